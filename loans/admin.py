@@ -4,11 +4,17 @@ from .models import (
 	AuditLog,
 	Client,
 	ClientAccessToken,
+	ClientCreditFeatures,
 	ClientOTP,
+	DailyCollectionRollup,
 	Loan,
 	LoanReminderLog,
+	MpesaCallbackInbox,
 	NotificationLog,
+	OutboxMessage,
 	Payment,
+	ReminderRun,
+	StkPushRequest,
 	SuspiciousActivityLog,
 )
 
@@ -39,6 +45,12 @@ class ClientAdmin(ReadOnlyAdmin):
 	)
 
 
+@admin.register(ClientCreditFeatures)
+class ClientCreditFeaturesAdmin(ReadOnlyAdmin):
+	list_display = ("client", "loans_total", "loans_paid", "paid_on_time", "total_due", "total_repaid", "updated_at")
+	readonly_fields = ("client", "loans_total", "loans_paid", "paid_on_time", "total_due", "total_repaid", "updated_at")
+
+
 @admin.register(Loan)
 class LoanAdmin(ReadOnlyAdmin):
 	list_display = (
@@ -76,10 +88,52 @@ class PaymentAdmin(ReadOnlyAdmin):
 		"phone",
 		"paid_at",
 		"raw_payload",
-		"raw_payload_encrypted",
 	)
 
 
+@admin.register(DailyCollectionRollup)
+class DailyCollectionRollupAdmin(ReadOnlyAdmin):
+	list_display = ("date", "total_amount", "payments_count", "loans_count", "updated_at")
+	date_hierarchy = "date"
+	readonly_fields = ("date", "total_amount", "payments_count", "loans_count", "updated_at")
+
+
+@admin.register(StkPushRequest)
+class StkPushRequestAdmin(ReadOnlyAdmin):
+	list_display = ("public_id", "loan", "amount", "state", "checkout_request_id", "created_at")
+	list_filter = ("state", "created_at")
+	search_fields = ("public_id", "checkout_request_id", "phone")
+	readonly_fields = (
+		"public_id",
+		"loan",
+		"phone",
+		"amount",
+		"state",
+		"checkout_request_id",
+		"merchant_request_id",
+		"result_code",
+		"result_desc",
+		"created_at",
+		"updated_at",
+	)
+
+
+@admin.register(MpesaCallbackInbox)
+class MpesaCallbackInboxAdmin(ReadOnlyAdmin):
+	list_display = ("id", "loan_id", "status", "attempts", "received_at", "processed_at")
+	list_filter = ("status", "received_at")
+	search_fields = ("checkout_request_id",)
+	readonly_fields = ("loan_id", "checkout_request_id", "status", "attempts", "available_at", "last_error", "received_at", "processed_at")
+
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(ReadOnlyAdmin):
+	list_display = ("id", "task", "status", "attempts", "available_at", "dispatched_at")
+	list_filter = ("status", "task")
+	search_fields = ("key",)
+	readonly_fields = ("task", "args", "key", "status", "attempts", "available_at", "last_error", "created_at", "dispatched_at")
+
+
 @admin.register(LoanReminderLog)
 class LoanReminderLogAdmin(ReadOnlyAdmin):
 	list_display = ("id", "loan", "reminder_type", "sent_at")
@@ -87,6 +141,24 @@ class LoanReminderLogAdmin(ReadOnlyAdmin):
 	readonly_fields = ("loan", "reminder_type", "sent_at")
 
 
+@admin.register(ReminderRun)
+class ReminderRunAdmin(ReadOnlyAdmin):
+	list_display = ("run_date", "reminder_type", "total", "sent", "failed", "pace", "finished_at")
+	list_filter = ("reminder_type", "run_date")
+	readonly_fields = (
+		"reminder_type",
+		"run_date",
+		"total",
+		"pace",
+		"sent",
+		"failed",
+		"last_loan_id",
+		"paced_at",
+		"started_at",
+		"finished_at",
+	)
+
+
 @admin.register(ClientOTP)
 class ClientOTPAdmin(ReadOnlyAdmin):
 	list_display = ("id", "phone_number", "expires_at", "attempts", "verified_at", "created_at")
@@ -3,6 +3,7 @@ from rest_framework import authentication
 from rest_framework import exceptions
 
 from loans.models import ClientAccessToken, hash_value
+from loans.services.client_tokens import cache_token, get_cached_token, get_last_used_tracker
 
 
 class ClientTokenAuthentication(authentication.BaseAuthentication):
@@ -16,14 +17,19 @@ class ClientTokenAuthentication(authentication.BaseAuthentication):
         raw_token = auth_header.split(" ", 1)[1].strip()
         token_hash = hash_value(raw_token)
 
-        try:
-            token_obj = ClientAccessToken.objects.select_related("client").get(token_hash=token_hash)
-        except ClientAccessToken.DoesNotExist as exc:
-            raise exceptions.AuthenticationFailed("Invalid client token") from exc
+        token_obj = get_cached_token(token_hash)
+        if token_obj is None:
+            try:
+                token_obj = ClientAccessToken.objects.select_related("client").get(token_hash=token_hash)
+            except ClientAccessToken.DoesNotExist as exc:
+                raise exceptions.AuthenticationFailed("Invalid client token") from exc
+            if token_obj.is_active():
+                cache_token(token_obj)
 
         if not token_obj.is_active():
             raise exceptions.AuthenticationFailed("Expired or revoked client token")
 
+        # last_used_at is only written once per CLIENT_TOKEN_TOUCH_SECONDS per process, in one batch.
         token_obj.last_used_at = timezone.now()
-        token_obj.save(update_fields=["last_used_at"])
+        get_last_used_tracker().touch(token_obj.id, token_obj.last_used_at)
         return token_obj.client, token_obj
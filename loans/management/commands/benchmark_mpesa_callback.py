@@ -0,0 +1,116 @@
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from loans.models import Client, Loan
+from loans.services.callbacks import INBOX_BATCH_SIZE, process_callback_inbox
+from loans.services.query_budget import collect_query_stats
+from loans.views import mpesa_callback
+
+BENCH_TOKEN = "benchmark-token"
+
+
+def callback_payload(receipt: str, amount: int) -> dict:
+    return {
+        "Body": {
+            "stkCallback": {
+                "CheckoutRequestID": f"ws_CO_{receipt}",
+                "ResultCode": 0,
+                "CallbackMetadata": {
+                    "Item": [
+                        {"Name": "Amount", "Value": amount},
+                        {"Name": "MpesaReceiptNumber", "Value": receipt},
+                        {"Name": "PhoneNumber", "Value": 254700000000},
+                    ]
+                },
+            }
+        }
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the M-Pesa callback ack and the inbox drain, draining after every callback (drain-batch-1) and in "
+        "batches (rolled back afterwards). Neither mode is the pre-inbox inline view; drain-batch-1 shows what "
+        "batching saves, and the queries per callback show what each applied payment costs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--callbacks", type=int, default=2000)
+        parser.add_argument("--loans", type=int, default=200)
+        parser.add_argument("--batch-size", type=int, default=INBOX_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        factory = RequestFactory()
+        with override_settings(
+            MPESA_CALLBACK_TOKEN=BENCH_TOKEN,
+            MPESA_WEBHOOK_SECRET="",
+            MPESA_CALLBACK_ALLOWED_IPS=[],
+        ):
+            single = self._run(factory, options, batch_size=1)
+            batched = self._run(factory, options, batch_size=options["batch_size"])
+
+        count = options["callbacks"]
+        # Most drain queries are the per-payment signal work (credit counters, collection rollups, outbox rows),
+        # which batching the inbox does not remove.
+        for label, timings in (("drain-batch-1", single), (f"drain-batch-{options['batch_size']}", batched)):
+            self.stdout.write(
+                f"{label}: ack {count / timings['ack']:.1f} callbacks/s ({timings['ack']:.2f}s, "
+                f"{timings['ack_queries'] / count:.1f} queries/callback), "
+                f"drain {count / timings['drain']:.1f} callbacks/s ({timings['drain']:.2f}s, "
+                f"{timings['drain_queries'] / count:.1f} queries/callback)"
+            )
+
+    def _post(self, factory, loan_id: int, receipt: str):
+        request = factory.post(
+            f"/api/mpesa/callback/{BENCH_TOKEN}/{loan_id}/",
+            data=callback_payload(receipt, 1),
+            content_type="application/json",
+        )
+        return mpesa_callback(request, token=BENCH_TOKEN, loan_id=loan_id)
+
+    def _run(self, factory, options, batch_size: int) -> dict:
+        with transaction.atomic():
+            client = Client.objects.create(name="Bench Client", phone_number="bench-callback")
+            loans = Loan.objects.bulk_create(
+                Loan(
+                    client=client,
+                    amount=Decimal("1000000.00"),
+                    status=Loan.Status.ACTIVE,
+                    due_date=timezone.localdate() + timedelta(days=30),
+                )
+                for _ in range(options["loans"])
+            )
+
+            timings = {"ack": 0.0, "drain": 0.0, "ack_queries": 0, "drain_queries": 0}
+            for index in range(options["callbacks"]):
+                loan_id = loans[index % len(loans)].id
+                with collect_query_stats() as stats:
+                    started = time.perf_counter()
+                    self._post(factory, loan_id, f"BENCHCB{index}")
+                    timings["ack"] += time.perf_counter() - started
+                timings["ack_queries"] += stats.count
+                if batch_size == 1:
+                    with collect_query_stats() as stats:
+                        started = time.perf_counter()
+                        process_callback_inbox(batch_size=1, max_batches=1)
+                        timings["drain"] += time.perf_counter() - started
+                    timings["drain_queries"] += stats.count
+
+            if batch_size > 1:
+                with collect_query_stats() as stats:
+                    started = time.perf_counter()
+                    while process_callback_inbox(batch_size=batch_size):
+                        pass
+                    timings["drain"] = time.perf_counter() - started
+                timings["drain_queries"] = stats.count
+
+            transaction.set_rollback(True)
+
+        return timings
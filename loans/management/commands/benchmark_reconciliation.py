@@ -0,0 +1,72 @@
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from loans.models import Client, Loan, Payment
+from loans.services.reconciliation import reconcile_loan_statuses
+
+
+class Command(BaseCommand):
+    help = "Benchmark the set-based loan reconciliation against synthetic portfolios (rolled back afterwards)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="10000,100000,1000000", help="Comma-separated loan counts")
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options["sizes"].split(",") if size.strip()]
+        for size in sizes:
+            with transaction.atomic():
+                seed_started = time.perf_counter()
+                self._seed(size, options["batch_size"])
+                seed_seconds = time.perf_counter() - seed_started
+
+                started = time.perf_counter()
+                report = reconcile_loan_statuses()
+                elapsed = time.perf_counter() - started
+                transaction.set_rollback(True)
+
+            self.stdout.write(
+                f"loans={size} seed={seed_seconds:.2f}s reconcile={elapsed:.2f}s "
+                f"scanned={report['scanned']} transitions={report['transitions']}"
+            )
+
+    def _seed(self, size: int, batch_size: int):
+        today = timezone.localdate()
+        client_count = max(1, size // 4)
+        clients = Client.objects.bulk_create(
+            (Client(name=f"Bench {i}", phone_number=f"bench-{i}") for i in range(client_count)),
+            batch_size=batch_size,
+        )
+
+        for start in range(0, size, batch_size):
+            loans = Loan.objects.bulk_create(
+                [
+                    Loan(
+                        client=clients[i % client_count],
+                        amount=Decimal("1000.00"),
+                        status=Loan.Status.ACTIVE,
+                        due_date=today + timedelta(days=(i % 60) - 30),
+                    )
+                    for i in range(start, min(start + batch_size, size))
+                ],
+                batch_size=batch_size,
+            )
+            # Every third loan is fully repaid but still flagged ACTIVE, so it must transition to PAID.
+            Payment.objects.bulk_create(
+                [
+                    Payment(
+                        loan=loan,
+                        amount=loan.amount,
+                        mpesa_receipt=f"BENCH{start + offset}",
+                        phone=f"bench-{start + offset}",
+                    )
+                    for offset, loan in enumerate(loans)
+                    if (start + offset) % 3 == 0
+                ],
+                batch_size=batch_size,
+            )
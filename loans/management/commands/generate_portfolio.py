@@ -0,0 +1,248 @@
+import random
+import time
+from datetime import datetime, time as day_time, timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from loans.models import AuditLog, Client, Loan, LoanReminderLog, Payment, encrypt_value, hash_value
+from loans.services.collections import rebuild_all_collection_rollups
+from loans.services.credit import rebuild_all_client_credit_features
+from loans.services.reminder_schedule import delivery_window
+from loans.services.reminders import DUE_SOON_DAYS_AHEAD
+from loans.services.report_cache import invalidate_reports
+
+TERMS_DAYS = (7, 14, 30, 30, 30, 60, 90)
+AUDIT_ENDPOINTS = (
+    ("GET", "/api/client/loans/summary/", 200),
+    ("GET", "/api/client/payments/", 200),
+    ("POST", "/api/client/loans/apply/", 201),
+    ("POST", "/api/client/auth/verify-otp/", 200),
+    ("POST", "/api/client/auth/verify-otp/", 400),
+)
+BACKDATE_BATCH_SIZE = 1000
+
+
+class BackdatedQuerySet(QuerySet):
+    """bulk_create that inserts the planned created_at/sent_at instead of letting auto_now_add stamp the current time.
+
+    A raw insert takes every field as set on the instance, so auto_now fields must be filled in by the caller.
+    """
+
+    def _insert(self, objs, fields, *args, **kwargs):
+        kwargs["raw"] = True
+        return super()._insert(objs, fields, *args, **kwargs)
+
+
+class Command(BaseCommand):
+    help = "Bulk-load a deterministic synthetic portfolio (clients, loans, payments, reminders, audit logs)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=10000)
+        parser.add_argument("--loans-per-client", type=float, default=4.0, help="Average loans per client")
+        parser.add_argument("--history-days", type=int, default=365, help="How far back loans are spread")
+        parser.add_argument("--audit-per-client", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--chunk-size", type=int, default=2000, help="Clients generated per transaction")
+        parser.add_argument("--skip-credit-features", action="store_true")
+
+    def handle(self, *args, **options):
+        if options["clients"] < 1 or options["loans_per_client"] < 1:
+            raise CommandError("--clients and --loans-per-client must be at least 1.")
+        if not 0 <= options["seed"] < 1000:
+            raise CommandError("--seed must be between 0 and 999; it namespaces phone numbers and receipts.")
+        if Client.objects.filter(phone_number=self._phone(options["seed"], 0)).exists():
+            raise CommandError(f"A portfolio for seed {options['seed']} already exists; pick another seed.")
+
+        rng = random.Random(options["seed"])
+        now = timezone.now()
+        totals = {"clients": 0, "loans": 0, "payments": 0, "reminders": 0, "audit_logs": 0}
+        started = time.perf_counter()
+
+        # bulk_create never sends post_save, so the credit/rollup/SMS signal handlers stay out of the way.
+        for start in range(0, options["clients"], options["chunk_size"]):
+            stop = min(start + options["chunk_size"], options["clients"])
+            with transaction.atomic():
+                counts = self._generate_chunk(rng, range(start, stop), now, options)
+            for key, value in counts.items():
+                totals[key] += value
+            self.stdout.write(f"{stop}/{options['clients']} clients, {totals['loans']} loans, {totals['payments']} payments")
+
+        rebuild_all_collection_rollups()
+        invalidate_reports()
+        if not options["skip_credit_features"]:
+            rebuild_all_client_credit_features()
+
+        elapsed = time.perf_counter() - started
+        rows = sum(totals.values())
+        summary = ", ".join(f"{key}={value}" for key, value in totals.items())
+        self.stdout.write(self.style.SUCCESS(f"Generated {rows} rows in {elapsed:.1f}s ({rows / elapsed:.0f} rows/s): {summary}"))
+
+    def _phone(self, seed: int, index: int) -> str:
+        return f"2547{seed:03d}{index:09d}"
+
+    def _generate_chunk(self, rng, indexes, now, options) -> dict:
+        seed = options["seed"]
+        history = timedelta(days=options["history_days"])
+        clients = []
+        for index in indexes:
+            id_number = f"{seed:03d}{index:09d}"
+            clients.append(
+                Client(
+                    name=f"Client {seed}-{index}",
+                    phone_number=self._phone(seed, index),
+                    id_number_encrypted=encrypt_value(id_number),
+                    id_number_hash=hash_value(id_number),
+                    created_at=now - history - timedelta(days=rng.randint(0, 180)),
+                    updated_at=now,
+                )
+            )
+        self._create_backdated(Client, clients)
+
+        loans = []
+        plans = []
+        max_loans = max(1, round(options["loans_per_client"] * 2) - 1)
+        for client in clients:
+            for _ in range(rng.randint(1, max_loans)):
+                loan, plan = self._plan_loan(rng, client, now, history)
+                loans.append(loan)
+                plans.append(plan)
+        self._create_backdated(Loan, loans)
+
+        payments = []
+        reminders = []
+        today = timezone.localdate(now)
+        # Reminders go out at the start of the delivery window; every day's is shifted from today's.
+        window_start, _end = delivery_window(today)
+        for loan, (installments, settled_at) in zip(loans, plans):
+            receipt_base = f"G{seed:03d}{loan.id:010d}"
+            remaining = loan.amount
+            for number, (amount, paid_at) in enumerate(installments):
+                payments.append(
+                    Payment(
+                        loan=loan,
+                        amount=amount,
+                        mpesa_receipt=f"{receipt_base}{number}",
+                        phone=loan.client.phone_number,
+                        paid_at=paid_at,
+                    )
+                )
+                remaining -= amount
+            reminders.extend(self._plan_reminders(loan, remaining, settled_at, today, window_start))
+        Payment.objects.bulk_create(payments)
+        self._create_backdated(LoanReminderLog, reminders)
+
+        audit_logs = []
+        for client in clients:
+            for _ in range(options["audit_per_client"]):
+                method, endpoint, status_code = rng.choice(AUDIT_ENDPOINTS)
+                audit_logs.append(
+                    AuditLog(
+                        actor=client.phone_number,
+                        action=f"{method} {endpoint}",
+                        endpoint=endpoint,
+                        method=method,
+                        status_code=status_code,
+                        metadata={"query": "", "duration_ms": round(rng.lognormvariate(3.5, 0.7), 2), "status_code": status_code},
+                        created_at=now - timedelta(seconds=rng.randint(0, int(history.total_seconds()))),
+                    )
+                )
+        self._create_backdated(AuditLog, audit_logs)
+
+        return {
+            "clients": len(clients),
+            "loans": len(loans),
+            "payments": len(payments),
+            "reminders": len(reminders),
+            "audit_logs": len(audit_logs),
+        }
+
+    def _create_backdated(self, model, objects: list):
+        BackdatedQuerySet(model).bulk_create(objects, batch_size=BACKDATE_BATCH_SIZE)
+
+    def _plan_loan(self, rng, client, now, history):
+        created_at = now - timedelta(seconds=rng.randint(0, int(history.total_seconds())))
+        due_date = timezone.localdate(created_at) + timedelta(days=rng.choice(TERMS_DAYS))
+        amount = Decimal(min(100000, max(500, round(rng.lognormvariate(8.3, 0.6), -2)))).quantize(Decimal("0.01"))
+        today = timezone.localdate(now)
+        age_days = (now - created_at).days
+
+        approval_status = Loan.ApprovalStatus.APPROVED
+        approved_at = min(now, created_at + timedelta(minutes=rng.randint(5, 600)))
+        if age_days < 2 and rng.random() < 0.5:
+            approval_status, approved_at = Loan.ApprovalStatus.PENDING, None
+        elif rng.random() < 0.02:
+            approval_status, approved_at = Loan.ApprovalStatus.REJECTED, None
+
+        # Matured loans: ~78% repaid (mostly on time), ~12% part-paid, ~10% untouched.
+        # Running loans: ~10% repaid early, ~45% part-paid, ~45% untouched.
+        repaid_share, part_paid_share = (0.78, 0.90) if due_date < today else (0.10, 0.55)
+        outcome = rng.random()
+        if approval_status != Loan.ApprovalStatus.APPROVED or outcome >= part_paid_share:
+            paid = Decimal("0.00")
+        elif outcome < repaid_share:
+            paid = amount
+        else:
+            paid = (amount * Decimal(rng.uniform(0.1, 0.9))).quantize(Decimal("1"))
+
+        installments = []
+        settled_at = None
+        if paid:
+            due_at = timezone.make_aware(datetime.combine(due_date, day_time(18)))
+            late = paid == amount and due_date < today and rng.random() < 0.15
+            window_end = min(now, due_at + timedelta(days=rng.randint(1, 20)) if late else due_at)
+            window_seconds = max(60, int((window_end - approved_at).total_seconds()))
+            offsets = sorted(rng.randint(60, window_seconds) for _ in range(rng.randint(1, 3)))
+            parts = self._split(rng, paid, len(offsets))
+            installments = [(part, min(now, approved_at + timedelta(seconds=offset))) for part, offset in zip(parts, offsets)]
+            if paid == amount:
+                settled_at = installments[-1][1]
+
+        if paid >= amount:
+            status = Loan.Status.PAID
+        elif due_date < today:
+            status = Loan.Status.OVERDUE
+        else:
+            status = Loan.Status.ACTIVE
+
+        loan = Loan(
+            client=client,
+            amount=amount,
+            status=status,
+            approval_status=approval_status,
+            approved_at=approved_at,
+            due_date=due_date,
+            created_at=created_at,
+        )
+        return loan, (installments, settled_at)
+
+    def _split(self, rng, total: Decimal, parts: int) -> list:
+        if parts == 1:
+            return [total]
+        cuts = sorted(rng.sample(range(1, int(total)), parts - 1)) if int(total) > parts else []
+        if not cuts:
+            return [total]
+        bounds = [0, *cuts, int(total)]
+        amounts = [Decimal(bounds[i + 1] - bounds[i]) for i in range(len(bounds) - 1)]
+        amounts[-1] += total - sum(amounts)
+        return amounts
+
+    def _plan_reminders(self, loan, remaining: Decimal, settled_at, today, window_start) -> list:
+        reminders = []
+        due_soon_day = loan.due_date - timedelta(days=DUE_SOON_DAYS_AHEAD)
+        due_soon_at = window_start + (due_soon_day - today)
+        overdue_at = window_start + (loan.due_date + timedelta(days=1) - today)
+        if loan.approval_status != Loan.ApprovalStatus.APPROVED:
+            return reminders
+        if due_soon_day <= today and (settled_at is None or settled_at > due_soon_at):
+            reminders.append(
+                LoanReminderLog(loan=loan, reminder_type=LoanReminderLog.ReminderType.DUE_SOON, sent_at=due_soon_at)
+            )
+        if loan.due_date < today and remaining > 0:
+            reminders.append(
+                LoanReminderLog(loan=loan, reminder_type=LoanReminderLog.ReminderType.OVERDUE, sent_at=overdue_at)
+            )
+        return reminders
@@ -0,0 +1,29 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from loans.services.collections import ROLLUP_CHUNK_DAYS, rebuild_all_collection_rollups, verify_collection_rollups
+
+
+class Command(BaseCommand):
+    help = "Backfill the daily collection rollups from the payment table, or check them for drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true", help="Compare rollups with live payments without writing")
+        parser.add_argument("--since", type=date.fromisoformat, help="Only touch days from this date (YYYY-MM-DD)")
+        parser.add_argument("--chunk-days", type=int, default=ROLLUP_CHUNK_DAYS)
+
+    def handle(self, *args, **options):
+        if not options["check"]:
+            rebuilt = rebuild_all_collection_rollups(chunk_days=options["chunk_days"], since=options["since"])
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt collection rollups for {rebuilt} days."))
+            return
+
+        mismatches = 0
+        for day, stored, expected in verify_collection_rollups(chunk_days=options["chunk_days"], since=options["since"]):
+            mismatches += 1
+            self.stdout.write(self.style.WARNING(f"date={day} stored={stored} live={expected}"))
+
+        if mismatches:
+            raise CommandError(f"{mismatches} days have drifted collection rollups.")
+        self.stdout.write(self.style.SUCCESS("Collection rollups match live payments."))
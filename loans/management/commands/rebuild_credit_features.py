@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from loans.services.credit import (
+    CREDIT_CHUNK_SIZE,
+    rebuild_all_client_credit_features,
+    verify_client_credit_features,
+)
+
+
+class Command(BaseCommand):
+    help = "Rebuild per-client credit counters from the loan and payment tables, or check them for drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true", help="Compare counters with live tables without writing")
+        parser.add_argument("--chunk-size", type=int, default=CREDIT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        if not options["check"]:
+            rebuilt = rebuild_all_client_credit_features(chunk_size=options["chunk_size"])
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt credit counters for {rebuilt} clients."))
+            return
+
+        mismatches = 0
+        for client_id, stored, expected in verify_client_credit_features(chunk_size=options["chunk_size"]):
+            mismatches += 1
+            self.stdout.write(self.style.WARNING(f"client={client_id} stored={stored} live={expected}"))
+
+        if mismatches:
+            raise CommandError(f"{mismatches} clients have drifted credit counters.")
+        self.stdout.write(self.style.SUCCESS("Credit counters match live tables."))
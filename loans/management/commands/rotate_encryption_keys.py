@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from loans.models import Client, MpesaCallbackInbox, PaymentPayload, field_encryption_keys
+from loans.services.key_rotation import init_rotation_worker, rotate_tokens
+
+TARGETS = (
+    (Client, "id_number_encrypted"),
+    (PaymentPayload, "payload_encrypted"),
+    (MpesaCallbackInbox, "payload_encrypted"),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-encrypt client ID numbers, stored M-Pesa payloads and inbox callbacks under FIELD_ENCRYPTION_KEY. "
+        "Keep the old keys in FIELD_ENCRYPTION_PREVIOUS_KEYS until this finishes; progress is checkpointed "
+        "after every batch so an interrupted run resumes where it stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Rows per worker task")
+        parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1), help="1 runs in-process")
+        parser.add_argument("--progress-file", default="rotate-encryption-keys.json")
+        parser.add_argument("--restart", action="store_true", help="Ignore saved progress")
+
+    def handle(self, *args, **options):
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be at least 1.")
+        keys = field_encryption_keys()
+        progress_path = Path(options["progress_file"])
+        fingerprint = hashlib.sha256(keys[0].encode("utf-8")).hexdigest()[:16]
+        progress = self._load_progress(progress_path, fingerprint, options["restart"])
+
+        workers = max(1, options["workers"])
+        executor = None
+        if workers > 1:
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=init_rotation_worker, initargs=(keys,))
+        else:
+            init_rotation_worker(keys)
+
+        unreadable_total = 0
+        try:
+            for model, field in TARGETS:
+                label = f"{model._meta.label}.{field}"
+                last_pk = progress["fields"].get(label, 0)
+                rotated_count = 0
+                while True:
+                    chunks = self._next_chunks(model, field, last_pk, options["chunk_size"], workers)
+                    if not chunks:
+                        break
+                    results = executor.map(rotate_tokens, chunks) if executor else map(rotate_tokens, chunks)
+                    rotated, unreadable = [], []
+                    for chunk_rotated, chunk_unreadable in results:
+                        rotated.extend(chunk_rotated)
+                        unreadable.extend(chunk_unreadable)
+                    if rotated:
+                        rotated = self._write_unchanged(model, field, chunks, rotated, options["chunk_size"])
+                    for pk in unreadable:
+                        self.stdout.write(self.style.WARNING(f"{label} pk={pk}: no configured key can decrypt it"))
+                    rotated_count += len(rotated)
+                    unreadable_total += len(unreadable)
+                    last_pk = chunks[-1][-1][0]
+                    progress["fields"][label] = last_pk
+                    progress_path.write_text(json.dumps(progress, indent=2, sort_keys=True))
+                self.stdout.write(f"{label}: re-encrypted {rotated_count} rows")
+        finally:
+            if executor:
+                executor.shutdown()
+
+        if unreadable_total:
+            raise CommandError(f"{unreadable_total} values could not be decrypted with any configured key.")
+        self.stdout.write(
+            self.style.SUCCESS("Every encrypted field is under the primary key; previous keys can be retired.")
+        )
+
+    def _load_progress(self, path: Path, fingerprint: str, restart: bool) -> dict:
+        if not restart and path.exists():
+            saved = json.loads(path.read_text())
+            # Progress only counts for the key it was made with; a newer rotation starts from the top.
+            if saved.get("key") == fingerprint:
+                return saved
+        return {"key": fingerprint, "fields": {}}
+
+    def _write_unchanged(self, model, field: str, chunks: list, rotated: list, batch_size: int) -> list:
+        # The rows were read before the workers ran; one saved since then already holds a token made by the app
+        # under the primary key, and writing the rotated copy of the old value would undo that edit.
+        read = {pk: token for chunk in chunks for pk, token in chunk}
+        with transaction.atomic():
+            stored = dict(
+                model.objects.select_for_update().filter(pk__in=[pk for pk, _ in rotated]).values_list("pk", field)
+            )
+            unchanged = [(pk, token) for pk, token in rotated if stored.get(pk) == read[pk]]
+            model.objects.bulk_update(
+                [model(pk=pk, **{field: token}) for pk, token in unchanged],
+                [field],
+                batch_size=batch_size,
+            )
+        return unchanged
+
+    def _next_chunks(self, model, field: str, after_pk: int, chunk_size: int, count: int) -> list:
+        rows = list(
+            model.objects.filter(pk__gt=after_pk)
+            .exclude(**{field: ""})
+            .order_by("pk")
+            .values_list("pk", field)[: chunk_size * count]
+        )
+        return [rows[start : start + chunk_size] for start in range(0, len(rows), chunk_size)]
@@ -0,0 +1,361 @@
+import json
+import statistics
+from contextlib import nullcontext
+from types import SimpleNamespace
+import time
+import tracemalloc
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from itertools import count
+from pathlib import Path
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework.test import force_authenticate
+
+from loans.management.commands.benchmark_mpesa_callback import BENCH_TOKEN, callback_payload
+from loans.models import Loan, MpesaCallbackInbox, NotificationLog, OutboxMessage, Payment, StkPushRequest
+from loans.services.collections import refresh_collection_days
+from loans.services.query_budget import collect_query_stats
+from loans.services.reminder_schedule import delivery_window, run_reminder_schedule
+from loans.services.report_cache import REPORT_CACHE_ALIAS, clear_report_cache
+from loans.tasks import (
+    apply_payment_effects_task,
+    check_suspicious_transactions,
+    dispatch_outbox_messages,
+    fail_stale_stk_pushes_task,
+    process_mpesa_callback_inbox,
+    purge_mpesa_callback_inbox,
+    purge_outbox_messages,
+    reconcile_transactions,
+    recompute_credit_scores_task,
+    retry_failed_notifications,
+    send_due_soon_reminders,
+    send_overdue_reminders,
+    send_payment_confirmation_sms,
+    send_stk_push,
+)
+from loans.views import (
+    DailyCollectionsReportView,
+    MonthlyPerformanceReportView,
+    OutstandingLoansReportView,
+    OverdueLoansReportView,
+    SystemMetricsView,
+    mpesa_callback,
+)
+
+PENDING_CALLBACKS = 200
+SETTLED_CALLBACKS = 200
+FAILED_NOTIFICATIONS = 50
+OVERPAID_LOANS = 20
+OUTBOX_MESSAGES = 200
+STALE_STK_PUSHES = 50
+MIN_PEAK_DELTA_KB = 256
+# Beat tasks that have no benchmark on purpose; every other scheduled task must have one.
+UNBENCHMARKED_TASKS = {"loans.tasks.run_daily_backup"}
+STK_PUSH_RESPONSE = {
+    "ResponseCode": "0",
+    "ResponseDescription": "Success. Request accepted for processing",
+    "CheckoutRequestID": "ws_CO_BENCH",
+    "MerchantRequestID": "BENCH-1",
+}
+
+
+def task_benchmark_name(task_name: str) -> str:
+    return "task_" + task_name.rsplit(".", 1)[-1].removesuffix("_task")
+
+
+def unbenchmarked_beat_tasks(benchmark_names) -> list:
+    benchmarked = set(benchmark_names)
+    scheduled = {entry["task"] for entry in settings.CELERY_BEAT_SCHEDULE.values()}
+    return sorted(task for task in scheduled - UNBENCHMARKED_TASKS if task_benchmark_name(task) not in benchmarked)
+
+
+def compare_results(current: dict, baseline: dict, threshold: float, min_delta_ms: float) -> list:
+    regressions = []
+    for size, benchmarks in current["results"].items():
+        for name, result in benchmarks.items():
+            before = baseline.get("results", {}).get(size, {}).get(name)
+            if not before:
+                continue
+            label = f"{name}@{size}"
+            if result["queries"] > before["queries"]:
+                regressions.append(f"{label}: queries {before['queries']} -> {result['queries']}")
+            wall_delta = result["wall_ms"] - before["wall_ms"]
+            if wall_delta > min_delta_ms and result["wall_ms"] > before["wall_ms"] * (1 + threshold):
+                regressions.append(f"{label}: wall {before['wall_ms']}ms -> {result['wall_ms']}ms")
+            peak_delta = result["peak_kb"] - before["peak_kb"]
+            if peak_delta > MIN_PEAK_DELTA_KB and result["peak_kb"] > before["peak_kb"] * (1 + threshold):
+                regressions.append(f"{label}: peak memory {before['peak_kb']}KB -> {result['peak_kb']}KB")
+    return regressions
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the report views, the M-Pesa callback and the Celery tasks against generated portfolios, "
+        "write the results as JSON and optionally fail on regressions against a baseline. "
+        "run_daily_backup is left out because it only copies the database file; any other beat task without a "
+        "benchmark is an error."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="1000,10000", help="Comma-separated client counts")
+        parser.add_argument("--repeat", type=int, default=5, help="Timed runs per benchmark; the median is kept")
+        parser.add_argument("--only", default="", help="Comma-separated benchmark names to run")
+        parser.add_argument("--seed", type=int, default=500)
+        parser.add_argument("--output", default="benchmark-results.json")
+        parser.add_argument("--baseline", help="Results file to compare against")
+        parser.add_argument("--threshold", type=float, default=0.25, help="Allowed relative slowdown")
+        parser.add_argument("--min-delta-ms", type=float, default=5.0, help="Ignore slowdowns smaller than this")
+
+    def handle(self, *args, **options):
+        missing = unbenchmarked_beat_tasks(name for name, _run in self._benchmarks({}))
+        if missing:
+            raise CommandError(f"Beat tasks without a benchmark: {', '.join(missing)}.")
+        sizes = [int(size) for size in options["sizes"].split(",") if size.strip()]
+        only = {name.strip() for name in options["only"].split(",") if name.strip()}
+        report = {
+            "created_at": timezone.now().isoformat(),
+            "database": connection.vendor,
+            "repeat": options["repeat"],
+            "results": {},
+        }
+
+        # Every size is seeded and measured inside one transaction that is rolled back, and every timed
+        # run sits in its own savepoint so tasks see the same data on each repeat. Twilio, Daraja and the
+        # Celery broker are replaced by stubs that accept everything, so only our own work (queries,
+        # NotificationLog rows) is timed, and the report cache is a private in-memory one that is emptied
+        # before every run.
+        with override_settings(
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"],
+            CACHES={
+                **settings.CACHES,
+                REPORT_CACHE_ALIAS: {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "benchmarks"},
+            },
+            MPESA_CALLBACK_TOKEN=BENCH_TOKEN,
+            MPESA_WEBHOOK_SECRET="",
+            MPESA_CALLBACK_ALLOWED_IPS=[],
+            SMS_PROVIDER="twilio",
+            TWILIO_FROM_NUMBER="+15550000000",
+            ENABLE_WHATSAPP_REMINDERS=False,
+            SMS_RATE_LIMITS={},
+            ADMIN_ALERT_PHONE="254700000000",
+            OUTBOX_DISPATCH_MODE="broker",
+        ), mock.patch(
+            "loans.services.sms._twilio_client", return_value=mock.Mock()
+        ), mock.patch(
+            "loans.tasks.get_mpesa_service", return_value=mock.Mock(**{"stk_push.return_value": STK_PUSH_RESPONSE})
+        ), mock.patch(
+            "loans.services.outbox.current_app",
+            SimpleNamespace(producer_or_acquire=nullcontext, send_task=lambda *args, **kwargs: None),
+        ):
+            for size in sizes:
+                with transaction.atomic():
+                    fixtures = self._seed(size, options["seed"])
+                    results = {}
+                    for name, run in self._benchmarks(fixtures):
+                        if only and name not in only:
+                            continue
+                        results[name] = self._measure(run, options["repeat"])
+                        self.stdout.write(
+                            f"clients={size} {name}: {results[name]['wall_ms']}ms "
+                            f"queries={results[name]['queries']} peak={results[name]['peak_kb']}KB"
+                        )
+                    transaction.set_rollback(True)
+                report["results"][str(size)] = results
+
+        Path(options["output"]).write_text(json.dumps(report, indent=2, sort_keys=True))
+        self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+        if not options["baseline"]:
+            return
+        baseline = json.loads(Path(options["baseline"]).read_text())
+        regressions = compare_results(report, baseline, options["threshold"], options["min_delta_ms"])
+        for regression in regressions:
+            self.stdout.write(self.style.WARNING(regression))
+        if regressions:
+            raise CommandError(f"{len(regressions)} benchmark regressions against {options['baseline']}.")
+        self.stdout.write(self.style.SUCCESS(f"No regressions against {options['baseline']}."))
+
+    def _seed(self, size: int, seed: int) -> dict:
+        call_command("generate_portfolio", clients=size, seed=seed, stdout=StringIO())
+        staff = get_user_model().objects.create_superuser(
+            username=f"benchmark-{seed}",
+            email="benchmark@example.com",
+            password=None,
+        )
+
+        active_loans = list(Loan.objects.filter(status=Loan.Status.ACTIVE).values_list("id", flat=True)[:PENDING_CALLBACKS])
+        MpesaCallbackInbox.objects.bulk_create(
+            MpesaCallbackInbox(loan_id=loan_id, payload=callback_payload(f"BENCHIN{index}", 1))
+            for index, loan_id in enumerate(active_loans)
+        )
+        NotificationLog.objects.bulk_create(
+            NotificationLog(
+                phone_number=f"2547000{index:05d}",
+                channel=NotificationLog.Channel.SMS,
+                message="Benchmark retry",
+                success=False,
+                error_message="Twilio SMS config missing",
+            )
+            for index in range(FAILED_NOTIFICATIONS)
+        )
+        overpaid_at = timezone.now() - timedelta(days=1)
+        Payment.objects.bulk_create(
+            Payment(
+                loan_id=loan_id,
+                amount=Decimal("50.00"),
+                mpesa_receipt=f"BENCHOVER{loan_id}",
+                phone="254700000000",
+                paid_at=overpaid_at,
+            )
+            for loan_id in Loan.objects.filter(status=Loan.Status.PAID).values_list("id", flat=True)[:OVERPAID_LOANS]
+        )
+        refresh_collection_days(overpaid_at)
+
+        # The payment-effects job settles a running loan of its own, which leaves the other benchmarks' data alone.
+        unsettled = Loan.objects.create(
+            client_id=Loan.objects.values_list("client_id", flat=True).first(),
+            amount=Decimal("1000.00"),
+            due_date=timezone.localdate() + timedelta(days=30),
+        )
+        retention_days = max(settings.OUTBOX_RETENTION_DAYS, settings.MPESA_INBOX_RETENTION_DAYS)
+        expired = timezone.now() - timedelta(days=retention_days + 1)
+        loan_ids = list(Loan.objects.values_list("id", flat=True)[:SETTLED_CALLBACKS])
+        MpesaCallbackInbox.objects.bulk_create(
+            MpesaCallbackInbox(
+                loan_id=loan_ids[index % len(loan_ids)],
+                payload=callback_payload(f"BENCHDONE{index}", 1),
+                status=MpesaCallbackInbox.Status.APPLIED,
+                processed_at=expired,
+            )
+            for index in range(SETTLED_CALLBACKS)
+        )
+        OutboxMessage.objects.bulk_create(
+            OutboxMessage(task=send_payment_confirmation_sms.name, args=[index])
+            for index in range(OUTBOX_MESSAGES)
+        )
+        OutboxMessage.objects.bulk_create(
+            OutboxMessage(
+                task=send_payment_confirmation_sms.name,
+                args=[index],
+                status=OutboxMessage.Status.DISPATCHED,
+                dispatched_at=expired,
+            )
+            for index in range(OUTBOX_MESSAGES)
+        )
+        StkPushRequest.objects.bulk_create(
+            StkPushRequest(loan_id=loan_ids[0], phone="254700000000", amount=Decimal("1.00"), state=StkPushRequest.State.SENDING)
+            for _ in range(STALE_STK_PUSHES)
+        )
+        StkPushRequest.objects.filter(state=StkPushRequest.State.SENDING).update(updated_at=expired)
+        push = StkPushRequest.objects.create(loan_id=loan_ids[0], phone="254700000000", amount=Decimal("1.00"))
+        return {
+            "staff": staff,
+            "loan_id": active_loans[0] if active_loans else Loan.objects.values_list("id", flat=True).first(),
+            "payment_id": Payment.objects.values_list("id", flat=True).first(),
+            "unsettled": (unsettled.id, unsettled.client_id, unsettled.amount),
+            "push_id": push.id,
+        }
+
+    def _benchmarks(self, fixtures: dict):
+        factory = RequestFactory()
+        receipts = count()
+
+        def view(view_class, path):
+            handler = view_class.as_view()
+
+            def run():
+                request = factory.get(path)
+                force_authenticate(request, user=fixtures["staff"])
+                response = handler(request)
+                response.render()
+                if response.status_code != 200:
+                    raise CommandError(f"{path} answered {response.status_code}")
+
+            return run
+
+        def callback():
+            loan_id = fixtures["loan_id"]
+            request = factory.post(
+                f"/api/mpesa/callback/{BENCH_TOKEN}/{loan_id}/",
+                data=callback_payload(f"BENCHRUN{next(receipts)}", 1),
+                content_type="application/json",
+            )
+            mpesa_callback(request, token=BENCH_TOKEN, loan_id=loan_id).render()
+
+        def payment_effects():
+            # The payment that settles the loan is written inside the timed run (one INSERT, no signals) so that
+            # the job has a transition to apply and the other benchmarks keep seeing the seeded portfolio.
+            loan_id, client_id, balance = fixtures["unsettled"]
+            Payment.objects.bulk_create(
+                [Payment(loan_id=loan_id, amount=balance, mpesa_receipt="BENCHSETTLE", phone="254700000000")]
+            )
+            apply_payment_effects_task(client_id)
+
+        def pace_reminders():
+            # One tick early in today's delivery window, so the runs are planned and the first share is sent.
+            start, _end = delivery_window(timezone.localdate())
+            run_reminder_schedule(now=start + timedelta(seconds=settings.REMINDER_TICK_SECONDS))
+
+        return [
+            ("report_daily_collections", view(DailyCollectionsReportView, "/api/reports/daily-collections/")),
+            ("report_outstanding_loans", view(OutstandingLoansReportView, "/api/reports/outstanding-loans/")),
+            ("report_overdue_loans", view(OverdueLoansReportView, "/api/reports/overdue-loans/")),
+            ("report_monthly_performance", view(MonthlyPerformanceReportView, "/api/reports/monthly-performance/")),
+            ("system_metrics", view(SystemMetricsView, "/api/system/metrics/")),
+            ("mpesa_callback", callback),
+            ("task_send_payment_confirmation_sms", lambda: send_payment_confirmation_sms(fixtures["payment_id"])),
+            ("task_send_stk_push", lambda: send_stk_push(fixtures["push_id"])),
+            ("task_fail_stale_stk_pushes", fail_stale_stk_pushes_task),
+            ("task_apply_payment_effects", payment_effects),
+            ("task_dispatch_outbox_messages", dispatch_outbox_messages),
+            ("task_purge_outbox_messages", purge_outbox_messages),
+            ("task_process_mpesa_callback_inbox", process_mpesa_callback_inbox),
+            ("task_purge_mpesa_callback_inbox", purge_mpesa_callback_inbox),
+            ("task_pace_loan_reminders", pace_reminders),
+            ("task_send_due_soon_reminders", send_due_soon_reminders),
+            ("task_send_overdue_reminders", send_overdue_reminders),
+            ("task_recompute_credit_scores", recompute_credit_scores_task),
+            ("task_reconcile_transactions", reconcile_transactions),
+            ("task_retry_failed_notifications", retry_failed_notifications),
+            ("task_check_suspicious_transactions", check_suspicious_transactions),
+        ]
+
+    def _run_once(self, run):
+        cache.clear()
+        clear_report_cache()
+        with transaction.atomic(), collect_query_stats() as stats:
+            started = time.perf_counter()
+            run()
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            transaction.set_rollback(True)
+        return elapsed_ms, stats.count
+
+    def _measure(self, run, repeat: int) -> dict:
+        samples = [self._run_once(run) for _ in range(max(1, repeat))]
+        timings = [elapsed_ms for elapsed_ms, _queries in samples]
+
+        # tracemalloc slows allocation-heavy code down, so peak memory gets its own untimed run.
+        tracemalloc.start()
+        try:
+            self._run_once(run)
+            _current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        return {
+            "wall_ms": round(statistics.median(timings), 2),
+            "wall_ms_min": round(min(timings), 2),
+            "queries": samples[-1][1],
+            "peak_kb": round(peak / 1024, 1),
+        }
@@ -1,13 +1,19 @@
+import json
 import logging
 import time
 
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
 from django.utils.deprecation import MiddlewareMixin
 from rest_framework.exceptions import APIException
 
 from loans.models import AuditLog
+from loans.services.audit import record_audit_entry
+from loans.services.latency import HTTP_METHODS, UNMATCHED_ENDPOINT, get_latency_histogram
+from loans.services.query_budget import budget_for, collect_query_stats
 
 logger = logging.getLogger(__name__)
+budget_logger = logging.getLogger("loans.query_budget")
 
 
 class AuditLogMiddleware(MiddlewareMixin):
@@ -29,17 +35,64 @@ class AuditLogMiddleware(MiddlewareMixin):
             duration_ms = None
             if start:
                 duration_ms = round((time.perf_counter() - start) * 1000, 2)
+                resolver_match = getattr(request, "resolver_match", None)
+                endpoint = f"/{resolver_match.route}" if resolver_match and resolver_match.route else UNMATCHED_ENDPOINT
+                method = request.method if request.method in HTTP_METHODS else "OTHER"
+                try:
+                    get_latency_histogram().record(method, endpoint, response.status_code, duration_ms)
+                except OSError:
+                    logger.exception("Failed to record latency for %s %s", request.method, endpoint)
 
-            AuditLog.objects.create(
-                actor=actor,
-                action=f"{request.method} {request.path}",
-                endpoint=request.path,
-                method=request.method,
-                status_code=response.status_code,
-                metadata={
-                    "query": request.META.get("QUERY_STRING", ""),
-                    "duration_ms": duration_ms,
-                    "status_code": response.status_code,
-                },
+            record_audit_entry(
+                AuditLog(
+                    actor=actor,
+                    action=f"{request.method} {request.path}",
+                    endpoint=request.path,
+                    method=request.method,
+                    status_code=response.status_code,
+                    metadata={
+                        "query": request.META.get("QUERY_STRING", ""),
+                        "duration_ms": duration_ms,
+                        "status_code": response.status_code,
+                        **getattr(request, "_query_stats", {}),
+                    },
+                )
+            )
+        return response
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.QUERY_BUDGET_ENABLED or not request.path.startswith("/api/"):
+            return self.get_response(request)
+
+        started = time.perf_counter()
+        with collect_query_stats() as stats:
+            response = self.get_response(request)
+        duration_ms = round((time.perf_counter() - started) * 1000, 2)
+
+        resolver_match = getattr(request, "resolver_match", None)
+        url_name = resolver_match.url_name if resolver_match else None
+        budget = budget_for(url_name)
+        request._query_stats = {**stats.as_metadata(), "db_query_budget": budget}
+
+        over_budget = stats.count > budget
+        if over_budget or duration_ms >= settings.QUERY_BUDGET_SLOW_MS:
+            budget_logger.warning(
+                json.dumps(
+                    {
+                        "event": "query_budget_exceeded" if over_budget else "slow_request",
+                        "url_name": url_name,
+                        "method": request.method,
+                        "path": request.path,
+                        "status_code": response.status_code,
+                        "duration_ms": duration_ms,
+                        "budget": budget,
+                        **stats.as_metadata(),
+                    }
+                )
             )
         return response
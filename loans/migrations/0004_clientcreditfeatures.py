@@ -0,0 +1,27 @@
+# Generated by Django 6.0.2 on 2026-10-16 22:59
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0003_suspiciousactivitylog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClientCreditFeatures',
+            fields=[
+                ('client', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='credit_features', serialize=False, to='loans.client')),
+                ('loans_total', models.PositiveIntegerField(default=0)),
+                ('loans_paid', models.PositiveIntegerField(default=0)),
+                ('paid_on_time', models.PositiveIntegerField(default=0)),
+                ('total_due', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('total_repaid', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
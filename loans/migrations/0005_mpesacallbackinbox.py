@@ -0,0 +1,27 @@
+# Generated by Django 6.0.2 on 2026-10-16 23:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0004_clientcreditfeatures'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MpesaCallbackInbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('loan_id', models.PositiveBigIntegerField()),
+                ('payload', models.JSONField(blank=True, default=dict)),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('APPLIED', 'Applied'), ('IGNORED', 'Ignored'), ('DUPLICATE', 'Duplicate'), ('REJECTED', 'Rejected'), ('FAILED', 'Failed')], default='PENDING', max_length=10)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'id'], name='loans_mpesa_status_e5bbd9_idx')],
+            },
+        ),
+    ]
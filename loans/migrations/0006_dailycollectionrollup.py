@@ -0,0 +1,24 @@
+# Generated by Django 6.0.2 on 2026-10-16 23:15
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0005_mpesacallbackinbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyCollectionRollup',
+            fields=[
+                ('date', models.DateField(primary_key=True, serialize=False)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('payments_count', models.PositiveIntegerField(default=0)),
+                ('loans_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,88 @@
+# Generated by Django 6.0.2 on 2026-10-16 23:33
+
+import json
+
+import django.db.models.deletion
+from django.db import migrations, models, transaction
+
+CHUNK_SIZE = 1000
+
+
+def copy_payloads(apps, schema_editor):
+    # Encryption helpers are plain functions, not model methods, so the current ones are safe to use here.
+    from loans.models import decrypt_value, encrypt_payload
+
+    Payment = apps.get_model("loans", "Payment")
+    PaymentPayload = apps.get_model("loans", "PaymentPayload")
+    db = schema_editor.connection.alias
+    last_pk = 0
+    while True:
+        rows = list(
+            Payment.objects.using(db)
+            .filter(pk__gt=last_pk)
+            .order_by("pk")
+            .values_list("pk", "raw_payload", "raw_payload_encrypted")[:CHUNK_SIZE]
+        )
+        if not rows:
+            return
+        last_pk = rows[-1][0]
+        payloads = []
+        for pk, payload, encrypted in rows:
+            if not payload and encrypted:
+                payload = json.loads(decrypt_value(encrypted) or "{}")
+            if payload:
+                payloads.append(PaymentPayload(payment_id=pk, payload_encrypted=encrypt_payload(payload)))
+        # Each chunk commits on its own; rerunning after an interruption skips rows that were already copied.
+        with transaction.atomic(using=db):
+            PaymentPayload.objects.using(db).bulk_create(payloads, ignore_conflicts=True)
+
+
+def restore_payloads(apps, schema_editor):
+    from loans.models import decrypt_payload, encrypt_value
+
+    Payment = apps.get_model("loans", "Payment")
+    PaymentPayload = apps.get_model("loans", "PaymentPayload")
+    db = schema_editor.connection.alias
+    last_pk = 0
+    while True:
+        rows = list(
+            PaymentPayload.objects.using(db)
+            .filter(pk__gt=last_pk)
+            .order_by("pk")
+            .values_list("pk", "payload_encrypted")[:CHUNK_SIZE]
+        )
+        if not rows:
+            return
+        last_pk = rows[-1][0]
+        payments = []
+        for pk, encrypted in rows:
+            payload = decrypt_payload(encrypted)
+            payments.append(
+                Payment(
+                    pk=pk,
+                    raw_payload=payload,
+                    raw_payload_encrypted=encrypt_value(json.dumps(payload, separators=(",", ":"))),
+                )
+            )
+        with transaction.atomic(using=db):
+            Payment.objects.using(db).bulk_update(payments, ["raw_payload", "raw_payload_encrypted"])
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('loans', '0006_dailycollectionrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentPayload',
+            fields=[
+                ('payment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='payload_record', serialize=False, to='loans.payment')),
+                ('payload_encrypted', models.TextField()),
+            ],
+        ),
+        migrations.RunPython(copy_payloads, restore_payloads),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 6.0.2 on 2026-10-16 23:33
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0007_paymentpayload'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='payment',
+            name='raw_payload',
+        ),
+        migrations.RemoveField(
+            model_name='payment',
+            name='raw_payload_encrypted',
+        ),
+    ]
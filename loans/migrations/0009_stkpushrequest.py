@@ -0,0 +1,32 @@
+# Generated by Django 6.0.2 on 2026-10-16 23:40
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0008_remove_payment_raw_payload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StkPushRequest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('public_id', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('phone', models.CharField(max_length=20)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('state', models.CharField(choices=[('QUEUED', 'Queued'), ('SENT', 'Sent'), ('COMPLETED', 'Completed'), ('FAILED', 'Failed')], default='QUEUED', max_length=10)),
+                ('checkout_request_id', models.CharField(blank=True, max_length=100, null=True, unique=True)),
+                ('merchant_request_id', models.CharField(blank=True, default='', max_length=100)),
+                ('result_code', models.IntegerField(blank=True, null=True)),
+                ('result_desc', models.CharField(blank=True, default='', max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('loan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stk_push_requests', to='loans.loan')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-16 23:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0010_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loanreminderlog',
+            name='claim_id',
+            field=models.UUIDField(blank=True, db_index=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 6.0.2 on 2026-10-16 23:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0011_loanreminderlog_claim_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReminderRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reminder_type', models.CharField(choices=[('DUE_SOON', 'Due Soon'), ('OVERDUE', 'Overdue')], max_length=12)),
+                ('run_date', models.DateField()),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('pace', models.FloatField()),
+                ('sent', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('last_loan_id', models.PositiveBigIntegerField(default=0)),
+                ('paced_at', models.DateTimeField()),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('run_date', 'reminder_type'), name='unique_reminder_run_per_day')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 6.0.2 on 2026-10-17 09:12
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0012_reminderrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mpesacallbackinbox',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='mpesacallbackinbox',
+            name='available_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='mpesacallbackinbox',
+            name='last_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
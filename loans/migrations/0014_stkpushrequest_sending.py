@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-17 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0013_mpesacallbackinbox_retries'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stkpushrequest',
+            name='state',
+            field=models.CharField(choices=[('QUEUED', 'Queued'), ('SENDING', 'Sending'), ('SENT', 'Sent'), ('COMPLETED', 'Completed'), ('FAILED', 'Failed')], default='QUEUED', max_length=10),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 6.0.2 on 2026-10-17 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0014_stkpushrequest_sending'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mpesacallbackinbox',
+            name='checkout_request_id',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name='mpesacallbackinbox',
+            index=models.Index(fields=['checkout_request_id'], name='loans_mpesa_checkou_21e448_idx'),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 6.0.2 on 2026-10-17 10:20
+
+from django.db import migrations, models, transaction
+
+CHUNK_SIZE = 1000
+
+
+def encrypt_payloads(apps, schema_editor):
+    # Encryption helpers are plain functions, not model methods, so the current ones are safe to use here.
+    from loans.models import encrypt_payload
+
+    MpesaCallbackInbox = apps.get_model("loans", "MpesaCallbackInbox")
+    db = schema_editor.connection.alias
+    last_pk = 0
+    while True:
+        rows = list(
+            MpesaCallbackInbox.objects.using(db)
+            .filter(pk__gt=last_pk)
+            .order_by("pk")
+            .values_list("pk", "payload")[:CHUNK_SIZE]
+        )
+        if not rows:
+            return
+        last_pk = rows[-1][0]
+        entries = [
+            MpesaCallbackInbox(pk=pk, payload={}, payload_encrypted=encrypt_payload(payload))
+            for pk, payload in rows
+            if payload
+        ]
+        # Each chunk commits on its own; rerunning after an interruption re-encrypts nothing it already cleared.
+        with transaction.atomic(using=db):
+            MpesaCallbackInbox.objects.using(db).bulk_update(entries, ["payload", "payload_encrypted"])
+
+
+def decrypt_payloads(apps, schema_editor):
+    from loans.models import decrypt_payload
+
+    MpesaCallbackInbox = apps.get_model("loans", "MpesaCallbackInbox")
+    db = schema_editor.connection.alias
+    last_pk = 0
+    while True:
+        rows = list(
+            MpesaCallbackInbox.objects.using(db)
+            .filter(pk__gt=last_pk)
+            .order_by("pk")
+            .values_list("pk", "payload_encrypted")[:CHUNK_SIZE]
+        )
+        if not rows:
+            return
+        last_pk = rows[-1][0]
+        entries = [
+            MpesaCallbackInbox(pk=pk, payload=decrypt_payload(encrypted), payload_encrypted="")
+            for pk, encrypted in rows
+            if encrypted
+        ]
+        with transaction.atomic(using=db):
+            MpesaCallbackInbox.objects.using(db).bulk_update(entries, ["payload", "payload_encrypted"])
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('loans', '0015_mpesacallbackinbox_checkout_request_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mpesacallbackinbox',
+            name='payload_encrypted',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.RunPython(encrypt_payloads, decrypt_payloads),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 6.0.2 on 2026-10-17 10:20
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0016_mpesacallbackinbox_payload_encrypted'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='mpesacallbackinbox',
+            name='payload',
+        ),
+    ]
@@ -3,25 +3,50 @@ import hashlib
 import hmac
 import json
 import secrets
+import uuid
+import zlib
 from datetime import timedelta
 from decimal import Decimal
+from functools import lru_cache
 
-from cryptography.fernet import Fernet, InvalidToken
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models
-from django.db.models import Max, Sum
+from django.db import models, transaction
+from django.db.models import Case, CharField, DecimalField, F, Max, Sum, Value, When
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
 User = get_user_model()
 
 
-def _fernet_instance() -> Fernet:
-	key = settings.FIELD_ENCRYPTION_KEY
-	if not key:
-		fallback = hashlib.sha256(settings.SECRET_KEY.encode("utf-8")).digest()
-		key = base64.urlsafe_b64encode(fallback).decode("utf-8")
-	return Fernet(key.encode("utf-8"))
+@lru_cache(maxsize=4)
+def _encryption_keys(primary: str, previous: tuple, secret_key: str, legacy_key: bool = True) -> tuple:
+	fallback = base64.urlsafe_b64encode(hashlib.sha256(secret_key.encode("utf-8")).digest()).decode("utf-8")
+	if not primary:
+		return (fallback, *previous)
+	if not legacy_key:
+		return tuple(dict.fromkeys((primary, *previous)))
+	# Data written before FIELD_ENCRYPTION_KEY was set stays readable (and rotatable) under the derived key.
+	return tuple(dict.fromkeys((primary, *previous, fallback)))
+
+
+def field_encryption_keys() -> tuple:
+	return _encryption_keys(
+		settings.FIELD_ENCRYPTION_KEY,
+		tuple(settings.FIELD_ENCRYPTION_PREVIOUS_KEYS),
+		settings.SECRET_KEY,
+		settings.FIELD_ENCRYPTION_LEGACY_KEY,
+	)
+
+
+@lru_cache(maxsize=4)
+def _build_fernet(keys: tuple) -> MultiFernet:
+	return MultiFernet([Fernet(key.encode("utf-8")) for key in keys])
+
+
+def _fernet_instance() -> MultiFernet:
+	return _build_fernet(field_encryption_keys())
 
 
 def hash_value(value: str) -> str:
@@ -42,6 +67,18 @@ def decrypt_value(value: str) -> str:
 		return ""
 
 
+def encrypt_payload(payload: dict) -> str:
+	compressed = zlib.compress(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+	return _fernet_instance().encrypt(compressed).decode("utf-8")
+
+
+def decrypt_payload(value: str) -> dict:
+	try:
+		return json.loads(zlib.decompress(_fernet_instance().decrypt(value.encode("utf-8"))))
+	except (InvalidToken, ValueError, TypeError, zlib.error):
+		return {}
+
+
 class Client(models.Model):
 	name = models.CharField(max_length=255)
 	phone_number = models.CharField(max_length=20, unique=True, db_index=True)
@@ -71,6 +108,44 @@ class Client(models.Model):
 		self.id_number_hash = hash_value(normalized)
 
 
+class ClientCreditFeatures(models.Model):
+	client = models.OneToOneField(Client, on_delete=models.CASCADE, primary_key=True, related_name="credit_features")
+	loans_total = models.PositiveIntegerField(default=0)
+	loans_paid = models.PositiveIntegerField(default=0)
+	paid_on_time = models.PositiveIntegerField(default=0)
+	total_due = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal("0.00"))
+	total_repaid = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal("0.00"))
+	updated_at = models.DateTimeField(auto_now=True)
+
+	def __str__(self) -> str:
+		return f"Credit features for client #{self.client_id}"
+
+	def as_tuple(self) -> tuple:
+		return (self.loans_total, self.loans_paid, self.paid_on_time, self.total_due, self.total_repaid)
+
+
+class LoanQuerySet(models.QuerySet):
+	def with_financials(self, today=None):
+		today = today or timezone.localdate()
+		money = DecimalField(max_digits=12, decimal_places=2)
+		return self.annotate(
+			paid_total=Coalesce(Sum("payments__amount"), Value(Decimal("0.00")), output_field=money),
+			last_paid_at=Max("payments__paid_at"),
+		).annotate(
+			balance_due=Case(
+				When(paid_total__gte=F("amount"), then=Value(Decimal("0.00"))),
+				default=F("amount") - F("paid_total"),
+				output_field=money,
+			),
+			computed_status=Case(
+				When(paid_total__gte=F("amount"), then=Value(Loan.Status.PAID)),
+				When(due_date__lt=today, then=Value(Loan.Status.OVERDUE)),
+				default=Value(Loan.Status.ACTIVE),
+				output_field=CharField(),
+			),
+		)
+
+
 class Loan(models.Model):
 	class Status(models.TextChoices):
 		ACTIVE = "ACTIVE", "Active"
@@ -108,6 +183,8 @@ class Loan(models.Model):
 	due_date = models.DateField(db_index=True)
 	created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
+	objects = LoanQuerySet.as_manager()
+
 	class Meta:
 		permissions = [
 			("can_approve_loan", "Can approve loan"),
@@ -124,6 +201,8 @@ class Loan(models.Model):
 
 	@property
 	def total_paid(self) -> Decimal:
+		if hasattr(self, "paid_total"):
+			return self.paid_total
 		if not self.pk:
 			return Decimal("0.00")
 		aggregate = self.payments.aggregate(total=Sum("amount"))
@@ -131,11 +210,15 @@ class Loan(models.Model):
 
 	@property
 	def balance(self) -> Decimal:
+		if hasattr(self, "balance_due"):
+			return self.balance_due
 		remaining = self.amount - self.total_paid
 		return remaining if remaining > Decimal("0.00") else Decimal("0.00")
 
 	@property
 	def latest_payment_at(self):
+		if hasattr(self, "last_paid_at"):
+			return self.last_paid_at
 		return self.payments.aggregate(last=Max("paid_at"))["last"]
 
 	def calculate_status(self) -> str:
@@ -166,8 +249,6 @@ class Payment(models.Model):
 	mpesa_receipt = models.CharField(max_length=50, unique=True, db_index=True)
 	phone = models.CharField(max_length=20, db_index=True)
 	paid_at = models.DateTimeField(default=timezone.now, db_index=True)
-	raw_payload = models.JSONField(default=dict, blank=True)
-	raw_payload_encrypted = models.TextField(blank=True, default="")
 
 	class Meta:
 		indexes = [
@@ -179,10 +260,153 @@ class Payment(models.Model):
 	def __str__(self) -> str:
 		return f"Payment {self.mpesa_receipt} - Loan #{self.loan_id}"
 
+	@property
+	def raw_payload(self) -> dict:
+		# The callback body lives in PaymentPayload so payment scans never read it; it is fetched on first access.
+		if not hasattr(self, "_raw_payload"):
+			encrypted = None
+			if self.pk:
+				encrypted = (
+					PaymentPayload.objects.filter(payment_id=self.pk).values_list("payload_encrypted", flat=True).first()
+				)
+			self._raw_payload = decrypt_payload(encrypted) if encrypted else {}
+		return self._raw_payload
+
+	@raw_payload.setter
+	def raw_payload(self, value: dict):
+		self._raw_payload = value
+		self._raw_payload_dirty = True
+
 	def save(self, *args, **kwargs):
-		if self.raw_payload:
-			self.raw_payload_encrypted = encrypt_value(json.dumps(self.raw_payload, separators=(",", ":")))
-		super().save(*args, **kwargs)
+		if not getattr(self, "_raw_payload_dirty", False):
+			super().save(*args, **kwargs)
+			return
+		adding = self._state.adding
+		with transaction.atomic(savepoint=False):
+			super().save(*args, **kwargs)
+			if adding and self._raw_payload:
+				PaymentPayload.objects.create(payment_id=self.pk, payload_encrypted=encrypt_payload(self._raw_payload))
+			elif self._raw_payload:
+				PaymentPayload.objects.update_or_create(
+					payment_id=self.pk,
+					defaults={"payload_encrypted": encrypt_payload(self._raw_payload)},
+				)
+			elif not adding:
+				PaymentPayload.objects.filter(payment_id=self.pk).delete()
+		self._raw_payload_dirty = False
+
+
+class PaymentPayload(models.Model):
+	payment = models.OneToOneField(Payment, on_delete=models.CASCADE, primary_key=True, related_name="payload_record")
+	payload_encrypted = models.TextField()
+
+	def __str__(self) -> str:
+		return f"Payload for payment #{self.payment_id}"
+
+
+class DailyCollectionRollup(models.Model):
+	date = models.DateField(primary_key=True)
+	total_amount = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal("0.00"))
+	payments_count = models.PositiveIntegerField(default=0)
+	loans_count = models.PositiveIntegerField(default=0)
+	updated_at = models.DateTimeField(auto_now=True)
+
+	def __str__(self) -> str:
+		return f"Collections {self.date}: {self.total_amount} ({self.payments_count} payments)"
+
+	def as_tuple(self) -> tuple:
+		return (self.total_amount, self.payments_count, self.loans_count)
+
+
+class MpesaCallbackInbox(models.Model):
+	class Status(models.TextChoices):
+		PENDING = "PENDING", "Pending"
+		APPLIED = "APPLIED", "Applied"
+		IGNORED = "IGNORED", "Ignored"
+		DUPLICATE = "DUPLICATE", "Duplicate"
+		REJECTED = "REJECTED", "Rejected"
+		FAILED = "FAILED", "Failed"
+
+	loan_id = models.PositiveBigIntegerField()
+	payload_encrypted = models.TextField(blank=True, default="")
+	checkout_request_id = models.CharField(max_length=100, blank=True, default="")
+	status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+	attempts = models.PositiveIntegerField(default=0)
+	available_at = models.DateTimeField(default=timezone.now)
+	last_error = models.TextField(blank=True, default="")
+	received_at = models.DateTimeField(auto_now_add=True)
+	processed_at = models.DateTimeField(null=True, blank=True)
+
+	class Meta:
+		indexes = [
+			models.Index(fields=["status", "id"]),
+			models.Index(fields=["checkout_request_id"]),
+		]
+
+	def __str__(self) -> str:
+		return f"Callback #{self.pk} - Loan #{self.loan_id} ({self.status})"
+
+	@property
+	def payload(self) -> dict:
+		# Stored compressed and encrypted like PaymentPayload; decrypted once per instance.
+		if not hasattr(self, "_payload"):
+			self._payload = decrypt_payload(self.payload_encrypted) if self.payload_encrypted else {}
+		return self._payload
+
+	@payload.setter
+	def payload(self, value: dict):
+		self._payload = value or {}
+		self.payload_encrypted = encrypt_payload(self._payload) if self._payload else ""
+
+
+class OutboxMessage(models.Model):
+	class Status(models.TextChoices):
+		PENDING = "PENDING", "Pending"
+		DISPATCHED = "DISPATCHED", "Dispatched"
+		FAILED = "FAILED", "Failed"
+
+	task = models.CharField(max_length=200)
+	args = models.JSONField(default=list, blank=True)
+	key = models.CharField(max_length=100, blank=True, default="")
+	status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+	attempts = models.PositiveIntegerField(default=0)
+	available_at = models.DateTimeField(default=timezone.now)
+	last_error = models.TextField(blank=True, default="")
+	created_at = models.DateTimeField(auto_now_add=True)
+	dispatched_at = models.DateTimeField(null=True, blank=True)
+
+	class Meta:
+		indexes = [
+			models.Index(fields=["status", "available_at"]),
+			models.Index(fields=["key", "status"]),
+		]
+
+	def __str__(self) -> str:
+		return f"Outbox #{self.pk} - {self.task} ({self.status})"
+
+
+class StkPushRequest(models.Model):
+	class State(models.TextChoices):
+		QUEUED = "QUEUED", "Queued"
+		SENDING = "SENDING", "Sending"
+		SENT = "SENT", "Sent"
+		COMPLETED = "COMPLETED", "Completed"
+		FAILED = "FAILED", "Failed"
+
+	public_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+	loan = models.ForeignKey(Loan, on_delete=models.CASCADE, related_name="stk_push_requests")
+	phone = models.CharField(max_length=20)
+	amount = models.DecimalField(max_digits=12, decimal_places=2)
+	state = models.CharField(max_length=10, choices=State.choices, default=State.QUEUED)
+	checkout_request_id = models.CharField(max_length=100, unique=True, null=True, blank=True)
+	merchant_request_id = models.CharField(max_length=100, blank=True, default="")
+	result_code = models.IntegerField(null=True, blank=True)
+	result_desc = models.CharField(max_length=255, blank=True, default="")
+	created_at = models.DateTimeField(auto_now_add=True)
+	updated_at = models.DateTimeField(auto_now=True)
+
+	def __str__(self) -> str:
+		return f"STK push {self.public_id} - Loan #{self.loan_id} ({self.state})"
 
 
 class LoanReminderLog(models.Model):
@@ -193,6 +417,7 @@ class LoanReminderLog(models.Model):
 	loan = models.ForeignKey(Loan, on_delete=models.CASCADE, related_name="reminder_logs")
 	reminder_type = models.CharField(max_length=12, choices=ReminderType.choices)
 	sent_at = models.DateTimeField(auto_now_add=True)
+	claim_id = models.UUIDField(null=True, blank=True, editable=False, db_index=True)
 
 	class Meta:
 		constraints = [
@@ -269,6 +494,27 @@ class ClientAccessToken(models.Model):
 		return self.revoked_at is None and self.expires_at > timezone.now()
 
 
+class ReminderRun(models.Model):
+	reminder_type = models.CharField(max_length=12, choices=LoanReminderLog.ReminderType.choices)
+	run_date = models.DateField()
+	total = models.PositiveIntegerField(default=0)
+	pace = models.FloatField()
+	sent = models.PositiveIntegerField(default=0)
+	failed = models.PositiveIntegerField(default=0)
+	last_loan_id = models.PositiveBigIntegerField(default=0)
+	paced_at = models.DateTimeField()
+	started_at = models.DateTimeField(auto_now_add=True)
+	finished_at = models.DateTimeField(null=True, blank=True)
+
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=["run_date", "reminder_type"], name="unique_reminder_run_per_day"),
+		]
+
+	def __str__(self) -> str:
+		return f"{self.reminder_type} reminders {self.run_date}: {self.sent}/{self.total}"
+
+
 class NotificationLog(models.Model):
 	class Channel(models.TextChoices):
 		WHATSAPP = "WHATSAPP", "WhatsApp"
@@ -0,0 +1,36 @@
+import base64
+import json
+
+from rest_framework.exceptions import ValidationError
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(*values) -> str:
+    raw = json.dumps([str(value) for value in values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int, param: str = "cursor") -> list:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (ValueError, UnicodeError):
+        raise ValidationError({param: "Invalid cursor."})
+    if not isinstance(values, list) or len(values) != size or not all(isinstance(value, str) for value in values):
+        raise ValidationError({param: "Invalid cursor."})
+    return values
+
+
+def page_size_from(request, default: int = DEFAULT_PAGE_SIZE, maximum: int = MAX_PAGE_SIZE) -> int:
+    raw = request.query_params.get("page_size")
+    if raw is None:
+        return default
+    try:
+        size = int(raw)
+    except ValueError:
+        raise ValidationError({"page_size": "Must be an integer."})
+    if size < 1:
+        raise ValidationError({"page_size": "Must be at least 1."})
+    return min(size, maximum)
@@ -1,5 +1,7 @@
 from rest_framework.permissions import BasePermission
 
+from .models import Client
+
 
 class IsLoanOfficer(BasePermission):
     def has_permission(self, request, view):
@@ -22,4 +24,4 @@ class IsSystemAutomation(BasePermission):
 class IsClientAuthenticated(BasePermission):
     def has_permission(self, request, view):
         user = getattr(request, "user", None)
-        return bool(user and hasattr(user, "phone_number"))
+        return isinstance(user, Client)
@@ -2,7 +2,7 @@ from decimal import Decimal
 
 from rest_framework import serializers
 
-from loans.models import Loan, Payment
+from loans.models import Loan, Payment, StkPushRequest
 
 
 class OTPRequestSerializer(serializers.Serializer):
@@ -23,13 +23,20 @@ class ClientLoanSummarySerializer(serializers.ModelSerializer):
 
 
 class PaymentHistorySerializer(serializers.ModelSerializer):
-    loan_id = serializers.IntegerField(source="loan.id", read_only=True)
+    loan_id = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Payment
         fields = ["id", "loan_id", "amount", "mpesa_receipt", "phone", "paid_at"]
 
 
+class PaymentHistoryPageSerializer(serializers.Serializer):
+    results = PaymentHistorySerializer(many=True)
+    next_cursor = serializers.CharField(allow_null=True)
+    sync_token = serializers.CharField(allow_null=True)
+    has_more = serializers.BooleanField()
+
+
 class LoanApprovalSerializer(serializers.Serializer):
     action = serializers.ChoiceField(choices=["APPROVE", "REJECT"])
 
@@ -72,6 +79,7 @@ class OutstandingLoansSerializer(serializers.Serializer):
 class OverdueLoansSerializer(serializers.Serializer):
     overdue_count = serializers.IntegerField()
     results = ClientLoanSummarySerializer(many=True)
+    next_cursor = serializers.CharField(allow_null=True)
 
 
 class MonthlyPerformanceSerializer(serializers.Serializer):
@@ -98,6 +106,15 @@ class STKPushSerializer(serializers.Serializer):
         return attrs
 
 
+class StkPushRequestSerializer(serializers.ModelSerializer):
+    request_id = serializers.UUIDField(source="public_id", read_only=True)
+    loan_id = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = StkPushRequest
+        fields = ["request_id", "loan_id", "amount", "state", "result_code", "result_desc", "created_at", "updated_at"]
+
+
 class ClientLoanApplicationSerializer(serializers.Serializer):
     amount = serializers.DecimalField(max_digits=12, decimal_places=2)
     due_date = serializers.DateField()
@@ -0,0 +1,122 @@
+import atexit
+import logging
+import os
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from loans.models import AuditLog
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+
+
+class AuditBuffer:
+    def __init__(self, max_size: int, batch_size: int, flush_interval: float, overflow_policy: str = DROP_OLDEST):
+        if overflow_policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"Unknown audit overflow policy: {overflow_policy}")
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.dropped = 0
+        self.flushed = 0
+        self.failed = 0
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._entries = deque()
+        self._thread = None
+
+    def _ensure_worker(self):
+        if self._pid != os.getpid():
+            # Forked (e.g. gunicorn --preload): the parent's lock, queue and thread are not ours.
+            self._reset()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="audit-log-flusher", daemon=True)
+            self._thread.start()
+
+    def add(self, entry: AuditLog) -> bool:
+        self._ensure_worker()
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                self.dropped += 1
+                if self.overflow_policy == DROP_NEWEST:
+                    return False
+                self._entries.popleft()
+            self._entries.append(entry)
+            pending = len(self._entries)
+        if pending >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def _take_batch(self):
+        with self._lock:
+            count = min(self.batch_size, len(self._entries))
+            return [self._entries.popleft() for _ in range(count)]
+
+    def flush(self) -> int:
+        written = 0
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return written
+            try:
+                AuditLog.objects.bulk_create(batch)
+            except Exception:
+                logger.exception("Failed to flush %s audit log entries", len(batch))
+                with self._lock:
+                    self.failed += len(batch)
+                continue
+            written += len(batch)
+            with self._lock:
+                self.flushed += len(batch)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            close_old_connections()
+            self.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending": len(self._entries),
+                "flushed": self.flushed,
+                "dropped": self.dropped,
+                "failed": self.failed,
+            }
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_audit_buffer() -> AuditBuffer:
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = AuditBuffer(
+                    max_size=settings.AUDIT_LOG_BUFFER_SIZE,
+                    batch_size=settings.AUDIT_LOG_BATCH_SIZE,
+                    flush_interval=settings.AUDIT_LOG_FLUSH_SECONDS,
+                    overflow_policy=settings.AUDIT_LOG_OVERFLOW_POLICY,
+                )
+                atexit.register(_buffer.flush)
+    return _buffer
+
+
+def record_audit_entry(entry: AuditLog):
+    if settings.AUDIT_LOG_MODE == "sync":
+        entry.save()
+        return
+    get_audit_buffer().add(entry)
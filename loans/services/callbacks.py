@@ -0,0 +1,318 @@
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from loans.models import Loan, MpesaCallbackInbox, Payment, StkPushRequest, SuspiciousActivityLog
+
+logger = logging.getLogger(__name__)
+
+INBOX_BATCH_SIZE = 200
+PURGE_BATCH_SIZE = 1000
+MAX_RETRY_SECONDS = 300
+SETTLED_STATUSES = (
+    MpesaCallbackInbox.Status.APPLIED,
+    MpesaCallbackInbox.Status.DUPLICATE,
+    MpesaCallbackInbox.Status.IGNORED,
+    MpesaCallbackInbox.Status.REJECTED,
+)
+
+
+def _stk_callback(payload) -> dict:
+    try:
+        stk_callback = payload["Body"]["stkCallback"]
+    except (KeyError, TypeError):
+        return {}
+    return stk_callback if isinstance(stk_callback, dict) else {}
+
+
+def _checkout_request_id(payload) -> str:
+    checkout_request_id = _stk_callback(payload).get("CheckoutRequestID")
+    return checkout_request_id[:100] if isinstance(checkout_request_id, str) else ""
+
+
+def record_callback(loan_id: int, payload: dict) -> MpesaCallbackInbox:
+    return MpesaCallbackInbox.objects.create(
+        loan_id=loan_id,
+        payload=payload,
+        checkout_request_id=_checkout_request_id(payload),
+    )
+
+
+def record_stk_result(payload) -> int:
+    stk_callback = _stk_callback(payload)
+    checkout_request_id = stk_callback.get("CheckoutRequestID")
+    if not checkout_request_id or not isinstance(checkout_request_id, str):
+        return 0
+    result_code = stk_callback.get("ResultCode")
+    state = StkPushRequest.State.COMPLETED if result_code == 0 else StkPushRequest.State.FAILED
+    # Only a SENT push takes a result, so a repeated callback cannot flip a finished one.
+    return StkPushRequest.objects.filter(
+        checkout_request_id=checkout_request_id,
+        state=StkPushRequest.State.SENT,
+    ).update(
+        state=state,
+        result_code=result_code if isinstance(result_code, int) else None,
+        result_desc=str(stk_callback.get("ResultDesc") or "")[:255],
+        updated_at=timezone.now(),
+    )
+
+
+def _apply_stk_results(entries) -> int:
+    # Results are matched here rather than in the callback view, which keeps the ack to its single INSERT.
+    by_checkout_id = {}
+    for entry in entries:
+        if entry.checkout_request_id:
+            by_checkout_id.setdefault(entry.checkout_request_id, entry)
+    if not by_checkout_id:
+        return 0
+    sent = StkPushRequest.objects.filter(
+        checkout_request_id__in=by_checkout_id,
+        state=StkPushRequest.State.SENT,
+    ).values_list("checkout_request_id", flat=True)
+    return sum(record_stk_result(by_checkout_id[checkout_request_id].payload) for checkout_request_id in sent)
+
+
+def apply_early_stk_result(loan_id: int, checkout_request_id: str) -> int:
+    """Apply a Daraja result that the inbox drain saw before the push was marked SENT.
+
+    The callback view commits the payload to the inbox before the drain matches it, and the task marks the
+    push SENT before calling this, so whichever side runs second sees the other's write.
+    """
+    entry = (
+        MpesaCallbackInbox.objects.filter(checkout_request_id=checkout_request_id, loan_id=loan_id)
+        .order_by("id")
+        .only("payload_encrypted")
+        .first()
+    )
+    return record_stk_result(entry.payload) if entry else 0
+
+
+def fail_stale_stk_pushes(timeout_seconds: int = None, now=None) -> int:
+    """Fail pushes left in SENDING longer than STK_PUSH_SENDING_TIMEOUT_SECONDS by a worker that died mid-send.
+
+    Whether Daraja got such a push is unknown, so the status endpoint stops reporting it in flight. A
+    payment the customer still completes arrives through the callback inbox like any other.
+    """
+    timeout_seconds = settings.STK_PUSH_SENDING_TIMEOUT_SECONDS if timeout_seconds is None else timeout_seconds
+    now = now or timezone.now()
+    return StkPushRequest.objects.filter(
+        state=StkPushRequest.State.SENDING,
+        updated_at__lt=now - timedelta(seconds=timeout_seconds),
+    ).update(
+        state=StkPushRequest.State.FAILED,
+        result_desc="Send did not complete; outcome unknown",
+        updated_at=now,
+    )
+
+
+def _parse_callback(entry: MpesaCallbackInbox):
+    # The payload is whatever the caller posted; any shape other than Daraja's is ignored rather than raised.
+    stk_callback = _stk_callback(entry.payload)
+    if stk_callback.get("ResultCode") != 0:
+        return None
+    try:
+        metadata_items = stk_callback["CallbackMetadata"]["Item"]
+        metadata = {item["Name"]: item.get("Value") for item in metadata_items if item.get("Name")}
+    except (AttributeError, KeyError, TypeError):
+        return None
+    if not isinstance(metadata.get("MpesaReceiptNumber"), str) or metadata.get("Amount") is None:
+        return None
+    return metadata
+
+
+def _parse_amount(value):
+    try:
+        amount = Decimal(str(value))
+    except (InvalidOperation, ValueError):
+        return None
+    return amount if amount.is_finite() else None
+
+
+def _claim_batch(batch_size: int, now):
+    pending = MpesaCallbackInbox.objects.filter(
+        status=MpesaCallbackInbox.Status.PENDING,
+        available_at__lte=now,
+    ).order_by("id")
+    if connection.features.has_select_for_update_skip_locked:
+        pending = pending.select_for_update(skip_locked=True)
+    return list(pending[:batch_size])
+
+
+def _apply_loan_payments(loan: Loan, items, outcomes, suspicious):
+    balance = loan.balance
+    with transaction.atomic():
+        for entry, metadata, amount in items:
+            receipt = metadata["MpesaReceiptNumber"]
+            if amount > balance:
+                suspicious.append(
+                    SuspiciousActivityLog(
+                        category="OVERPAYMENT_ATTEMPT",
+                        reference=f"loan:{loan.id}",
+                        severity="HIGH",
+                        details={"amount": str(amount), "balance": str(balance), "receipt": receipt},
+                    )
+                )
+                outcomes[entry.id] = MpesaCallbackInbox.Status.REJECTED
+                continue
+            try:
+                with transaction.atomic():
+                    # Pass only the id so the payment signals load the loan fresh instead of its batch annotations.
+                    Payment.objects.create(
+                        loan_id=loan.id,
+                        amount=amount,
+                        mpesa_receipt=receipt,
+                        phone=str(metadata.get("PhoneNumber") or loan.client.phone_number),
+                        raw_payload=entry.payload,
+                    )
+            except IntegrityError:
+                outcomes[entry.id] = MpesaCallbackInbox.Status.DUPLICATE
+                continue
+            balance -= amount
+            outcomes[entry.id] = MpesaCallbackInbox.Status.APPLIED
+
+
+def _process_batch(entries, now) -> dict:
+    _apply_stk_results(entries)
+    outcomes = {}
+    errors = {}
+    suspicious = []
+    parsed = []
+    for entry in entries:
+        try:
+            metadata = _parse_callback(entry)
+        except Exception:
+            logger.exception("Unreadable M-Pesa callback #%s", entry.id)
+            metadata = None
+        if metadata is None:
+            outcomes[entry.id] = MpesaCallbackInbox.Status.IGNORED
+            continue
+        parsed.append((entry, metadata))
+
+    loans = Loan.objects.select_related("client").with_financials().in_bulk({entry.loan_id for entry, _ in parsed})
+    receipts = {metadata["MpesaReceiptNumber"] for _, metadata in parsed}
+    seen_receipts = set(Payment.objects.filter(mpesa_receipt__in=receipts).values_list("mpesa_receipt", flat=True))
+    duplicate_receipts = {}
+
+    by_loan = defaultdict(list)
+    for entry, metadata in parsed:
+        loan = loans.get(entry.loan_id)
+        receipt = metadata["MpesaReceiptNumber"]
+        if loan is None:
+            outcomes[entry.id] = MpesaCallbackInbox.Status.IGNORED
+            continue
+        amount = _parse_amount(metadata["Amount"])
+        if amount is None:
+            suspicious.append(
+                SuspiciousActivityLog(
+                    category="INVALID_AMOUNT",
+                    reference=f"loan:{loan.id}",
+                    severity="HIGH",
+                    details={"amount": str(metadata["Amount"])[:50], "receipt": receipt},
+                )
+            )
+            outcomes[entry.id] = MpesaCallbackInbox.Status.REJECTED
+            continue
+        if amount <= 0:
+            suspicious.append(
+                SuspiciousActivityLog(
+                    category="NON_POSITIVE_AMOUNT",
+                    reference=f"loan:{loan.id}",
+                    severity="HIGH",
+                    details={"amount": str(amount), "receipt": receipt},
+                )
+            )
+            outcomes[entry.id] = MpesaCallbackInbox.Status.REJECTED
+            continue
+        if receipt in seen_receipts:
+            duplicate_receipts.setdefault(receipt, loan.id)
+            outcomes[entry.id] = MpesaCallbackInbox.Status.DUPLICATE
+            continue
+        seen_receipts.add(receipt)
+        by_loan[loan.id].append((entry, metadata, amount))
+
+    for loan_id, items in by_loan.items():
+        try:
+            _apply_loan_payments(loans[loan_id], items, outcomes, suspicious)
+        except Exception as exc:
+            logger.exception("Failed to apply M-Pesa callbacks for loan %s", loan_id)
+            for entry, _metadata, _amount in items:
+                outcomes[entry.id] = MpesaCallbackInbox.Status.FAILED
+                errors[entry.id] = repr(exc)
+
+    if duplicate_receipts:
+        logged = set(
+            SuspiciousActivityLog.objects.filter(
+                category="DUPLICATE_RECEIPT",
+                reference__in=duplicate_receipts,
+            ).values_list("reference", flat=True)
+        )
+        suspicious.extend(
+            SuspiciousActivityLog(
+                category="DUPLICATE_RECEIPT",
+                reference=receipt,
+                severity="MEDIUM",
+                details={"loan_id": loan_id},
+            )
+            for receipt, loan_id in duplicate_receipts.items()
+            if receipt not in logged
+        )
+    SuspiciousActivityLog.objects.bulk_create(suspicious)
+
+    return _settle(entries, outcomes, errors, now)
+
+
+def _settle(entries, outcomes: dict, errors: dict, now) -> dict:
+    # A failed entry is a paid customer's payment, so it goes back to PENDING with backoff like an outbox
+    # message and only becomes FAILED after MPESA_INBOX_MAX_ATTEMPTS.
+    counts = defaultdict(int)
+    for entry in entries:
+        outcome = outcomes.get(entry.id, MpesaCallbackInbox.Status.FAILED)
+        counts[outcome] += 1
+        entry.processed_at = now
+        if outcome != MpesaCallbackInbox.Status.FAILED:
+            entry.status = outcome
+            entry.last_error = ""
+            continue
+        entry.attempts += 1
+        entry.last_error = errors.get(entry.id, "Not processed")[:1000]
+        if entry.attempts >= settings.MPESA_INBOX_MAX_ATTEMPTS:
+            entry.status = MpesaCallbackInbox.Status.FAILED
+        else:
+            entry.status = MpesaCallbackInbox.Status.PENDING
+            entry.available_at = now + timedelta(seconds=min(2**entry.attempts, MAX_RETRY_SECONDS))
+    MpesaCallbackInbox.objects.bulk_update(entries, ["status", "attempts", "available_at", "last_error", "processed_at"])
+    return counts
+
+
+def process_callback_inbox(batch_size: int = INBOX_BATCH_SIZE, max_batches: int = 50, now=None) -> dict:
+    totals = defaultdict(int)
+    for _ in range(max_batches):
+        claimed_at = now or timezone.now()
+        with transaction.atomic():
+            entries = _claim_batch(batch_size, claimed_at)
+            if not entries:
+                break
+            for outcome, count in _process_batch(entries, claimed_at).items():
+                totals[outcome] += count
+        if len(entries) < batch_size:
+            break
+    return dict(totals)
+
+
+def purge_callback_inbox(retention_days: int = None, batch_size: int = PURGE_BATCH_SIZE, now=None) -> int:
+    """Delete settled callbacks processed more than MPESA_INBOX_RETENTION_DAYS ago; FAILED rows stay for the admin."""
+    retention_days = settings.MPESA_INBOX_RETENTION_DAYS if retention_days is None else retention_days
+    cutoff = (now or timezone.now()) - timedelta(days=retention_days)
+    expired = MpesaCallbackInbox.objects.filter(status__in=SETTLED_STATUSES, processed_at__lt=cutoff)
+    purged = 0
+    # Bounded batches keep each DELETE short next to the drain's claims.
+    while True:
+        ids = list(expired.order_by("id").values_list("id", flat=True)[:batch_size])
+        if not ids:
+            return purged
+        purged += MpesaCallbackInbox.objects.filter(id__in=ids).delete()[0]
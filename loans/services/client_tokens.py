@@ -0,0 +1,123 @@
+import atexit
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from loans.models import Client, ClientAccessToken
+
+logger = logging.getLogger(__name__)
+
+TOKEN_CACHE_ALIAS = "tokens"
+
+
+def _token_cache():
+    return caches[TOKEN_CACHE_ALIAS]
+
+
+def _token_key(token_hash: str) -> str:
+    return f"client-token:{token_hash}"
+
+
+def get_cached_token(token_hash: str):
+    entry = _token_cache().get(_token_key(token_hash))
+    if entry is None:
+        return None
+    token_id, client_id, expires_at, revoked = entry
+    if revoked:
+        return None
+    token = ClientAccessToken(id=token_id, client_id=client_id, token_hash=token_hash, expires_at=expires_at)
+    # Only the auth fields are cached, so the client comes back deferred: its profile is read from the
+    # database when a view touches it, never from the cache directory.
+    token.client = Client.from_db(ClientAccessToken.objects.db, ["id"], [client_id])
+    return token
+
+
+def cache_token(token: ClientAccessToken):
+    ttl = min(settings.CLIENT_TOKEN_CACHE_SECONDS, int((token.expires_at - timezone.now()).total_seconds()))
+    if ttl <= 0:
+        return
+    entry = (token.id, token.client_id, token.expires_at, token.revoked_at is not None)
+    _token_cache().set(_token_key(token.token_hash), entry, timeout=ttl)
+
+
+def forget_token(token_hash: str):
+    transaction.on_commit(lambda: _token_cache().delete(_token_key(token_hash)))
+
+
+class LastUsedTracker:
+    def __init__(self, interval: float = None):
+        # None follows CLIENT_TOKEN_TOUCH_SECONDS; 0 writes every touch straight through.
+        self.interval = interval
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_flush = None
+        self._thread = None
+
+    def _interval(self) -> float:
+        return settings.CLIENT_TOKEN_TOUCH_SECONDS if self.interval is None else self.interval
+
+    def _ensure_worker(self):
+        # Deferred touches would otherwise wait for the next request, which an idle worker never gets.
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="token-last-used-flusher", daemon=True)
+            self._thread.start()
+
+    def touch(self, token_id: int, moment):
+        if self._pid != os.getpid():
+            self._reset()
+        with self._lock:
+            self._pending[token_id] = moment
+            now = time.monotonic()
+            if self._last_flush is not None and now - self._last_flush < self._interval():
+                self._ensure_worker()
+                return
+            batch, self._pending, self._last_flush = self._pending, {}, now
+        self._write(batch)
+
+    def flush(self) -> int:
+        with self._lock:
+            batch, self._pending, self._last_flush = self._pending, {}, time.monotonic()
+        return self._write(batch)
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval())
+            close_old_connections()
+            self.flush()
+
+    def _write(self, batch: dict) -> int:
+        if not batch:
+            return 0
+        try:
+            ClientAccessToken.objects.bulk_update(
+                [ClientAccessToken(id=token_id, last_used_at=moment) for token_id, moment in batch.items()],
+                ["last_used_at"],
+            )
+        except Exception:
+            logger.exception("Failed to record last_used_at for %s client tokens", len(batch))
+            return 0
+        return len(batch)
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_last_used_tracker() -> LastUsedTracker:
+    global _tracker
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                _tracker = LastUsedTracker()
+                atexit.register(_tracker.flush)
+    return _tracker
@@ -0,0 +1,143 @@
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, F, Min, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from loans.models import DailyCollectionRollup, Payment
+
+ROLLUP_CHUNK_DAYS = 31
+EMPTY_ROLLUP = (Decimal("0.00"), 0, 0)
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def _live_rollups(start_day, end_day) -> dict:
+    payments = Payment.objects.filter(paid_at__gte=_day_start(start_day), paid_at__lt=_day_start(end_day + timedelta(days=1)))
+    return {
+        row["day"]: (row["total"], row["payments"], row["loans"])
+        for row in payments.order_by()
+        .annotate(day=TruncDate("paid_at"))
+        .values("day")
+        .annotate(total=Sum("amount"), payments=Count("id"), loans=Count("loan_id", distinct=True))
+    }
+
+
+def rebuild_collection_rollups(start_day, end_day) -> int:
+    with transaction.atomic():
+        # Lock the stored days first so an incremental update cannot land between the count and the write.
+        stale = set(
+            DailyCollectionRollup.objects.select_for_update()
+            .filter(date__gte=start_day, date__lte=end_day)
+            .values_list("date", flat=True)
+        )
+        live = _live_rollups(start_day, end_day)
+        DailyCollectionRollup.objects.filter(date__in=stale - set(live)).delete()
+        DailyCollectionRollup.objects.bulk_create(
+            [
+                DailyCollectionRollup(
+                    date=day,
+                    total_amount=total,
+                    payments_count=payments,
+                    loans_count=loans,
+                    updated_at=timezone.now(),
+                )
+                for day, (total, payments, loans) in live.items()
+            ],
+            update_conflicts=True,
+            unique_fields=["date"],
+            update_fields=["total_amount", "payments_count", "loans_count", "updated_at"],
+        )
+    return len(live)
+
+
+def _payment_date_span():
+    first = Payment.objects.aggregate(first=Min("paid_at"))["first"]
+    if first is None:
+        return None
+    return timezone.localdate(first), timezone.localdate()
+
+
+def rebuild_all_collection_rollups(chunk_days: int = ROLLUP_CHUNK_DAYS, since=None) -> int:
+    span = _payment_date_span()
+    if span is None:
+        DailyCollectionRollup.objects.all().delete()
+        return 0
+    start_day, last_day = span
+    start_day = max(start_day, since) if since else start_day
+    if not since:
+        DailyCollectionRollup.objects.filter(date__lt=start_day).delete()
+    rebuilt = 0
+    while start_day <= last_day:
+        end_day = min(start_day + timedelta(days=chunk_days - 1), last_day)
+        rebuilt += rebuild_collection_rollups(start_day, end_day)
+        start_day = end_day + timedelta(days=1)
+    return rebuilt
+
+
+def verify_collection_rollups(chunk_days: int = ROLLUP_CHUNK_DAYS, since=None):
+    span = _payment_date_span()
+    if span is None:
+        return
+    start_day, last_day = span
+    start_day = max(start_day, since) if since else start_day
+    while start_day <= last_day:
+        end_day = min(start_day + timedelta(days=chunk_days - 1), last_day)
+        live = _live_rollups(start_day, end_day)
+        stored = {
+            row.date: row.as_tuple()
+            for row in DailyCollectionRollup.objects.filter(date__gte=start_day, date__lte=end_day)
+        }
+        for day in sorted(set(live) | set(stored)):
+            expected = live.get(day, EMPTY_ROLLUP)
+            if stored.get(day, EMPTY_ROLLUP) != expected:
+                yield day, stored.get(day), expected
+        start_day = end_day + timedelta(days=1)
+
+
+def record_payment_collected(payment: Payment):
+    day = timezone.localdate(payment.paid_at)
+    with transaction.atomic():
+        # The locked day row serialises payments of the same day: concurrent first payments meet on the
+        # primary key inside get_or_create, and the same-loan check below sees every earlier committed payment.
+        _rollup, created = DailyCollectionRollup.objects.select_for_update().get_or_create(date=day)
+        if created:
+            # First payment of the day: count it from the live table, which already includes this payment.
+            total, payments, loans = _live_rollups(day, day).get(day, EMPTY_ROLLUP)
+            DailyCollectionRollup.objects.filter(date=day).update(
+                total_amount=total,
+                payments_count=payments,
+                loans_count=loans,
+                updated_at=timezone.now(),
+            )
+            return
+        same_loan_same_day = (
+            Payment.objects.filter(loan_id=payment.loan_id, paid_at__gte=_day_start(day), paid_at__lt=_day_start(day + timedelta(days=1)))
+            .exclude(pk=payment.pk)
+            .exists()
+        )
+        DailyCollectionRollup.objects.filter(date=day).update(
+            total_amount=F("total_amount") + payment.amount,
+            payments_count=F("payments_count") + 1,
+            loans_count=F("loans_count") + int(not same_loan_same_day),
+            updated_at=timezone.now(),
+        )
+
+
+def refresh_collection_days(*moments):
+    # Deletes and edits recount the affected days: during a cascade delete every payment of the loan is
+    # already gone when post_delete fires, so "other payments of this loan today" cannot be trusted.
+    for day in {timezone.localdate(moment) for moment in moments if moment}:
+        rebuild_collection_rollups(day, day)
+
+
+def collections_between(start_day, end_day) -> dict:
+    summary = DailyCollectionRollup.objects.filter(date__gte=start_day, date__lte=end_day).aggregate(
+        total=Sum("total_amount"),
+        payments_count=Sum("payments_count"),
+    )
+    return {"total": summary["total"] or Decimal("0.00"), "payments_count": summary["payments_count"] or 0}
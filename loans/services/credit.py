@@ -1,27 +1,25 @@
+from collections import defaultdict
 from decimal import Decimal
 
-from django.db.models import F, Max, Sum
+from django.db import transaction
+from django.db.models import Count, DateTimeField, F, Max, OuterRef, Q, Subquery, Sum
+from django.utils import timezone
 
-from loans.models import Client, Loan
+from loans.models import Client, ClientCreditFeatures, Loan, Payment
+from loans.services.report_cache import invalidate_client_summaries
 
+BASE_LOAN_LIMIT = Decimal("5000.00")
+CREDIT_CHUNK_SIZE = 1000
+EMPTY_FEATURES = (0, 0, 0, Decimal("0.00"), Decimal("0.00"))
+FEATURE_FIELDS = ("loans_total", "loans_paid", "paid_on_time", "total_due", "total_repaid")
 
-def recompute_client_credit(client: Client) -> Client:
-    loans = client.loans.all()
-    total_loans = loans.count()
-    if total_loans == 0:
-        client.credit_score = 0
-        client.max_loan_limit = Decimal("5000.00")
-        client.save(update_fields=["credit_score", "max_loan_limit", "updated_at"])
-        return client
-
-    paid_count = loans.filter(status=Loan.Status.PAID).count()
 
-    paid_loans_with_last_payment = loans.filter(status=Loan.Status.PAID).annotate(last_paid_at=Max("payments__paid_at"))
-    on_time_paid = paid_loans_with_last_payment.filter(last_paid_at__date__lte=F("due_date")).count()
+def score_from_features(total_loans, paid_count, on_time_paid, total_due, total_paid):
+    if total_loans == 0:
+        return 0, BASE_LOAN_LIMIT
 
-    aggregate = loans.aggregate(total_due=Sum("amount"), total_paid=Sum("payments__amount"))
-    total_due = aggregate["total_due"] or Decimal("0.00")
-    total_paid = aggregate["total_paid"] or Decimal("0.00")
+    total_due = total_due or Decimal("0.00")
+    total_paid = total_paid or Decimal("0.00")
 
     completion_rate = paid_count / total_loans
     timeliness_rate = (on_time_paid / paid_count) if paid_count else 0
@@ -30,11 +28,265 @@ def recompute_client_credit(client: Client) -> Client:
     score = int((completion_rate * 40) + (timeliness_rate * 40) + (repayment_ratio * 20))
     score = max(0, min(100, score))
 
-    base_limit = Decimal("5000.00")
     multiplier = Decimal("1.0") + (Decimal(score) / Decimal("100"))
-    max_limit = (base_limit * multiplier).quantize(Decimal("0.01"))
+    max_limit = (BASE_LOAN_LIMIT * multiplier).quantize(Decimal("0.01"))
+    return score, max_limit
+
+
+def _client_features(lookup: str, value) -> dict:
+    loans = Loan.objects.filter(**{f"client__id__{lookup}": value}).order_by()
 
-    client.credit_score = score
-    client.max_loan_limit = max_limit
+    # total_due is summed across the loan/payment join, exactly as the original per-client aggregate did:
+    # a loan counts once per payment (at least once). Scores and limits depend on it, so it stays as is.
+    features = {
+        row["client_id"]: [
+            row["total_loans"],
+            row["paid_count"],
+            0,
+            row["total_due"] or Decimal("0.00"),
+            row["total_paid"] or Decimal("0.00"),
+        ]
+        for row in loans.values("client_id").annotate(
+            total_loans=Count("id", distinct=True),
+            paid_count=Count("id", distinct=True, filter=Q(status=Loan.Status.PAID)),
+            total_due=Sum("amount"),
+            total_paid=Sum("payments__amount"),
+        )
+    }
+
+    last_payment = Payment.objects.filter(loan=OuterRef("pk")).order_by("-paid_at").values("paid_at")[:1]
+    on_time = (
+        loans.filter(status=Loan.Status.PAID)
+        .annotate(last_paid_at=Subquery(last_payment, output_field=DateTimeField()))
+        .filter(last_paid_at__date__lte=F("due_date"))
+        .values("client_id")
+        .annotate(on_time_paid=Count("id"))
+    )
+    for row in on_time:
+        features[row["client_id"]][2] = row["on_time_paid"]
+    return features
+
+
+def recompute_client_credit(client: Client) -> Client:
+    features = _client_features("exact", client.id).get(client.id, EMPTY_FEATURES)
+    client.credit_score, client.max_loan_limit = score_from_features(*features)
     client.save(update_fields=["credit_score", "max_loan_limit", "updated_at"])
     return client
+
+
+def recompute_all_client_credit(chunk_size: int = CREDIT_CHUNK_SIZE) -> dict:
+    scanned = 0
+    updated = 0
+    last_id = 0
+
+    while True:
+        clients = list(
+            Client.objects.filter(id__gt=last_id)
+            .order_by("id")
+            .only("id", "credit_score", "max_loan_limit")[:chunk_size]
+        )
+        if not clients:
+            break
+        last_id = clients[-1].id
+        features = _client_features("range", (clients[0].id, last_id))
+
+        now = timezone.now()
+        changed = []
+        for client in clients:
+            score, max_limit = score_from_features(*features.get(client.id, EMPTY_FEATURES))
+            if client.credit_score == score and client.max_loan_limit == max_limit:
+                continue
+            client.credit_score = score
+            client.max_loan_limit = max_limit
+            client.updated_at = now
+            changed.append(client)
+
+        Client.objects.bulk_update(changed, ["credit_score", "max_loan_limit", "updated_at"], batch_size=chunk_size)
+        invalidate_client_summaries(client.id for client in changed)
+        scanned += len(clients)
+        updated += len(changed)
+        if len(clients) < chunk_size:
+            break
+
+    return {"scanned": scanned, "updated": updated}
+
+
+def _features_rows(client_ids, features):
+    rows = []
+    for client_id in client_ids:
+        values = features.get(client_id, EMPTY_FEATURES)
+        rows.append(ClientCreditFeatures(client_id=client_id, **dict(zip(FEATURE_FIELDS, values))))
+    return rows
+
+
+def rebuild_client_credit_features(client_ids) -> int:
+    client_ids = list(client_ids)
+    features = _client_features("in", client_ids)
+    with transaction.atomic():
+        ClientCreditFeatures.objects.filter(client_id__in=client_ids).delete()
+        ClientCreditFeatures.objects.bulk_create(_features_rows(client_ids, features))
+    return len(client_ids)
+
+
+def rebuild_all_client_credit_features(chunk_size: int = CREDIT_CHUNK_SIZE) -> int:
+    rebuilt = 0
+    last_id = 0
+    while True:
+        client_ids = list(
+            Client.objects.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:chunk_size]
+        )
+        if not client_ids:
+            break
+        last_id = client_ids[-1]
+        rebuilt += rebuild_client_credit_features(client_ids)
+    return rebuilt
+
+
+def verify_client_credit_features(chunk_size: int = CREDIT_CHUNK_SIZE):
+    last_id = 0
+    while True:
+        client_ids = list(
+            Client.objects.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:chunk_size]
+        )
+        if not client_ids:
+            break
+        last_id = client_ids[-1]
+        live = _client_features("range", (client_ids[0], last_id))
+        stored = {
+            row.client_id: row.as_tuple()
+            for row in ClientCreditFeatures.objects.filter(client_id__in=client_ids)
+        }
+        for client_id in client_ids:
+            expected = tuple(live.get(client_id, EMPTY_FEATURES))
+            if stored.get(client_id) != expected:
+                yield client_id, stored.get(client_id), expected
+
+
+def rescore_client_from_features(client_id: int):
+    features = ClientCreditFeatures.objects.filter(client_id=client_id).first()
+    if features is None:
+        rebuild_client_credit_features([client_id])
+        features = ClientCreditFeatures.objects.get(client_id=client_id)
+    score, max_limit = score_from_features(*features.as_tuple())
+    Client.objects.filter(id=client_id).update(credit_score=score, max_loan_limit=max_limit, updated_at=timezone.now())
+    return score, max_limit
+
+
+def _apply_feature_delta(client_id: int, build_missing: bool = True, **deltas):
+    changes = {field: F(field) + delta for field, delta in deltas.items() if delta}
+    if not changes:
+        return
+    updated = ClientCreditFeatures.objects.filter(client_id=client_id).update(**changes, updated_at=timezone.now())
+    if not updated and build_missing:
+        # No counters yet for this client: build them from the live tables, which already include this event.
+        rebuild_client_credit_features([client_id])
+
+
+def _paid_on_time(status: str, due_date, last_paid_at) -> bool:
+    if status != Loan.Status.PAID or last_paid_at is None:
+        return False
+    return timezone.localtime(last_paid_at).date() <= due_date
+
+
+def _record_loan_payment_change(loan_id: int, payment_id: int, removed=None, added=None, build_missing: bool = True):
+    """Apply one payment's (amount, paid_at) leaving and/or joining a loan to its client's counters.
+
+    The loan row is locked so the delta is taken against the status a concurrent transition will see.
+    Returns the client id, or None when the loan is gone.
+    """
+    loan = (
+        Loan.objects.select_for_update()
+        .filter(pk=loan_id)
+        .values_list("client_id", "status", "due_date", "amount")
+        .first()
+    )
+    if loan is None:
+        return None
+    client_id, status, due_date, loan_amount = loan
+    others = (
+        Payment.objects.filter(loan_id=loan_id)
+        .exclude(pk=payment_id)
+        .aggregate(count=Count("id"), last_paid_at=Max("paid_at"))
+    )
+    count_before = others["count"] + int(removed is not None)
+    count_after = others["count"] + int(added is not None)
+    last_before = max(filter(None, [others["last_paid_at"], removed and removed[1]]), default=None)
+    last_after = max(filter(None, [others["last_paid_at"], added and added[1]]), default=None)
+
+    _apply_feature_delta(
+        client_id,
+        build_missing=build_missing,
+        # total_due follows the original join: a loan counts once per payment, and at least once.
+        total_due=loan_amount * (max(1, count_after) - max(1, count_before)),
+        total_repaid=(added[0] if added else 0) - (removed[0] if removed else 0),
+        paid_on_time=int(_paid_on_time(status, due_date, last_after)) - int(_paid_on_time(status, due_date, last_before)),
+    )
+    return client_id
+
+
+def record_payment_created(payment: Payment):
+    return _record_loan_payment_change(payment.loan_id, payment.pk, added=(payment.amount, payment.paid_at))
+
+
+def record_payment_deleted(payment: Payment):
+    # Deletes can run inside a client or loan cascade, so a missing row is left for the next rescore to build.
+    return _record_loan_payment_change(
+        payment.loan_id, payment.pk, removed=(payment.amount, payment.paid_at), build_missing=False
+    )
+
+
+def record_payment_changed(payment: Payment, previous_loan_id: int, previous_amount, previous_paid_at) -> set:
+    current = (payment.amount, payment.paid_at)
+    previous = (previous_amount, previous_paid_at)
+    if previous_loan_id == payment.loan_id:
+        client_ids = {_record_loan_payment_change(payment.loan_id, payment.pk, removed=previous, added=current)}
+    else:
+        client_ids = {
+            _record_loan_payment_change(previous_loan_id, payment.pk, removed=previous),
+            _record_loan_payment_change(payment.loan_id, payment.pk, added=current),
+        }
+    client_ids.discard(None)
+    return client_ids
+
+
+def record_status_transitions(changed):
+    """Apply (loan_id, previous_status, new_status) transitions that were just written to the counters.
+
+    Only moves into or out of PAID change them; those loans' last payment is read in one grouped query.
+    """
+    transitions = {
+        loan_id: (previous_status, new_status)
+        for loan_id, previous_status, new_status in changed
+        if Loan.Status.PAID in (previous_status, new_status)
+    }
+    if not transitions:
+        return
+    loans = (
+        Loan.objects.filter(id__in=transitions)
+        .order_by()
+        .annotate(last_paid_at=Max("payments__paid_at"))
+        .values_list("id", "client_id", "due_date", "last_paid_at")
+    )
+    deltas = defaultdict(lambda: defaultdict(int))
+    for loan_id, client_id, due_date, last_paid_at in loans:
+        previous_status, new_status = transitions[loan_id]
+        delta = deltas[client_id]
+        delta["loans_paid"] += int(new_status == Loan.Status.PAID) - int(previous_status == Loan.Status.PAID)
+        delta["paid_on_time"] += int(_paid_on_time(new_status, due_date, last_paid_at)) - int(
+            _paid_on_time(previous_status, due_date, last_paid_at)
+        )
+    for client_id, delta in deltas.items():
+        _apply_feature_delta(client_id, **delta)
+
+
+def record_loan_created(loan: Loan):
+    _apply_feature_delta(
+        loan.client_id,
+        loans_total=1,
+        total_due=loan.amount,
+        loans_paid=int(loan.status == Loan.Status.PAID),
+    )
+
+
+def invalidate_client_credit_features(client_id: int):
+    ClientCreditFeatures.objects.filter(client_id=client_id).delete()
@@ -0,0 +1,31 @@
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+
+# Kept free of Django imports: these run inside ProcessPoolExecutor workers that are only handed the keys.
+_primary = None
+_cipher = None
+
+
+def init_rotation_worker(keys):
+    global _primary, _cipher
+    fernets = [Fernet(key.encode("utf-8")) for key in keys]
+    _primary, _cipher = fernets[0], MultiFernet(fernets)
+
+
+def rotate_tokens(rows: list) -> tuple:
+    """Re-encrypt (pk, token) pairs under the primary key.
+
+    Returns (rotated pairs, unreadable pks); tokens already under the primary key are left out of both.
+    """
+    rotated, unreadable = [], []
+    for pk, token in rows:
+        raw = token.encode("utf-8")
+        try:
+            _primary.decrypt(raw)
+            continue
+        except InvalidToken:
+            pass
+        try:
+            rotated.append((pk, _cipher.rotate(raw).decode("utf-8")))
+        except InvalidToken:
+            unreadable.append(pk)
+    return rotated, unreadable
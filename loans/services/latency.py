@@ -0,0 +1,227 @@
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines run a single process.
+    fcntl = None
+
+BUCKET_BOUNDS_MS = (1, 2, 5, 10, 25, 50, 75, 100, 150, 250, 400, 600, 1000, 1500, 2500, 5000, 10000)
+BUCKET_COUNT = len(BUCKET_BOUNDS_MS) + 1
+QUANTILES = (0.5, 0.95, 0.99)
+
+MAGIC = b"WEITOLAT"
+VERSION = 1
+KEY_BYTES = 120
+OVERFLOW_KEY = "OTHER 0 other"
+# Requests that resolve to no route, or use a nonstandard method, share one series each, so client-chosen
+# paths and methods cannot fill the table.
+UNMATCHED_ENDPOINT = "unmatched"
+HTTP_METHODS = frozenset({"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"})
+
+_HEADER = struct.Struct("<8sIIII")
+_SLOT_STAMP = struct.Struct("<q")
+_CELL = struct.Struct(f"<{BUCKET_COUNT}Id")
+_KEYS_OFFSET = 64
+
+
+# One ring slot per minute of the window; each slot holds a bucket-count row per series. The file is
+# mmap'd MAP_SHARED so every gunicorn worker on the host writes into the same histograms.
+class LatencyHistogram:
+    def __init__(self, path: str, max_series: int = 256, window_minutes: int = 15):
+        self.path = path
+        self.max_series = max_series
+        self.window_minutes = window_minutes
+        self._slots_offset = _KEYS_OFFSET + max_series * KEY_BYTES
+        self._slot_size = _SLOT_STAMP.size + max_series * _CELL.size
+        self._size = self._slots_offset + window_minutes * self._slot_size
+        self._pid = None
+        self._thread_lock = threading.Lock()
+
+    def _open(self):
+        if self._pid == os.getpid():
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._pid = os.getpid()
+        self._index = {}
+        with self._locked():
+            if os.fstat(self._fd).st_size != self._size:
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, self._size)
+            self._map = mmap.mmap(self._fd, self._size)
+            expected = _HEADER.pack(MAGIC, VERSION, self.max_series, self.window_minutes, BUCKET_COUNT)
+            if self._map[: _HEADER.size] != expected:
+                self._map[:] = bytes(self._size)
+                self._map[: _HEADER.size] = expected
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _key_at(self, index: int) -> str:
+        offset = _KEYS_OFFSET + index * KEY_BYTES
+        return self._map[offset : offset + KEY_BYTES].rstrip(b"\x00").decode("utf-8")
+
+    def _series_index(self, key: str) -> int:
+        if key in self._index:
+            return self._index[key]
+        stored_key = key.encode("utf-8")[:KEY_BYTES].decode("utf-8", "ignore")
+        encoded = stored_key.encode("utf-8")
+        usable = self.max_series - 1
+        start = zlib.crc32(encoded) % usable
+        for probe in range(usable):
+            index = (start + probe) % usable
+            stored = self._key_at(index)
+            if not stored:
+                offset = _KEYS_OFFSET + index * KEY_BYTES
+                self._map[offset : offset + len(encoded)] = encoded
+                self._index[key] = index
+                return index
+            if stored == stored_key:
+                self._index[key] = index
+                return index
+        # Table full: the last series collects everything that did not fit.
+        overflow_index = self.max_series - 1
+        if not self._key_at(overflow_index):
+            offset = _KEYS_OFFSET + overflow_index * KEY_BYTES
+            self._map[offset : offset + len(OVERFLOW_KEY)] = OVERFLOW_KEY.encode("utf-8")
+        return overflow_index
+
+    def _slot_offset(self, minute: int) -> int:
+        return self._slots_offset + (minute % self.window_minutes) * self._slot_size
+
+    def record(self, method: str, endpoint: str, status_code: int, duration_ms: float):
+        self._open()
+        minute = int(time.time() // 60)
+        bucket = bisect.bisect_left(BUCKET_BOUNDS_MS, duration_ms)
+        with self._locked():
+            slot = self._slot_offset(minute)
+            if _SLOT_STAMP.unpack_from(self._map, slot)[0] != minute:
+                self._map[slot : slot + self._slot_size] = bytes(self._slot_size)
+                _SLOT_STAMP.pack_into(self._map, slot, minute)
+            cell = slot + _SLOT_STAMP.size + self._series_index(f"{method} {status_code} {endpoint}") * _CELL.size
+            values = list(_CELL.unpack_from(self._map, cell))
+            values[bucket] += 1
+            values[-1] += duration_ms
+            _CELL.pack_into(self._map, cell, *values)
+
+    def snapshot(self) -> dict:
+        self._open()
+        oldest = int(time.time() // 60) - self.window_minutes
+        series = {}
+        with self._locked():
+            keys = [self._key_at(index) for index in range(self.max_series)]
+            for slot_number in range(self.window_minutes):
+                slot = self._slots_offset + slot_number * self._slot_size
+                if _SLOT_STAMP.unpack_from(self._map, slot)[0] <= oldest:
+                    continue
+                for index, key in enumerate(keys):
+                    if not key:
+                        continue
+                    values = _CELL.unpack_from(self._map, slot + _SLOT_STAMP.size + index * _CELL.size)
+                    if not any(values[:-1]):
+                        continue
+                    counts, total = series.setdefault(key, ([0] * BUCKET_COUNT, [0.0]))
+                    for bucket, count in enumerate(values[:-1]):
+                        counts[bucket] += count
+                    total[0] += values[-1]
+        return {key: (counts, total[0]) for key, (counts, total) in series.items()}
+
+    def reset(self):
+        self._open()
+        with self._locked():
+            self._map[_KEYS_OFFSET:] = bytes(self._size - _KEYS_OFFSET)
+            self._index = {}
+
+
+def quantile(counts, q: float) -> float:
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = q * total
+    cumulative = 0
+    for bucket, count in enumerate(counts):
+        if cumulative + count >= rank and count:
+            if bucket >= len(BUCKET_BOUNDS_MS):
+                return float(BUCKET_BOUNDS_MS[-1])
+            lower = BUCKET_BOUNDS_MS[bucket - 1] if bucket else 0
+            upper = BUCKET_BOUNDS_MS[bucket]
+            return round(lower + (upper - lower) * (rank - cumulative) / count, 2)
+        cumulative += count
+    return float(BUCKET_BOUNDS_MS[-1])
+
+
+def summarize(counts, total_ms: float) -> dict:
+    count = sum(counts)
+    summary = {"count": count, "avg_ms": round(total_ms / count, 2) if count else 0}
+    for q in QUANTILES:
+        summary[f"p{int(q * 100)}"] = quantile(counts, q)
+    return summary
+
+
+def latency_report(histogram=None) -> dict:
+    snapshot = (histogram or get_latency_histogram()).snapshot()
+    overall_counts = [0] * BUCKET_COUNT
+    overall_total = 0.0
+    errors = 0
+    endpoints = []
+    for key, (counts, total_ms) in sorted(snapshot.items()):
+        method, status_code, endpoint = key.split(" ", 2)
+        for bucket, count in enumerate(counts):
+            overall_counts[bucket] += count
+        overall_total += total_ms
+        if int(status_code) >= 500:
+            errors += sum(counts)
+        endpoints.append({"method": method, "endpoint": endpoint, "status": int(status_code), **summarize(counts, total_ms)})
+    return {"overall": summarize(overall_counts, overall_total), "errors": errors, "endpoints": endpoints}
+
+
+def _label(value: str) -> str:
+    # Label values are quoted strings in the text exposition format; only these three need escaping.
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus(histogram=None) -> str:
+    snapshot = (histogram or get_latency_histogram()).snapshot()
+    lines = [
+        "# HELP weito_http_request_duration_ms API request latency over the rolling window.",
+        "# TYPE weito_http_request_duration_ms summary",
+    ]
+    for key, (counts, total_ms) in sorted(snapshot.items()):
+        method, status_code, endpoint = key.split(" ", 2)
+        labels = f'method="{_label(method)}",endpoint="{_label(endpoint)}",status="{_label(status_code)}"'
+        for q in QUANTILES:
+            lines.append(f'weito_http_request_duration_ms{{{labels},quantile="{q}"}} {quantile(counts, q)}')
+        lines.append(f"weito_http_request_duration_ms_sum{{{labels}}} {round(total_ms, 2)}")
+        lines.append(f"weito_http_request_duration_ms_count{{{labels}}} {sum(counts)}")
+    return "\n".join(lines) + "\n"
+
+
+_histogram = None
+
+
+def get_latency_histogram() -> LatencyHistogram:
+    global _histogram
+    if _histogram is None or _histogram.path != settings.LATENCY_METRICS_PATH:
+        _histogram = LatencyHistogram(
+            settings.LATENCY_METRICS_PATH,
+            max_series=settings.LATENCY_METRICS_MAX_SERIES,
+            window_minutes=settings.LATENCY_WINDOW_MINUTES,
+        )
+    return _histogram
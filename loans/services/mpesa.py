@@ -1,4 +1,10 @@
 import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
 import requests
@@ -6,6 +12,70 @@ from django.conf import settings
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+try:
+    import fcntl
+except ImportError:  # Windows development machines run a single process.
+    fcntl = None
+
+TOKEN_WAIT_SECONDS = 10
+TOKEN_POLL_SECONDS = 0.05
+
+
+class TokenFile:
+    """The current OAuth token as a JSON file readable only by this user, shared by the workers on a host.
+
+    JSON rather than a pickling cache, so a planted file can at worst hold a bad token, and next to it a lock
+    file whose flock lets one worker refresh while the others wait. The kernel drops the lock if that worker dies.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def read(self):
+        try:
+            with open(self.path, encoding="utf-8") as handle:
+                data = json.load(handle)
+            return str(data["token"]), float(data["expires_at"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def write(self, token: str, expires_at: float):
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        staging = f"{self.path}.{os.getpid()}.{threading.get_ident()}"
+        with os.fdopen(os.open(staging, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w", encoding="utf-8") as handle:
+            json.dump({"token": token, "expires_at": expires_at}, handle)
+        os.replace(staging, self.path)
+
+    def clear(self, token: str):
+        stored = self.read()
+        if stored and stored[0] == token:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    @contextmanager
+    def refresh_lock(self, wait_seconds: float):
+        """Hold the refresh lock, or give up after wait_seconds and refresh without it."""
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        fd = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            deadline = time.monotonic() + wait_seconds
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        break
+                    time.sleep(TOKEN_POLL_SECONDS)
+            yield
+        finally:
+            os.close(fd)
+
 
 class MpesaService:
     def __init__(self):
@@ -15,11 +85,22 @@ class MpesaService:
             total=3,
             backoff_factor=0.5,
             status_forcelist=(429, 500, 502, 503, 504),
-            allowed_methods=("GET", "POST"),
+            # Connect failures are retried for every method; read and status retries would resend an STK
+            # push that Daraja may already have delivered to the customer.
+            allowed_methods=("GET",),
         )
-        self.session.mount("https://", HTTPAdapter(max_retries=retry))
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=settings.MPESA_HTTP_POOL_SIZE)
+        # Both schemes, so a plain-http base URL (a local Daraja stub) goes through the same pool and retries.
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._token = ""
+        self._token_expires_at = 0.0
+        key_id = hashlib.sha256(f"{self.base_url}:{settings.MPESA_CONSUMER_KEY}".encode("utf-8")).hexdigest()[:16]
+        self._token_file = TokenFile(os.path.join(settings.MPESA_TOKEN_DIR, f"oauth-{key_id}.json"))
 
-    def _get_access_token(self) -> str:
+    def _fetch_access_token(self) -> tuple:
         auth_string = f"{settings.MPESA_CONSUMER_KEY}:{settings.MPESA_CONSUMER_SECRET}"
         encoded_auth = base64.b64encode(auth_string.encode("utf-8")).decode("utf-8")
         response = self.session.get(
@@ -28,10 +109,47 @@ class MpesaService:
             timeout=20,
         )
         response.raise_for_status()
-        return response.json().get("access_token", "")
+        body = response.json()
+        expires_in = int(body.get("expires_in") or 0)
+        margin = settings.MPESA_TOKEN_REFRESH_MARGIN_SECONDS
+        lifetime = expires_in - margin if expires_in > 2 * margin else expires_in // 2
+        return body.get("access_token", ""), time.time() + lifetime
+
+    def _remember(self, token: str, expires_at: float):
+        self._token, self._token_expires_at = token, expires_at
+
+    def _remember_shared(self) -> bool:
+        shared = self._token_file.read()
+        if shared and shared[0] and time.time() < shared[1]:
+            self._remember(*shared)
+            return True
+        return False
+
+    def _get_access_token(self) -> str:
+        if self._token and time.time() < self._token_expires_at:
+            return self._token
+        with self._lock:
+            if self._token and time.time() < self._token_expires_at:
+                return self._token
+            if self._remember_shared():
+                return self._token
+            # One worker refreshes; the rest wait on the lock and then find its token in the file.
+            with self._token_file.refresh_lock(TOKEN_WAIT_SECONDS):
+                if self._remember_shared():
+                    return self._token
+                token, expires_at = self._fetch_access_token()
+                if token and expires_at > time.time():
+                    self._token_file.write(token, expires_at)
+            self._remember(token, expires_at)
+            return token
+
+    def _forget_access_token(self, token: str):
+        with self._lock:
+            if self._token == token:
+                self._remember("", 0.0)
+                self._token_file.clear(token)
 
     def stk_push(self, *, phone: str, amount: str, account_reference: str, transaction_desc: str, callback_url: str):
-        token = self._get_access_token()
         timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
         password_raw = f"{settings.MPESA_SHORTCODE}{settings.MPESA_PASSKEY}{timestamp}"
         password = base64.b64encode(password_raw.encode("utf-8")).decode("utf-8")
@@ -50,11 +168,33 @@ class MpesaService:
             "TransactionDesc": transaction_desc,
         }
 
-        response = self.session.post(
-            f"{self.base_url}/mpesa/stkpush/v1/processrequest",
-            json=payload,
-            headers={"Authorization": f"Bearer {token}"},
-            timeout=30,
-        )
+        for attempt in range(2):
+            token = self._get_access_token()
+            response = self.session.post(
+                f"{self.base_url}/mpesa/stkpush/v1/processrequest",
+                json=payload,
+                headers={"Authorization": f"Bearer {token}"},
+                timeout=30,
+            )
+            # A token revoked before its expiry is dropped everywhere and fetched once more.
+            if response.status_code == 401 and attempt == 0:
+                self._forget_access_token(token)
+                continue
+            break
         response.raise_for_status()
         return response.json()
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_mpesa_service() -> MpesaService:
+    global _service
+    base_url = settings.MPESA_BASE_URL.rstrip("/")
+    if _service is None or _service.pid != os.getpid() or _service.base_url != base_url:
+        with _service_lock:
+            if _service is None or _service.pid != os.getpid() or _service.base_url != base_url:
+                # A forked worker must not share the parent's pooled sockets.
+                _service = MpesaService()
+    return _service
@@ -0,0 +1,134 @@
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from celery import current_app
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from loans.models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = 200
+PURGE_BATCH_SIZE = 1000
+MAX_RETRY_SECONDS = 300
+
+
+def enqueue(task, *args, delay: int = 0, key: str = "") -> bool:
+    """Record a Celery task to run once the caller's transaction commits.
+
+    The row is written in the caller's transaction, so a rollback drops it and the request never waits on
+    the broker. With a key, nothing is written while an identical message is pending and not yet due, which
+    lets a burst of events share one delayed run. Returns False when such a message already existed.
+
+    The check and the insert are not atomic and no constraint backs them, so two concurrent callers can both
+    write a row. Keys are only used for tasks that are idempotent (apply_payment_effects only moves loans whose
+    status still differs from their payments), where the race costs one extra run.
+    """
+    name = getattr(task, "name", task)
+    now = timezone.now()
+    # Due messages may already be claimed and running, so only a future one can absorb this event.
+    if key and OutboxMessage.objects.filter(
+        task=name,
+        key=key,
+        status=OutboxMessage.Status.PENDING,
+        available_at__gt=now,
+    ).exists():
+        return False
+    OutboxMessage.objects.create(task=name, args=list(args), key=key, available_at=now + timedelta(seconds=delay))
+    return True
+
+
+def _claim_batch(batch_size: int, now):
+    due = OutboxMessage.objects.filter(status=OutboxMessage.Status.PENDING, available_at__lte=now).order_by("id")
+    if connection.features.has_select_for_update_skip_locked:
+        due = due.select_for_update(skip_locked=True)
+    return list(due[:batch_size])
+
+
+def _publish(messages) -> dict:
+    errors = {}
+    try:
+        # One producer connection for the whole batch instead of one checkout per message.
+        with current_app.producer_or_acquire() as producer:
+            for message in messages:
+                current_app.send_task(message.task, args=message.args, producer=producer)
+                errors[message.id] = ""
+    except Exception as exc:
+        logger.warning("Outbox publish failed after %s of %s messages: %s", len(errors), len(messages), exc)
+        for message in messages:
+            errors.setdefault(message.id, str(exc))
+    return errors
+
+
+def _run_inline(messages) -> dict:
+    errors = {}
+    for message in messages:
+        task = current_app.tasks.get(message.task)
+        if task is None:
+            errors[message.id] = f"Unknown task {message.task}"
+            continue
+        try:
+            # A savepoint per message so a failing task cannot undo the others or the claim.
+            with transaction.atomic():
+                task(*message.args)
+        except Exception as exc:
+            logger.warning("Outbox task %s #%s failed: %s", message.task, message.id, exc)
+            errors[message.id] = repr(exc)
+        else:
+            errors[message.id] = ""
+    return errors
+
+
+def _settle(messages, errors: dict, now) -> dict:
+    counts = defaultdict(int)
+    for message in messages:
+        error = errors.get(message.id, "Not dispatched")
+        if not error:
+            message.status = OutboxMessage.Status.DISPATCHED
+            message.dispatched_at = now
+            message.last_error = ""
+        else:
+            message.attempts += 1
+            message.last_error = error[:1000]
+            if message.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                message.status = OutboxMessage.Status.FAILED
+            else:
+                message.available_at = now + timedelta(seconds=min(2**message.attempts, MAX_RETRY_SECONDS))
+        counts[message.status] += 1
+    OutboxMessage.objects.bulk_update(messages, ["status", "attempts", "available_at", "last_error", "dispatched_at"])
+    return counts
+
+
+def dispatch_outbox(batch_size: int = OUTBOX_BATCH_SIZE, max_batches: int = 50, now=None) -> dict:
+    """Hand due outbox messages to Celery, or run them in-process when OUTBOX_DISPATCH_MODE is inline."""
+    inline = settings.OUTBOX_DISPATCH_MODE == "inline"
+    totals = defaultdict(int)
+    for _ in range(max_batches):
+        claimed_at = now or timezone.now()
+        with transaction.atomic():
+            messages = _claim_batch(batch_size, claimed_at)
+            if not messages:
+                break
+            errors = _run_inline(messages) if inline else _publish(messages)
+            for outcome, count in _settle(messages, errors, claimed_at).items():
+                totals[outcome] += count
+        if len(messages) < batch_size:
+            break
+    return dict(totals)
+
+
+def purge_outbox(retention_days: int = None, batch_size: int = PURGE_BATCH_SIZE, now=None) -> int:
+    """Delete dispatched messages older than OUTBOX_RETENTION_DAYS; FAILED rows stay for the admin."""
+    retention_days = settings.OUTBOX_RETENTION_DAYS if retention_days is None else retention_days
+    cutoff = (now or timezone.now()) - timedelta(days=retention_days)
+    expired = OutboxMessage.objects.filter(status=OutboxMessage.Status.DISPATCHED, dispatched_at__lt=cutoff)
+    purged = 0
+    # Bounded batches keep each DELETE short next to the dispatcher's claims.
+    while True:
+        ids = list(expired.order_by("id").values_list("id", flat=True)[:batch_size])
+        if not ids:
+            return purged
+        purged += OutboxMessage.objects.filter(id__in=ids).delete()[0]
@@ -0,0 +1,52 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F
+
+from loans.models import Client, Loan
+from loans.services.credit import record_status_transitions, rescore_client_from_features
+from loans.services.report_cache import invalidate_client_summaries, invalidate_reports
+
+
+def apply_payment_effects(client_id: int) -> dict:
+    # The outbox only folds a payment into a message that is not yet due, so a payment committed after this
+    # run was claimed schedules its own, and everything committed before is visible to the queries below.
+    if not Client.objects.filter(id=client_id).exists():
+        return {"client_id": client_id, "transitions": 0}
+
+    transitions = (
+        Loan.objects.filter(client_id=client_id)
+        .with_financials()
+        .exclude(status=F("computed_status"))
+        .order_by()
+        .values_list("id", "status", "computed_status")
+    )
+    grouped = defaultdict(list)
+    for loan_id, previous_status, new_status in transitions:
+        grouped[(previous_status, new_status)].append(loan_id)
+
+    changed = []
+    with transaction.atomic():
+        for (previous_status, new_status), loan_ids in grouped.items():
+            locked = list(
+                Loan.objects.select_for_update()
+                .filter(id__in=loan_ids, status=previous_status)
+                .order_by("id")
+                .values_list("id", flat=True)
+            )
+            if locked:
+                Loan.objects.filter(id__in=locked).update(status=new_status)
+                changed.extend((loan_id, previous_status, new_status) for loan_id in locked)
+        # The payments' own amounts are already in the counters; only the status moves are applied here, and
+        # the score is read back from the counters rather than rescanning the client's loans.
+        record_status_transitions(changed)
+        score, max_limit = rescore_client_from_features(client_id)
+        invalidate_reports()
+        invalidate_client_summaries([client_id])
+
+    return {
+        "client_id": client_id,
+        "transitions": len(changed),
+        "credit_score": score,
+        "max_loan_limit": str(max_limit),
+    }
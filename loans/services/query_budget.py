@@ -0,0 +1,39 @@
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+
+class QueryStats:
+    def __init__(self, capture_sql: bool = False):
+        self.count = 0
+        self.duration_ms = 0.0
+        self.capture_sql = capture_sql
+        self.statements = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration_ms += (time.perf_counter() - started) * 1000
+            if self.capture_sql:
+                self.statements.append(sql)
+
+    def as_metadata(self) -> dict:
+        return {"db_queries": self.count, "db_time_ms": round(self.duration_ms, 2)}
+
+
+@contextmanager
+def collect_query_stats(capture_sql: bool = False):
+    stats = QueryStats(capture_sql=capture_sql)
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(stats))
+        yield stats
+
+
+def budget_for(url_name) -> int:
+    return settings.QUERY_BUDGETS.get(url_name, settings.QUERY_BUDGET_DEFAULT)
@@ -0,0 +1,89 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from loans.models import AuditLog, Loan
+from loans.services.credit import record_status_transitions
+from loans.services.report_cache import invalidate_client_summaries, invalidate_reports
+
+RECONCILE_CHUNK_SIZE = 2000
+
+
+def _status_transitions(today):
+    return (
+        Loan.objects.with_financials(today=today)
+        .exclude(status=F("computed_status"))
+        .order_by()
+        .values_list("id", "client_id", "status", "computed_status")
+    )
+
+
+def apply_status_transitions(chunk, counts):
+    """Write (loan_id, client_id, status, computed_status) rows as grouped UPDATEs with their audit trail.
+
+    Only loans still in the status that was read are moved, counted and audited; one a concurrent writer has
+    changed since is left to that writer.
+    """
+    grouped = defaultdict(list)
+    client_ids = {}
+    for loan_id, client_id, previous_status, new_status in chunk:
+        grouped[(previous_status, new_status)].append(loan_id)
+        client_ids[loan_id] = client_id
+
+    changed = []
+    with transaction.atomic():
+        for (previous_status, new_status), loan_ids in grouped.items():
+            locked = list(
+                Loan.objects.select_for_update()
+                .filter(id__in=loan_ids, status=previous_status)
+                .order_by("id")
+                .values_list("id", flat=True)
+            )
+            if not locked:
+                continue
+            counts[new_status] += Loan.objects.filter(id__in=locked, status=previous_status).update(status=new_status)
+            changed.extend((loan_id, previous_status, new_status) for loan_id in locked)
+        if not changed:
+            return
+
+        AuditLog.objects.bulk_create(
+            [
+                AuditLog(
+                    actor="system",
+                    action="reconcile_status",
+                    endpoint="system/reconcile",
+                    method="SYSTEM",
+                    status_code=200,
+                    metadata={"loan_id": loan_id, "from": previous_status, "to": new_status},
+                )
+                for loan_id, previous_status, new_status in changed
+            ],
+            batch_size=RECONCILE_CHUNK_SIZE,
+        )
+
+        # Transitions into or out of PAID bypass the payment signals, so their counter deltas are applied here.
+        record_status_transitions(changed)
+        invalidate_reports()
+        invalidate_client_summaries({client_ids[loan_id] for loan_id, _previous, _new in changed})
+
+
+def reconcile_loan_statuses(chunk_size: int = RECONCILE_CHUNK_SIZE) -> dict:
+    today = timezone.localdate()
+    counts = {status: 0 for status in Loan.Status.values}
+
+    chunk = []
+    for row in _status_transitions(today).iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            apply_status_transitions(chunk, counts)
+            chunk = []
+    if chunk:
+        apply_status_transitions(chunk, counts)
+
+    return {
+        "scanned": Loan.objects.count(),
+        "transitions": counts,
+        "total_transitions": sum(counts.values()),
+    }
@@ -0,0 +1,94 @@
+import logging
+from datetime import datetime, time as dt_time, timedelta
+
+from django.conf import settings
+from django.db.models import F, PositiveBigIntegerField, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from loans.models import LoanReminderLog, ReminderRun
+from loans.services.reminders import count_reminder_candidates, send_loan_reminders
+
+logger = logging.getLogger(__name__)
+
+
+def delivery_window(day):
+    start, end = (
+        timezone.make_aware(datetime.combine(day, dt_time.fromisoformat(value)))
+        for value in (settings.REMINDER_WINDOW_START, settings.REMINDER_WINDOW_END)
+    )
+    return start, max(end, start + timedelta(seconds=1))
+
+
+def _pace(total: int, window_seconds: float) -> float:
+    # The configured rate is shared by the reminder types; a small set is stretched over the whole window
+    # instead of going out in the first minutes.
+    share = settings.REMINDER_RATE_PER_SECOND / len(LoanReminderLog.ReminderType.values)
+    return min(share, total / window_seconds) if total else share
+
+
+def _plan_runs(day, start, end):
+    window_seconds = (end - start).total_seconds()
+    # A stretched set is paced to finish two ticks early, so its last send is not due at the closing tick.
+    margin = settings.REMINDER_TICK_SECONDS * 2
+    if window_seconds > margin * 2:
+        window_seconds -= margin
+    planned = set(ReminderRun.objects.filter(run_date=day).values_list("reminder_type", flat=True))
+    for reminder_type in LoanReminderLog.ReminderType.values:
+        if reminder_type in planned:
+            continue
+        total = count_reminder_candidates(reminder_type, day)
+        ReminderRun.objects.get_or_create(
+            reminder_type=reminder_type,
+            run_date=day,
+            defaults={"total": total, "pace": _pace(total, window_seconds), "paced_at": start},
+        )
+
+
+def _advance(run: ReminderRun, now) -> dict:
+    _start, end = delivery_window(run.run_date)
+    if now >= end:
+        # Nothing goes out once the window has closed. A due-soon set is only right on its own day, and overdue
+        # loans left unreminded are counted into the next day's run, so the run is closed instead of resumed.
+        ReminderRun.objects.filter(id=run.id).update(finished_at=now)
+        logger.warning("Closed unfinished %s reminder run for %s at %s/%s", run.reminder_type, run.run_date, run.sent, run.total)
+        return {"closed": True}
+
+    # Token bucket: the run earns `pace` sends per second since it was last paced. Earnings are capped at two
+    # ticks so a stalled beat does not turn into a burst, and the unspent fraction carries over. A slow run
+    # earns less than one send per tick, so its cap is a whole token plus one tick's earnings: any lower and it
+    # would either never send or drop the overshoot on every send and drift past the end of the window.
+    tick_earnings = run.pace * settings.REMINDER_TICK_SECONDS
+    earned = min(run.pace * (now - run.paced_at).total_seconds(), tick_earnings + max(tick_earnings, 1))
+    limit = int(earned)
+    if limit < 1:
+        return {"sent": 0}
+    paced_at = now - timedelta(seconds=(earned - limit) / run.pace)
+    if not ReminderRun.objects.filter(id=run.id, paced_at=run.paced_at).update(paced_at=paced_at):
+        # An overlapping tick spent these tokens already.
+        return {"sent": 0}
+
+    result = send_loan_reminders(run.reminder_type, after_id=run.last_loan_id, limit=limit, today=run.run_date)
+    progress = {
+        "sent": F("sent") + result["sent"],
+        "failed": F("failed") + result["failed"],
+        "last_loan_id": Greatest("last_loan_id", Value(result["last_id"], output_field=PositiveBigIntegerField())),
+    }
+    if result["done"]:
+        progress["finished_at"] = now
+    ReminderRun.objects.filter(id=run.id).update(**progress)
+    return {"sent": result["sent"], "failed": result["failed"], "done": result["done"]}
+
+
+def run_reminder_schedule(now=None) -> dict:
+    """Plan today's reminder runs while the delivery window is open and send each run's share for this tick."""
+    now = now or timezone.now()
+    today = timezone.localdate(now)
+    start, end = delivery_window(today)
+    if start <= now < end:
+        _plan_runs(today, start, end)
+
+    report = {}
+    for run in ReminderRun.objects.filter(finished_at__isnull=True).order_by("run_date", "reminder_type"):
+        report[f"{run.run_date}:{run.reminder_type}"] = _advance(run, now)
+    return report
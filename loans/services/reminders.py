@@ -0,0 +1,115 @@
+import logging
+import uuid
+from datetime import timedelta
+
+from django.utils import timezone
+
+from loans.models import Loan, LoanReminderLog
+from loans.services.reconciliation import apply_status_transitions
+from loans.services.sms import send_batch
+
+logger = logging.getLogger(__name__)
+
+REMINDER_CHUNK_SIZE = 500
+# Due-soon reminders go out this many days before the due date ("due tomorrow").
+DUE_SOON_DAYS_AHEAD = 1
+
+MESSAGES = {
+    LoanReminderLog.ReminderType.DUE_SOON: (
+        "Reminder: Loan #{id} of KES {amount} is due tomorrow ({due_date}). Please pay to avoid penalties."
+    ),
+    LoanReminderLog.ReminderType.OVERDUE: (
+        "Overdue alert: Loan #{id} of KES {amount} was due on {due_date}. Please clear payment immediately."
+    ),
+}
+
+
+def _unreminded_loans(reminder_type: str, today):
+    if reminder_type == LoanReminderLog.ReminderType.DUE_SOON:
+        loans = Loan.objects.filter(status=Loan.Status.ACTIVE, due_date=today + timedelta(days=DUE_SOON_DAYS_AHEAD))
+    else:
+        loans = Loan.objects.filter(due_date__lt=today).exclude(status=Loan.Status.PAID)
+    return loans.exclude(reminder_logs__reminder_type=reminder_type)
+
+
+def count_reminder_candidates(reminder_type: str, today) -> int:
+    """Upper bound on the day's sends, without the payment aggregates that settle eligibility."""
+    return _unreminded_loans(reminder_type, today).count()
+
+
+def _candidates(reminder_type: str, today):
+    return (
+        _unreminded_loans(reminder_type, today)
+        .with_financials(today=today)
+        .order_by("id")
+        .values_list("id", "client_id", "status", "computed_status", "amount", "due_date", "client__phone_number")
+    )
+
+
+def _claim(reminder_type: str, loan_ids) -> dict:
+    # Losers of a race with another run hit the unique constraint and are skipped; the claim id tells
+    # this run's rows apart from theirs when reading back.
+    claim_id = uuid.uuid4()
+    LoanReminderLog.objects.bulk_create(
+        [LoanReminderLog(loan_id=loan_id, reminder_type=reminder_type, claim_id=claim_id) for loan_id in loan_ids],
+        ignore_conflicts=True,
+    )
+    return dict(LoanReminderLog.objects.filter(claim_id=claim_id).values_list("loan_id", "id"))
+
+
+def _send_chunk(reminder_type: str, chunk, totals: dict, transitions: dict):
+    changed = [row[:4] for row in chunk if row[2] != row[3]]
+    if changed:
+        apply_status_transitions(changed, transitions)
+
+    # A due-soon loan must still be ACTIVE and an overdue one OVERDUE, exactly as refresh_status would leave it.
+    target = Loan.Status.ACTIVE if reminder_type == LoanReminderLog.ReminderType.DUE_SOON else Loan.Status.OVERDUE
+    eligible = [row for row in chunk if row[3] == target]
+    claimed = _claim(reminder_type, [row[0] for row in eligible]) if eligible else {}
+    winners = [row for row in eligible if row[0] in claimed]
+
+    template = MESSAGES[reminder_type]
+    results = send_batch(
+        (phone_number, template.format(id=loan_id, amount=amount, due_date=due_date))
+        for loan_id, _client_id, _status, _computed, amount, due_date, phone_number in winners
+    )
+    failed = [claimed[row[0]] for row, sent in zip(winners, results) if not sent]
+    if failed:
+        LoanReminderLog.objects.filter(id__in=failed).delete()
+
+    totals["scanned"] += len(chunk)
+    totals["claimed"] += len(winners)
+    totals["sent"] += len(winners) - len(failed)
+    totals["failed"] += len(failed)
+
+
+def send_loan_reminders(
+    reminder_type: str,
+    chunk_size: int = REMINDER_CHUNK_SIZE,
+    after_id: int = 0,
+    limit: int = None,
+    today=None,
+) -> dict:
+    """Remind eligible loans once: select, claim slots in bulk, send concurrently, release failures.
+
+    after_id and limit let a caller work through the set in slices; last_id and done tell it where to resume.
+    """
+    today = today or timezone.localdate()
+    totals = {"scanned": 0, "claimed": 0, "sent": 0, "failed": 0, "last_id": after_id, "done": False}
+    transitions = {status: 0 for status in Loan.Status.values}
+
+    # Keyset pages rather than one cursor: each chunk writes status transitions and claims before the next read.
+    while limit is None or totals["claimed"] < limit:
+        size = chunk_size if limit is None else min(chunk_size, limit - totals["claimed"])
+        chunk = list(_candidates(reminder_type, today).filter(id__gt=totals["last_id"])[:size])
+        if chunk:
+            _send_chunk(reminder_type, chunk, totals, transitions)
+            totals["last_id"] = chunk[-1][0]
+        if len(chunk) < size:
+            totals["done"] = True
+            break
+
+    totals["transitions"] = sum(transitions.values())
+    if totals["failed"]:
+        logger.warning("%s reminders: %s of %s sends failed and were released", reminder_type, totals["failed"], totals["claimed"])
+    return totals
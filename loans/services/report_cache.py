@@ -0,0 +1,76 @@
+from uuid import uuid4
+
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+
+REPORT_CACHE_ALIAS = "reports"
+REPORT_VERSION_KEY = "reports:version"
+
+
+def _report_cache():
+    return caches[REPORT_CACHE_ALIAS]
+
+
+def _current_version(key: str) -> str:
+    cache = _report_cache()
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def current_report_version() -> str:
+    return _current_version(REPORT_VERSION_KEY)
+
+
+def bump_report_version():
+    # A fresh token rather than incr(): the file and database backends have no atomic increment across
+    # processes, and two writers racing to the same counter value could leave a stale entry current.
+    _report_cache().set(REPORT_VERSION_KEY, uuid4().hex, timeout=None)
+
+
+def invalidate_reports():
+    # Bump after commit so no request can cache pre-commit data under the new version. Robust: the payment
+    # has already committed, so a cache error is logged rather than turned into a 500 or an aborted drain.
+    transaction.on_commit(bump_report_version, robust=True)
+
+
+def cached_report(name: str, build):
+    cache = _report_cache()
+    key = f"reports:{name}:{timezone.localdate().isoformat()}:{current_report_version()}"
+    data = cache.get(key)
+    if data is None:
+        data = build()
+        cache.set(key, data)
+    return data
+
+
+def _client_summary_version_key(client_id: int) -> str:
+    return f"client-summary:{client_id}:version"
+
+
+def client_summary_version(client_id: int) -> str:
+    return _current_version(_client_summary_version_key(client_id))
+
+
+def invalidate_client_summaries(client_ids):
+    keys = {_client_summary_version_key(client_id) for client_id in client_ids}
+    if not keys:
+        return
+    transaction.on_commit(lambda: _report_cache().set_many({key: uuid4().hex for key in keys}, timeout=None), robust=True)
+
+
+def cached_client_summary(client_id: int, version: str, build):
+    cache = _report_cache()
+    key = f"client-summary:{client_id}:{version}"
+    data = cache.get(key)
+    if data is None:
+        data = build()
+        cache.set(key, data)
+    return data
+
+
+def clear_report_cache():
+    _report_cache().clear()
@@ -1,96 +1,183 @@
 import logging
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
+from requests.adapters import HTTPAdapter
+from twilio.http.http_client import TwilioHttpClient
 from twilio.rest import Client as TwilioClient
 
 from loans.models import NotificationLog
 
+try:
+    import fcntl
+except ImportError:  # Windows development machines run a single process.
+    fcntl = None
+
 logger = logging.getLogger(__name__)
 
+MAX_SCHEDULE_AHEAD_SECONDS = 3600
+_SLOT = struct.Struct("<d")
+
+
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart across threads; a rate of 0 disables it.
+
+    With a path, the next free slot is kept in that file under an flock, so every worker process on the host
+    draws from one schedule and the provider sees the configured rate, not a multiple of it.
+    """
+
+    def __init__(self, rate: float, clock=time.time, sleep=time.sleep, path: str = None):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.clock = clock
+        self.sleep = sleep
+        self.path = path if fcntl is not None else None
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def _reserve(self, now: float) -> float:
+        if self.path is None:
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self.interval
+            return slot
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            stored = os.pread(fd, _SLOT.size, 0)
+            next_slot = _SLOT.unpack(stored)[0] if len(stored) == _SLOT.size else 0.0
+            if next_slot > now + MAX_SCHEDULE_AHEAD_SECONDS:
+                # The wall clock stepped back; a schedule that far ahead would stall every sender.
+                next_slot = now
+            slot = max(next_slot, now)
+            os.pwrite(fd, _SLOT.pack(slot + self.interval), 0)
+        finally:
+            os.close(fd)
+        return slot
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = self.clock()
+            slot = self._reserve(now)
+        if slot > now:
+            self.sleep(slot - now)
+
+
+_client = None
+_limiters = {}
+_state_lock = threading.Lock()
+
 
 def _twilio_client():
     if not all([settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN]):
         return None
-    return TwilioClient(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+    global _client
+    key = (settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN, os.getpid())
+    if _client is None or _client[0] != key:
+        with _state_lock:
+            if _client is None or _client[0] != key:
+                # One pooled session per process, sized for the dispatcher's threads; a forked worker builds its own.
+                http_client = TwilioHttpClient(timeout=30)
+                http_client.session.mount("https://", HTTPAdapter(pool_maxsize=settings.SMS_DISPATCH_WORKERS))
+                _client = (key, TwilioClient(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN, http_client=http_client))
+    return _client[1]
 
 
-def send_sms(phone_number: str, message: str) -> bool:
+def _rate_limiter(provider: str) -> RateLimiter:
+    rate = float(settings.SMS_RATE_LIMITS.get(provider, 0))
+    path = os.path.join(settings.SMS_RATE_LIMIT_DIR, f"{provider}.slot")
+    key = (provider, rate, path, os.getpid())
+    limiter = _limiters.get(key)
+    if limiter is None:
+        with _state_lock:
+            limiter = _limiters.setdefault(key, RateLimiter(rate, path=path))
+    return limiter
+
+
+def _sms_attempt(twilio_client, phone_number: str, message: str) -> NotificationLog:
+    log = NotificationLog(phone_number=phone_number, channel=NotificationLog.Channel.SMS, message=message)
     provider = settings.SMS_PROVIDER.lower()
     if provider != "twilio":
         logger.warning("Unsupported SMS provider '%s'; SMS skipped for %s", provider, phone_number)
-        NotificationLog.objects.create(
-            phone_number=phone_number,
-            channel=NotificationLog.Channel.SMS,
-            message=message,
-            success=False,
-            error_message=f"Unsupported provider: {provider}",
-        )
-        return False
-
-    twilio_client = _twilio_client()
+        log.error_message = f"Unsupported provider: {provider}"
+        return log
     if not twilio_client or not settings.TWILIO_FROM_NUMBER:
-        NotificationLog.objects.create(
-            phone_number=phone_number,
-            channel=NotificationLog.Channel.SMS,
-            message=message,
-            success=False,
-            error_message="Twilio SMS config missing",
-        )
-        return False
+        log.error_message = "Twilio SMS config missing"
+        return log
 
     try:
+        _rate_limiter(provider).acquire()
         twilio_client.messages.create(body=message, from_=settings.TWILIO_FROM_NUMBER, to=phone_number)
-        NotificationLog.objects.create(
-            phone_number=phone_number,
-            channel=NotificationLog.Channel.SMS,
-            message=message,
-            success=True,
-        )
-        return True
+        log.success = True
     except Exception as exc:
-        NotificationLog.objects.create(
-            phone_number=phone_number,
-            channel=NotificationLog.Channel.SMS,
-            message=message,
-            success=False,
-            error_message=str(exc),
-        )
-        return False
-
+        log.error_message = str(exc)
+    return log
 
-def send_whatsapp(phone_number: str, message: str) -> bool:
-    if not settings.ENABLE_WHATSAPP_REMINDERS:
-        return False
 
-    twilio_client = _twilio_client()
-    if not twilio_client or not settings.TWILIO_WHATSAPP_FROM_NUMBER:
-        return False
+def _whatsapp_attempt(twilio_client, phone_number: str, message: str):
+    if not settings.ENABLE_WHATSAPP_REMINDERS or not twilio_client or not settings.TWILIO_WHATSAPP_FROM_NUMBER:
+        return None
 
+    log = NotificationLog(phone_number=phone_number, channel=NotificationLog.Channel.WHATSAPP, message=message)
     try:
+        _rate_limiter("twilio").acquire()
         twilio_client.messages.create(
             body=message,
             from_=settings.TWILIO_WHATSAPP_FROM_NUMBER,
             to=f"whatsapp:{phone_number}",
         )
-        NotificationLog.objects.create(
-            phone_number=phone_number,
-            channel=NotificationLog.Channel.WHATSAPP,
-            message=message,
-            success=True,
-        )
-        return True
+        log.success = True
     except Exception as exc:
-        NotificationLog.objects.create(
-            phone_number=phone_number,
-            channel=NotificationLog.Channel.WHATSAPP,
-            message=message,
-            success=False,
-            error_message=str(exc),
-        )
+        log.error_message = str(exc)
+    return log
+
+
+def _deliver(twilio_client, phone_number: str, message: str) -> list:
+    whatsapp = _whatsapp_attempt(twilio_client, phone_number, message)
+    if whatsapp is not None and whatsapp.success:
+        return [whatsapp]
+    sms = _sms_attempt(twilio_client, phone_number, message)
+    return [sms] if whatsapp is None else [whatsapp, sms]
+
+
+def send_sms(phone_number: str, message: str) -> bool:
+    log = _sms_attempt(_twilio_client(), phone_number, message)
+    log.save()
+    return log.success
+
+
+def send_whatsapp(phone_number: str, message: str) -> bool:
+    log = _whatsapp_attempt(_twilio_client(), phone_number, message)
+    if log is None:
         return False
+    log.save()
+    return log.success
 
 
 def send_with_fallback(phone_number: str, message: str) -> bool:
-    if send_whatsapp(phone_number, message):
-        return True
-    return send_sms(phone_number, message)
+    return send_batch([(phone_number, message)])[0]
+
+
+def send_batch(messages, workers: int = None) -> list:
+    """Send (phone_number, message) pairs concurrently, WhatsApp first when enabled, then SMS.
+
+    Returns one success flag per pair, in order. The threads only talk to the provider; every attempt is
+    logged afterwards with a single bulk_create.
+    """
+    messages = list(messages)
+    if not messages:
+        return []
+    twilio_client = _twilio_client()
+    workers = max(1, min(workers or settings.SMS_DISPATCH_WORKERS, len(messages)))
+    if workers == 1:
+        attempts = [_deliver(twilio_client, phone_number, message) for phone_number, message in messages]
+    else:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sms") as pool:
+            attempts = list(pool.map(lambda pair: _deliver(twilio_client, *pair), messages))
+    NotificationLog.objects.bulk_create([log for logs in attempts for log in logs])
+    return [logs[-1].success for logs in attempts]
@@ -1,24 +1,122 @@
+from django.conf import settings
 from django.contrib.auth.models import Group, Permission
-from django.db.models.signals import post_delete, post_migrate, post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_save
 from django.dispatch import receiver
 
-from .models import Payment
-from .services.credit import recompute_client_credit
-from .tasks import send_payment_confirmation_sms
+from .models import Client, ClientAccessToken, Loan, Payment
+from .services import outbox
+from .services.client_tokens import forget_token
+from .services.collections import record_payment_collected, refresh_collection_days
+from .services.credit import (
+    invalidate_client_credit_features,
+    record_loan_created,
+    record_payment_changed,
+    record_payment_created,
+    record_payment_deleted,
+    record_status_transitions,
+)
+from .services.report_cache import invalidate_client_summaries, invalidate_reports
+from .tasks import apply_payment_effects_task, send_payment_confirmation_sms
+
+
+@receiver(pre_save, sender=Payment)
+def payment_pre_save(sender, instance, **kwargs):
+    if instance.pk:
+        previous = Payment.objects.filter(pk=instance.pk).values_list("loan_id", "amount", "paid_at").first()
+        instance._previous_values = previous
+        instance._previous_paid_at = previous[2] if previous else None
+
+
+def schedule_payment_effects(client_id: int):
+    # Loan status and the score are settled by one delayed job per client, so a burst of payments costs one
+    # rescore and the writer does no aggregate work; the payment's own counter deltas are applied inline.
+    outbox.enqueue(
+        apply_payment_effects_task,
+        client_id,
+        delay=settings.PAYMENT_EFFECTS_DELAY_SECONDS,
+        key=f"client:{client_id}",
+    )
+
+
+def _payment_client_id(payment: Payment):
+    if Payment.loan.is_cached(payment):
+        return payment.loan.client_id
+    return Loan.objects.filter(pk=payment.loan_id).values_list("client_id", flat=True).first()
 
 
 @receiver(post_save, sender=Payment)
 def payment_post_save(sender, instance, created, **kwargs):
-    instance.loan.refresh_status(commit=True)
-    recompute_client_credit(instance.loan.client)
+    client_id = _payment_client_id(instance)
+    if created:
+        record_payment_collected(instance)
+        record_payment_created(instance)
+    else:
+        refresh_collection_days(instance.paid_at, getattr(instance, "_previous_paid_at", None))
+        previous = getattr(instance, "_previous_values", None)
+        if previous:
+            # A payment moved to another client's loan changes that client's counters too.
+            for other_client_id in record_payment_changed(instance, *previous) - {client_id}:
+                schedule_payment_effects(other_client_id)
+    schedule_payment_effects(client_id)
+    invalidate_reports()
+    invalidate_client_summaries([client_id])
     if created:
-        send_payment_confirmation_sms.delay(instance.id)
+        outbox.enqueue(send_payment_confirmation_sms, instance.id)
 
 
 @receiver(post_delete, sender=Payment)
 def payment_post_delete(sender, instance, **kwargs):
-    instance.loan.refresh_status(commit=True)
-    recompute_client_credit(instance.loan.client)
+    client_id = _payment_client_id(instance)
+    refresh_collection_days(instance.paid_at)
+    record_payment_deleted(instance)
+    invalidate_reports()
+    if client_id is not None:
+        schedule_payment_effects(client_id)
+        invalidate_client_summaries([client_id])
+
+
+@receiver(pre_save, sender=Loan)
+def loan_pre_save(sender, instance, update_fields=None, **kwargs):
+    # save() recomputes the status, so any save that writes it can move a loan into or out of PAID.
+    instance._previous_status = None
+    if instance.pk and (update_fields is None or "status" in update_fields):
+        stored = Loan.objects.filter(pk=instance.pk)
+        if transaction.get_connection().in_atomic_block:
+            # Serialises with apply_payment_effects, which locks the rows it moves, so a move is counted once.
+            stored = stored.select_for_update()
+        instance._previous_status = stored.values_list("status", flat=True).first()
+
+
+@receiver(post_save, sender=Loan)
+def loan_post_save(sender, instance, created, **kwargs):
+    if created:
+        record_loan_created(instance)
+    else:
+        previous_status = getattr(instance, "_previous_status", None)
+        if previous_status and previous_status != instance.status:
+            record_status_transitions([(instance.id, previous_status, instance.status)])
+    invalidate_reports()
+    invalidate_client_summaries([instance.client_id])
+
+
+@receiver(post_delete, sender=Loan)
+def loan_post_delete(sender, instance, **kwargs):
+    invalidate_client_credit_features(instance.client_id)
+    invalidate_reports()
+    invalidate_client_summaries([instance.client_id])
+
+
+@receiver(post_save, sender=Client)
+@receiver(post_delete, sender=Client)
+def client_changed(sender, instance, **kwargs):
+    invalidate_client_summaries([instance.id])
+
+
+@receiver(post_save, sender=ClientAccessToken)
+@receiver(post_delete, sender=ClientAccessToken)
+def client_token_changed(sender, instance, **kwargs):
+    forget_token(instance.token_hash)
 
 
 @receiver(post_migrate)
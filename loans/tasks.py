@@ -1,14 +1,28 @@
 import logging
-from datetime import timedelta
 
+import requests
 from celery import shared_task
+from django.conf import settings
 from django.core.management import call_command
-from django.db import IntegrityError, transaction
+from django.db.models import F
 from django.utils import timezone
-
-from .models import AuditLog, Loan, LoanReminderLog, NotificationLog, Payment, SuspiciousActivityLog
-from .services.credit import recompute_client_credit
-from .services.sms import send_with_fallback
+from urllib3.exceptions import NewConnectionError
+
+from .models import Loan, LoanReminderLog, NotificationLog, Payment, StkPushRequest, SuspiciousActivityLog
+from .services.callbacks import (
+    apply_early_stk_result,
+    fail_stale_stk_pushes,
+    process_callback_inbox,
+    purge_callback_inbox,
+)
+from .services.credit import recompute_all_client_credit
+from .services.mpesa import get_mpesa_service
+from .services.outbox import dispatch_outbox, purge_outbox
+from .services.payment_effects import apply_payment_effects
+from .services.reconciliation import reconcile_loan_statuses
+from .services.reminder_schedule import run_reminder_schedule
+from .services.reminders import send_loan_reminders
+from .services.sms import send_batch, send_with_fallback
 
 logger = logging.getLogger(__name__)
 
@@ -30,106 +44,143 @@ def send_payment_confirmation_sms(self, payment_id: int):
         raise RuntimeError(f"Payment confirmation failed for {payment.phone}")
 
 
-@shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={"max_retries": 3})
-def send_due_soon_reminders(self):
-    target_date = timezone.localdate() + timedelta(days=1)
-    loans = Loan.objects.select_related("client").filter(
-        status=Loan.Status.ACTIVE,
-        due_date=target_date,
+def _fail_stk_push(push_id: int, reason: str):
+    StkPushRequest.objects.filter(id=push_id, state=StkPushRequest.State.SENDING).update(
+        state=StkPushRequest.State.FAILED,
+        result_desc=reason[:255],
+        updated_at=timezone.now(),
+    )
+
+
+def _never_connected(exc: requests.RequestException) -> bool:
+    # Only a connection that was never opened proves Daraja did not get the push. "Connection aborted",
+    # read timeouts and error responses can all follow a request it already accepted.
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    reason = getattr(exc.args[0], "reason", None) if exc.args else None
+    return isinstance(exc, requests.ConnectionError) and isinstance(reason, NewConnectionError)
+
+
+@shared_task(bind=True, max_retries=3)
+def send_stk_push(self, push_id: int):
+    # Claim before calling Daraja: a redelivered or republished message finds the push taken and does nothing.
+    claimed = StkPushRequest.objects.filter(id=push_id, state=StkPushRequest.State.QUEUED).update(
+        state=StkPushRequest.State.SENDING,
+        updated_at=timezone.now(),
     )
+    if not claimed:
+        return
+    push = StkPushRequest.objects.get(id=push_id)
 
-    for loan in loans:
-        loan.refresh_status(commit=True)
-        if loan.status != Loan.Status.ACTIVE:
-            continue
-
-        try:
-            with transaction.atomic():
-                reminder, created = LoanReminderLog.objects.get_or_create(
-                    loan=loan,
-                    reminder_type=LoanReminderLog.ReminderType.DUE_SOON,
-                )
-            if not created:
-                continue
-
-            message = (
-                f"Reminder: Loan #{loan.id} of KES {loan.amount} is due tomorrow "
-                f"({loan.due_date}). Please pay to avoid penalties."
+    callback_url = (
+        f"{settings.MPESA_CALLBACK_BASE_URL.rstrip('/')}"
+        f"/api/mpesa/callback/{settings.MPESA_CALLBACK_TOKEN}/{push.loan_id}/"
+    )
+    try:
+        result = get_mpesa_service().stk_push(
+            phone=push.phone,
+            amount=push.amount,
+            account_reference=f"LOAN-{push.loan_id}",
+            transaction_desc=f"Loan repayment {push.loan_id}",
+            callback_url=callback_url,
+        )
+    except requests.RequestException as exc:
+        if _never_connected(exc) and self.request.retries < self.max_retries:
+            StkPushRequest.objects.filter(id=push.id, state=StkPushRequest.State.SENDING).update(
+                state=StkPushRequest.State.QUEUED,
+                updated_at=timezone.now(),
             )
-            sent = send_with_fallback(loan.client.phone_number, message)
-            if not sent:
-                reminder.delete()
-                raise RuntimeError(f"Due-soon reminder failed for loan {loan.id}")
-        except IntegrityError:
-            continue
-        except Exception:
-            logger.exception("Failed due-soon reminder for loan %s", loan.id)
+            raise self.retry(exc=exc, countdown=2**self.request.retries)
+        logger.warning("STK push %s failed: %s", push.public_id, exc)
+        _fail_stk_push(push.id, f"Daraja unreachable: {exc}" if _never_connected(exc) else str(exc))
+        return
+
+    if str(result.get("ResponseCode")) != "0":
+        _fail_stk_push(push.id, str(result.get("ResponseDescription") or result.get("errorMessage") or "Rejected"))
+        return
+    checkout_request_id = result.get("CheckoutRequestID")
+    StkPushRequest.objects.filter(id=push.id, state=StkPushRequest.State.SENDING).update(
+        state=StkPushRequest.State.SENT,
+        checkout_request_id=checkout_request_id,
+        merchant_request_id=result.get("MerchantRequestID") or "",
+        result_desc=str(result.get("ResponseDescription") or "")[:255],
+        updated_at=timezone.now(),
+    )
+    if checkout_request_id:
+        apply_early_stk_result(push.loan_id, checkout_request_id)
+
+
+@shared_task
+def fail_stale_stk_pushes_task():
+    return fail_stale_stk_pushes()
+
+
+@shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={"max_retries": 3})
+def apply_payment_effects_task(self, client_id: int):
+    return apply_payment_effects(client_id)
+
+
+@shared_task
+def process_mpesa_callback_inbox():
+    return process_callback_inbox()
+
+
+@shared_task
+def purge_mpesa_callback_inbox():
+    return purge_callback_inbox()
+
+
+@shared_task
+def dispatch_outbox_messages():
+    return dispatch_outbox()
+
+
+@shared_task
+def purge_outbox_messages():
+    return purge_outbox()
+
+
+@shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={"max_retries": 3})
+def send_due_soon_reminders(self):
+    return send_loan_reminders(LoanReminderLog.ReminderType.DUE_SOON)
 
 
 @shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={"max_retries": 3})
 def send_overdue_reminders(self):
-    today = timezone.localdate()
-    loans = Loan.objects.select_related("client").filter(due_date__lt=today).exclude(status=Loan.Status.PAID)
-
-    for loan in loans:
-        loan.refresh_status(commit=True)
-        if loan.status != Loan.Status.OVERDUE:
-            continue
-
-        try:
-            with transaction.atomic():
-                reminder, created = LoanReminderLog.objects.get_or_create(
-                    loan=loan,
-                    reminder_type=LoanReminderLog.ReminderType.OVERDUE,
-                )
-            if not created:
-                continue
-
-            message = (
-                f"Overdue alert: Loan #{loan.id} of KES {loan.amount} was due on "
-                f"{loan.due_date}. Please clear payment immediately."
-            )
-            sent = send_with_fallback(loan.client.phone_number, message)
-            if not sent:
-                reminder.delete()
-                raise RuntimeError(f"Overdue reminder failed for loan {loan.id}")
-        except IntegrityError:
-            continue
-        except Exception:
-            logger.exception("Failed overdue reminder for loan %s", loan.id)
+    return send_loan_reminders(LoanReminderLog.ReminderType.OVERDUE)
+
+
+@shared_task
+def pace_loan_reminders():
+    return run_reminder_schedule()
 
 
 @shared_task
 def recompute_credit_scores_task():
-    for loan in Loan.objects.select_related("client").all().only("client"):
-        recompute_client_credit(loan.client)
+    return recompute_all_client_credit()
 
 
 @shared_task
 def reconcile_transactions():
-    for loan in Loan.objects.select_related("client").all():
-        previous_status = loan.status
-        loan.refresh_status(commit=True)
-        if previous_status != loan.status:
-            AuditLog.objects.create(
-                actor="system",
-                action="reconcile_status",
-                endpoint="system/reconcile",
-                method="SYSTEM",
-                status_code=200,
-                metadata={"loan_id": loan.id, "from": previous_status, "to": loan.status},
-            )
+    report = reconcile_loan_statuses()
+    logger.info(
+        "Reconciled %s loans: %s transitions %s",
+        report["scanned"],
+        report["total_transitions"],
+        report["transitions"],
+    )
+    return report
 
 
 @shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={"max_retries": 3})
 def retry_failed_notifications(self):
-    failures = NotificationLog.objects.filter(success=False).order_by("created_at")[:50]
-    for failure in failures:
-        sent = send_with_fallback(failure.phone_number, failure.message)
+    failures = list(NotificationLog.objects.filter(success=False).order_by("created_at")[:50])
+    results = send_batch([(failure.phone_number, failure.message) for failure in failures])
+    for failure, sent in zip(failures, results):
         failure.attempts += 1
         failure.success = sent
         failure.error_message = "" if sent else failure.error_message
-        failure.save(update_fields=["attempts", "success", "error_message"])
+    NotificationLog.objects.bulk_update(failures, ["attempts", "success", "error_message"])
 
 
 @shared_task
@@ -139,20 +190,19 @@ def run_daily_backup():
 
 @shared_task
 def check_suspicious_transactions():
-    for loan in Loan.objects.all():
-        if loan.total_paid > loan.amount:
-            SuspiciousActivityLog.objects.get_or_create(
-                category="OVERPAYMENT",
-                reference=f"loan:{loan.id}",
-                defaults={
-                    "severity": "HIGH",
-                    "details": {
-                        "loan_id": loan.id,
-                        "loan_amount": str(loan.amount),
-                        "total_paid": str(loan.total_paid),
-                    },
+    for loan in Loan.objects.with_financials().filter(paid_total__gt=F("amount")):
+        SuspiciousActivityLog.objects.get_or_create(
+            category="OVERPAYMENT",
+            reference=f"loan:{loan.id}",
+            defaults={
+                "severity": "HIGH",
+                "details": {
+                    "loan_id": loan.id,
+                    "loan_amount": str(loan.amount),
+                    "total_paid": str(loan.total_paid),
                 },
-            )
+            },
+        )
 
     unresolved = SuspiciousActivityLog.objects.filter(resolved=False).order_by("created_at")[:10]
     if not unresolved:
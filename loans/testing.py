@@ -0,0 +1,65 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.test import override_settings
+from django.test.runner import DiscoverRunner
+from django.utils import timezone
+
+from loans.services.client_tokens import TOKEN_CACHE_ALIAS
+from loans.services.outbox import dispatch_outbox
+from loans.services.query_budget import budget_for, collect_query_stats
+from loans.services.report_cache import REPORT_CACHE_ALIAS
+
+# File caches and directories that running workers share on a host; a test run gets its own copies.
+SHARED_CACHE_ALIASES = (REPORT_CACHE_ALIAS, TOKEN_CACHE_ALIAS)
+SHARED_DIR_SETTINGS = ("SMS_RATE_LIMIT_DIR", "MPESA_TOKEN_DIR")
+SHARED_FILE_SETTINGS = ("LATENCY_METRICS_PATH",)
+# Statements a request runs in tests but that production budgets never see: the audit INSERT happens outside
+# QueryBudgetMiddleware, and TestCase's wrapping transaction turns each view's atomic() into a savepoint.
+UNBUDGETED_STATEMENTS = ('INSERT INTO "loans_auditlog"', "SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+
+
+class TestRunner(DiscoverRunner):
+    """Points the host-shared file caches, state directories and files at a temporary directory for the run, so
+    tests neither read nor clear the state of processes running on the same machine."""
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._cache_dir = tempfile.TemporaryDirectory(prefix="weito-tests-")
+        caches = {**settings.CACHES}
+        for alias in SHARED_CACHE_ALIASES:
+            caches[alias] = {**caches[alias], "LOCATION": os.path.join(self._cache_dir.name, alias)}
+        directories = {name: os.path.join(self._cache_dir.name, name.lower()) for name in SHARED_DIR_SETTINGS}
+        files = {
+            name: os.path.join(self._cache_dir.name, os.path.basename(getattr(settings, name)))
+            for name in SHARED_FILE_SETTINGS
+        }
+        self._cache_settings = override_settings(CACHES=caches, **directories, **files)
+        self._cache_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self._cache_settings.disable()
+        self._cache_dir.cleanup()
+        super().teardown_test_environment(**kwargs)
+
+
+class QueryBudgetAssertionsMixin:
+    @contextmanager
+    def assertWithinQueryBudget(self, url_name: str):
+        with collect_query_stats(capture_sql=True) as stats:
+            yield stats
+        statements = [sql for sql in stats.statements if not sql.startswith(UNBUDGETED_STATEMENTS)]
+        budget = budget_for(url_name)
+        if len(statements) > budget:
+            listing = "\n".join(f"{index}. {sql}" for index, sql in enumerate(statements, start=1))
+            self.fail(f"{url_name} ran {len(statements)} queries, budget is {budget}:\n{listing}")
+
+
+class InlineOutboxMixin:
+    def drain_outbox(self):
+        """Run every pending outbox message in-process, including ones whose delay has not elapsed."""
+        with override_settings(OUTBOX_DISPATCH_MODE="inline"):
+            return dispatch_outbox(now=timezone.now() + timedelta(days=1))
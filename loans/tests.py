@@ -1,21 +1,93 @@
-from datetime import timedelta
+import json
+import os
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, time as dt_time, timedelta
 from decimal import Decimal
+from io import StringIO
 from unittest.mock import patch
 
+import requests
+from cryptography.fernet import Fernet
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, transaction
+from django.db.models import F
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 from rest_framework import status
 from rest_framework.test import APITestCase
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
 
-from loans.models import Client, Loan, LoanReminderLog, Payment, SuspiciousActivityLog
-from loans.tasks import send_due_soon_reminders
+from loans.models import (
+	AuditLog,
+	Client,
+	ClientAccessToken,
+	ClientCreditFeatures,
+	DailyCollectionRollup,
+	Loan,
+	LoanReminderLog,
+	MpesaCallbackInbox,
+	NotificationLog,
+	OutboxMessage,
+	Payment,
+	PaymentPayload,
+	ReminderRun,
+	StkPushRequest,
+	SuspiciousActivityLog,
+	_fernet_instance,
+	field_encryption_keys,
+)
+from loans.pagination import encode_cursor
+from loans.services.audit import AuditBuffer
+from loans.services.callbacks import apply_early_stk_result, process_callback_inbox, record_callback
+from loans.services.client_tokens import TOKEN_CACHE_ALIAS, LastUsedTracker, get_last_used_tracker
+from loans.services.collections import verify_collection_rollups
+from loans.services.key_rotation import rotate_tokens
+from loans.services.latency import LatencyHistogram, get_latency_histogram, latency_report, render_prometheus
+from loans.services.mpesa import MpesaService, get_mpesa_service
+from loans.services.outbox import dispatch_outbox, purge_outbox
+from loans.services.credit import (
+	recompute_all_client_credit,
+	recompute_client_credit,
+	verify_client_credit_features,
+)
+from loans.services.reconciliation import apply_status_transitions
+from loans.services.reminder_schedule import run_reminder_schedule
+from loans.services.report_cache import (
+	REPORT_CACHE_ALIAS,
+	clear_report_cache,
+	client_summary_version,
+	current_report_version,
+)
+from loans.services.sms import RateLimiter, _twilio_client, send_batch
+from loans.testing import InlineOutboxMixin, QueryBudgetAssertionsMixin
+from loans.tasks import (
+	apply_payment_effects_task,
+	check_suspicious_transactions,
+	fail_stale_stk_pushes_task,
+	process_mpesa_callback_inbox,
+	purge_mpesa_callback_inbox,
+	reconcile_transactions,
+	recompute_credit_scores_task,
+	send_due_soon_reminders,
+	send_overdue_reminders,
+	send_payment_confirmation_sms,
+	send_stk_push,
+)
 
 
 @override_settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True, CELERY_TASK_STORE_EAGER_RESULT=False)
-class LoanAutomationIntegrationTests(APITestCase):
+class LoanAutomationIntegrationTests(InlineOutboxMixin, APITestCase):
 	def setUp(self):
+		clear_report_cache()
 		self.client_record = Client(name="John Doe", phone_number="254700000001")
 		self.client_record.set_id_number("12345678")
 		self.client_record.save()
@@ -34,8 +106,7 @@ class LoanAutomationIntegrationTests(APITestCase):
 		self.assertEqual(loan.status, Loan.Status.ACTIVE)
 
 	@override_settings(MPESA_CALLBACK_TOKEN="test-token", MPESA_WEBHOOK_SECRET="")
-	@patch("loans.signals.send_payment_confirmation_sms.delay")
-	def test_payment_webhook_creates_payment_and_marks_loan_paid(self, _mock_delay):
+	def test_payment_webhook_creates_payment_and_marks_loan_paid(self):
 		loan = self.create_loan(amount="1000.00")
 		url = reverse("mpesa-callback", kwargs={"token": "test-token", "loan_id": loan.id})
 		payload = {
@@ -54,6 +125,8 @@ class LoanAutomationIntegrationTests(APITestCase):
 		}
 
 		response = self.client.post(url, payload, format="json")
+		process_mpesa_callback_inbox()
+		self.drain_outbox()
 		loan.refresh_from_db()
 
 		self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -61,8 +134,7 @@ class LoanAutomationIntegrationTests(APITestCase):
 		self.assertEqual(loan.status, Loan.Status.PAID)
 
 	@override_settings(MPESA_CALLBACK_TOKEN="test-token", MPESA_WEBHOOK_SECRET="")
-	@patch("loans.signals.send_payment_confirmation_sms.delay")
-	def test_duplicate_webhook_receipt_is_ignored(self, _mock_delay):
+	def test_duplicate_webhook_receipt_is_ignored(self):
 		loan = self.create_loan(amount="500.00")
 		url = reverse("mpesa-callback", kwargs={"token": "test-token", "loan_id": loan.id})
 		payload = {
@@ -82,6 +154,7 @@ class LoanAutomationIntegrationTests(APITestCase):
 
 		self.client.post(url, payload, format="json")
 		self.client.post(url, payload, format="json")
+		process_mpesa_callback_inbox()
 
 		self.assertEqual(Payment.objects.filter(loan=loan, mpesa_receipt="DUPL111").count(), 1)
 		self.assertTrue(
@@ -90,8 +163,7 @@ class LoanAutomationIntegrationTests(APITestCase):
 		)
 
 	@override_settings(MPESA_CALLBACK_TOKEN="test-token", MPESA_WEBHOOK_SECRET="")
-	@patch("loans.signals.send_payment_confirmation_sms.delay")
-	def test_overpayment_attempt_is_blocked_and_logged(self, _mock_delay):
+	def test_overpayment_attempt_is_blocked_and_logged(self):
 		loan = self.create_loan(amount="500.00")
 		url = reverse("mpesa-callback", kwargs={"token": "test-token", "loan_id": loan.id})
 		payload = {
@@ -110,15 +182,140 @@ class LoanAutomationIntegrationTests(APITestCase):
 		}
 
 		response = self.client.post(url, payload, format="json")
+		process_mpesa_callback_inbox()
 		self.assertEqual(response.status_code, status.HTTP_200_OK)
 		self.assertFalse(Payment.objects.filter(mpesa_receipt="OVERP1").exists())
 		self.assertTrue(
 			SuspiciousActivityLog.objects.filter(category="OVERPAYMENT_ATTEMPT", reference=f"loan:{loan.id}").exists()
 		)
 
-	@patch("loans.signals.send_payment_confirmation_sms.delay")
-	@patch("loans.tasks.send_with_fallback", return_value=True)
-	def test_due_soon_reminder_schedules_once_and_skips_paid_loans(self, _mock_notify, _mock_delay):
+	def callback_payload(self, receipt, amount):
+		return {
+			"Body": {
+				"stkCallback": {
+					"MerchantRequestID": f"29115-{receipt}",
+					"CheckoutRequestID": f"ws_CO_{receipt}",
+					"ResultCode": 0,
+					"ResultDesc": "The service request is processed successfully.",
+					"CallbackMetadata": {
+						"Item": [
+							{"Name": "Amount", "Value": amount},
+							{"Name": "MpesaReceiptNumber", "Value": receipt},
+							{"Name": "PhoneNumber", "Value": 254700000001},
+						]
+					},
+				}
+			}
+		}
+
+	@override_settings(MPESA_CALLBACK_TOKEN="test-token", MPESA_WEBHOOK_SECRET="")
+	def test_payment_webhook_acknowledges_with_single_insert(self):
+		loan = self.create_loan(amount="1000.00")
+		push = StkPushRequest.objects.create(
+			loan=loan, phone="254700000001", amount=Decimal("100.00"), state=StkPushRequest.State.SENT, checkout_request_id="ws_CO_FAST1"
+		)
+		url = reverse("mpesa-callback", kwargs={"token": "test-token", "loan_id": loan.id})
+
+		with CaptureQueriesContext(connection) as captured:
+			response = self.client.post(url, self.callback_payload("FAST1", 100), format="json")
+
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		inbox_queries = [query["sql"] for query in captured if "loans_auditlog" not in query["sql"]]
+		self.assertEqual(len(inbox_queries), 1)
+		self.assertTrue(inbox_queries[0].startswith('INSERT INTO "loans_mpesacallbackinbox"'))
+		self.assertFalse(Payment.objects.filter(mpesa_receipt="FAST1").exists())
+
+		process_mpesa_callback_inbox()
+		push.refresh_from_db()
+		self.assertEqual((push.state, push.result_code), (StkPushRequest.State.COMPLETED, 0))
+		self.assertTrue(Payment.objects.filter(mpesa_receipt="FAST1").exists())
+
+	def test_inbox_drain_applies_batch_and_dedupes_receipts(self):
+		loan = self.create_loan(amount="1000.00")
+		for receipt, amount in [("BATCH1", 400), ("BATCH2", 600), ("BATCH1", 400), ("BATCH3", 50)]:
+			record_callback(loan.id, self.callback_payload(receipt, amount))
+		record_callback(loan.id, {"Body": {"stkCallback": {"ResultCode": 1032}}})
+
+		report = process_mpesa_callback_inbox()
+		self.drain_outbox()
+		loan.refresh_from_db()
+
+		self.assertEqual(report[MpesaCallbackInbox.Status.APPLIED], 2)
+		self.assertEqual(report[MpesaCallbackInbox.Status.DUPLICATE], 1)
+		self.assertEqual(report[MpesaCallbackInbox.Status.REJECTED], 1)
+		self.assertEqual(report[MpesaCallbackInbox.Status.IGNORED], 1)
+		self.assertEqual(loan.status, Loan.Status.PAID)
+		self.assertEqual(Payment.objects.filter(loan=loan).count(), 2)
+		self.assertTrue(SuspiciousActivityLog.objects.filter(category="DUPLICATE_RECEIPT", reference="BATCH1").exists())
+		self.assertFalse(MpesaCallbackInbox.objects.filter(status=MpesaCallbackInbox.Status.PENDING).exists())
+		self.assertEqual(process_mpesa_callback_inbox(), {})
+
+	def test_malformed_callbacks_do_not_block_the_batch(self):
+		loan = self.create_loan(amount="1000.00")
+		record_callback(loan.id, [{"Body": "not a callback"}])
+		record_callback(loan.id, {"Body": {"stkCallback": {"ResultCode": 0, "CallbackMetadata": {"Item": "oops"}}}})
+		record_callback(loan.id, {"Body": ["stkCallback"]})
+		record_callback(loan.id, self.callback_payload("NAN1", "NaN"))
+		record_callback(loan.id, self.callback_payload("GOOD1", 300))
+
+		report = process_mpesa_callback_inbox()
+
+		self.assertEqual(report[MpesaCallbackInbox.Status.IGNORED], 3)
+		self.assertEqual(report[MpesaCallbackInbox.Status.REJECTED], 1)
+		self.assertEqual(report[MpesaCallbackInbox.Status.APPLIED], 1)
+		self.assertTrue(SuspiciousActivityLog.objects.filter(category="INVALID_AMOUNT", details__receipt="NAN1").exists())
+		self.assertEqual(list(Payment.objects.values_list("mpesa_receipt", flat=True)), ["GOOD1"])
+		self.assertFalse(MpesaCallbackInbox.objects.filter(status=MpesaCallbackInbox.Status.PENDING).exists())
+
+	@override_settings(MPESA_INBOX_MAX_ATTEMPTS=2)
+	def test_failed_callbacks_are_retried_with_backoff(self):
+		loan = self.create_loan(amount="1000.00")
+		entry = record_callback(loan.id, self.callback_payload("RETRY1", 300))
+		now = timezone.now()
+
+		with patch("loans.services.callbacks.Payment.objects.create", side_effect=OperationalError("database is locked")):
+			self.assertEqual(process_mpesa_callback_inbox(), {MpesaCallbackInbox.Status.FAILED: 1})
+		entry.refresh_from_db()
+		self.assertEqual((entry.status, entry.attempts), (MpesaCallbackInbox.Status.PENDING, 1))
+		self.assertIn("database is locked", entry.last_error)
+		self.assertGreater(entry.available_at, now)
+		self.assertEqual(process_mpesa_callback_inbox(), {})
+
+		report = process_callback_inbox(now=now + timedelta(minutes=1))
+		entry.refresh_from_db()
+		self.assertEqual(report, {MpesaCallbackInbox.Status.APPLIED: 1})
+		self.assertEqual((entry.status, entry.last_error), (MpesaCallbackInbox.Status.APPLIED, ""))
+		self.assertTrue(Payment.objects.filter(mpesa_receipt="RETRY1").exists())
+
+		stuck = record_callback(loan.id, self.callback_payload("RETRY2", 100))
+		with patch("loans.services.callbacks.Payment.objects.create", side_effect=OperationalError("database is locked")):
+			process_callback_inbox(now=now + timedelta(minutes=1))
+			process_callback_inbox(now=now + timedelta(minutes=2))
+		stuck.refresh_from_db()
+		self.assertEqual((stuck.status, stuck.attempts), (MpesaCallbackInbox.Status.FAILED, 2))
+		self.assertEqual(process_callback_inbox(now=now + timedelta(days=1)), {})
+
+	def test_purge_drops_old_settled_callbacks_only(self):
+		loan = self.create_loan(amount="1000.00")
+		now = timezone.now()
+		settled = [record_callback(loan.id, self.callback_payload(f"PURGE{index}", 10)) for index in range(3)]
+		recent = record_callback(loan.id, self.callback_payload("PURGE9", 10))
+		process_mpesa_callback_inbox()
+		MpesaCallbackInbox.objects.filter(id__in=[entry.id for entry in settled]).update(processed_at=now - timedelta(days=31))
+		failed = record_callback(loan.id, {})
+		pending = record_callback(loan.id, {})
+		MpesaCallbackInbox.objects.filter(id=failed.id).update(
+			status=MpesaCallbackInbox.Status.FAILED,
+			processed_at=now - timedelta(days=60),
+		)
+
+		with override_settings(MPESA_INBOX_RETENTION_DAYS=30):
+			self.assertEqual(purge_mpesa_callback_inbox(), len(settled))
+		self.assertEqual(set(MpesaCallbackInbox.objects.values_list("id", flat=True)), {recent.id, failed.id, pending.id})
+		self.assertEqual(Payment.objects.filter(loan=loan).count(), 4)
+
+	@patch("loans.services.reminders.send_batch", side_effect=lambda messages: [True for _message in messages])
+	def test_due_soon_reminder_schedules_once_and_skips_paid_loans(self, _mock_notify):
 		due_soon_loan = self.create_loan(amount="1000.00", due_date=timezone.localdate() + timedelta(days=1))
 		paid_loan = self.create_loan(amount="1000.00", due_date=timezone.localdate() + timedelta(days=1))
 
@@ -129,6 +326,7 @@ class LoanAutomationIntegrationTests(APITestCase):
 			phone=self.client_record.phone_number,
 			raw_payload={},
 		)
+		self.drain_outbox()
 		paid_loan.refresh_from_db()
 		self.assertEqual(paid_loan.status, Loan.Status.PAID)
 
@@ -162,3 +360,1849 @@ class LoanAutomationIntegrationTests(APITestCase):
 		auth = self.client.get(reverse("system-metrics"))
 		self.assertEqual(auth.status_code, status.HTTP_200_OK)
 		self.assertIn("loan_count", auth.data)
+
+	def test_reconcile_transactions_applies_transitions_in_bulk(self):
+		overdue_loan = self.create_loan(amount="1000.00", due_date=timezone.localdate() - timedelta(days=3))
+		paid_loan = self.create_loan(amount="500.00")
+		untouched_loan = self.create_loan(amount="700.00")
+		Loan.objects.filter(id__in=[overdue_loan.id, paid_loan.id]).update(status=Loan.Status.ACTIVE)
+		Payment.objects.bulk_create(
+			[Payment(loan=paid_loan, amount=Decimal("500.00"), mpesa_receipt="RECON1", phone="254700000001")]
+		)
+
+		with self.assertNumQueries(11):
+			report = reconcile_transactions()
+
+		self.assertEqual(report["scanned"], 3)
+		self.assertEqual(report["transitions"][Loan.Status.OVERDUE], 1)
+		self.assertEqual(report["transitions"][Loan.Status.PAID], 1)
+		self.assertEqual(Loan.objects.get(id=overdue_loan.id).status, Loan.Status.OVERDUE)
+		self.assertEqual(Loan.objects.get(id=paid_loan.id).status, Loan.Status.PAID)
+		self.assertEqual(Loan.objects.get(id=untouched_loan.id).status, Loan.Status.ACTIVE)
+		self.assertEqual(AuditLog.objects.filter(action="reconcile_status").count(), 2)
+		self.assertEqual(reconcile_transactions()["total_transitions"], 0)
+
+	def test_transitions_changed_concurrently_are_not_counted_or_audited(self):
+		loan = self.create_loan(amount="500.00", due_date=timezone.localdate() - timedelta(days=3))
+		Loan.objects.filter(id=loan.id).update(status=Loan.Status.PAID)
+		counts = {status: 0 for status in Loan.Status.values}
+
+		apply_status_transitions([(loan.id, loan.client_id, Loan.Status.ACTIVE, Loan.Status.OVERDUE)], counts)
+
+		self.assertEqual(counts[Loan.Status.OVERDUE], 0)
+		self.assertEqual(Loan.objects.get(id=loan.id).status, Loan.Status.PAID)
+		self.assertFalse(AuditLog.objects.filter(action="reconcile_status").exists())
+
+
+class LoanFinancialsQueryCountTests(APITestCase):
+	def setUp(self):
+		cache.clear()
+		self.client_record = Client.objects.create(name="Jane Doe", phone_number="254700000002")
+		self.staff_user = get_user_model().objects.create_superuser(
+			username="officer",
+			email="officer@example.com",
+			password="secure-pass-123",
+		)
+		self.receipt_counter = 0
+
+	def add_loans(self, count, due_date):
+		for _ in range(count):
+			loan = Loan.objects.create(client=self.client_record, amount=Decimal("1000.00"), due_date=due_date)
+			self.receipt_counter += 1
+			Payment.objects.bulk_create(
+				[
+					Payment(
+						loan=loan,
+						amount=Decimal("250.00"),
+						mpesa_receipt=f"FIN{self.receipt_counter}",
+						phone=self.client_record.phone_number,
+					)
+				]
+			)
+
+	def count_queries(self, func):
+		cache.clear()
+		clear_report_cache()
+		with CaptureQueriesContext(connection) as captured:
+			func()
+		return len(captured)
+
+	def assertConstantQueries(self, func, due_date):
+		self.add_loans(1, due_date)
+		baseline = self.count_queries(func)
+		self.add_loans(9, due_date)
+		self.assertEqual(self.count_queries(func), baseline)
+
+	def test_with_financials_annotations_back_the_properties(self):
+		self.add_loans(1, timezone.localdate() - timedelta(days=1))
+		loan = Loan.objects.with_financials().get()
+		with self.assertNumQueries(0):
+			self.assertEqual(loan.total_paid, Decimal("250.00"))
+			self.assertEqual(loan.balance, Decimal("750.00"))
+			self.assertIsNotNone(loan.latest_payment_at)
+			self.assertEqual(loan.computed_status, Loan.Status.OVERDUE)
+
+	def test_client_summary_query_count_is_constant(self):
+		_token, raw_token = ClientAccessToken.create_token(self.client_record)
+		self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {raw_token}")
+		self.assertConstantQueries(
+			lambda: self.client.get(reverse("client-loan-summary")),
+			timezone.localdate() + timedelta(days=7),
+		)
+
+	def test_outstanding_report_query_count_is_constant(self):
+		self.client.force_authenticate(user=self.staff_user)
+		self.assertConstantQueries(
+			lambda: self.client.get(reverse("report-outstanding-loans")),
+			timezone.localdate() + timedelta(days=7),
+		)
+		response = self.client.get(reverse("report-outstanding-loans"))
+		self.assertEqual(response.data["outstanding_loans_count"], 10)
+		self.assertEqual(response.data["outstanding_total"], Decimal("7500.00"))
+
+	def test_overdue_report_query_count_is_constant(self):
+		self.client.force_authenticate(user=self.staff_user)
+		self.assertConstantQueries(
+			lambda: self.client.get(reverse("report-overdue-loans")),
+			timezone.localdate() - timedelta(days=2),
+		)
+
+	def test_check_suspicious_transactions_query_count_is_constant(self):
+		self.assertConstantQueries(check_suspicious_transactions, timezone.localdate() + timedelta(days=7))
+
+
+class CreditScoringTests(APITestCase):
+	def setUp(self):
+		self.today = timezone.localdate()
+		self.receipt_counter = 0
+
+	def pay(self, loan, amount, days_from_due):
+		self.receipt_counter += 1
+		paid_at = timezone.make_aware(
+			timezone.datetime.combine(loan.due_date + timedelta(days=days_from_due), timezone.datetime.min.time())
+		)
+		Payment.objects.bulk_create(
+			[
+				Payment(
+					loan=loan,
+					amount=Decimal(amount),
+					mpesa_receipt=f"CRD{self.receipt_counter}",
+					phone="254700000100",
+					paid_at=paid_at,
+				)
+			]
+		)
+
+	def build_portfolio(self):
+		clients = [Client.objects.create(name=f"Client {i}", phone_number=f"25470000010{i}") for i in range(4)]
+		on_time = Loan.objects.create(client=clients[0], amount=Decimal("1000.00"), due_date=self.today - timedelta(days=10))
+		self.pay(on_time, "400.00", -5)
+		self.pay(on_time, "600.00", -1)
+		late = Loan.objects.create(client=clients[0], amount=Decimal("500.00"), due_date=self.today - timedelta(days=20))
+		self.pay(late, "500.00", 3)
+		Loan.objects.create(client=clients[0], amount=Decimal("800.00"), due_date=self.today + timedelta(days=5))
+		partial = Loan.objects.create(client=clients[1], amount=Decimal("2000.00"), due_date=self.today - timedelta(days=1))
+		self.pay(partial, "300.00", -3)
+		Loan.objects.create(client=clients[2], amount=Decimal("700.00"), due_date=self.today + timedelta(days=3))
+		Loan.objects.filter(id__in=[on_time.id, late.id]).update(status=Loan.Status.PAID)
+		return clients
+
+	def test_batch_scoring_matches_per_client_function(self):
+		clients = self.build_portfolio()
+		expected = {}
+		for client in clients:
+			recompute_client_credit(client)
+			expected[client.id] = (client.credit_score, client.max_loan_limit)
+		Client.objects.update(credit_score=0, max_loan_limit=Decimal("1.00"))
+
+		report = recompute_credit_scores_task()
+
+		self.assertEqual(report, {"scanned": 4, "updated": 4})
+		actual = {client.id: (client.credit_score, client.max_loan_limit) for client in Client.objects.all()}
+		self.assertEqual(actual, expected)
+		self.assertEqual(recompute_credit_scores_task(), {"scanned": 4, "updated": 0})
+
+	def test_scores_keep_the_original_repayment_ratio(self):
+		client = Client.objects.create(name="Parity Client", phone_number="254700000150")
+		loan = Loan.objects.create(client=client, amount=Decimal("1000.00"), due_date=self.today - timedelta(days=10))
+		self.pay(loan, "500.00", -2)
+		self.pay(loan, "500.00", -1)
+		Loan.objects.filter(id=loan.id).update(status=Loan.Status.PAID)
+
+		# completion 40 + timeliness 40 + 20 * (1000 repaid / 2000 due across the join).
+		recompute_client_credit(client)
+		self.assertEqual((client.credit_score, client.max_loan_limit), (90, Decimal("9500.00")))
+		recompute_credit_scores_task()
+		client.refresh_from_db()
+		self.assertEqual(client.credit_score, 90)
+
+	def test_batch_scoring_query_count_is_per_chunk(self):
+		self.build_portfolio()
+		Client.objects.update(credit_score=0, max_loan_limit=Decimal("1.00"))
+		with self.assertNumQueries(4):
+			recompute_all_client_credit(chunk_size=1000)
+
+
+class CreditCountersTests(InlineOutboxMixin, APITestCase):
+	def setUp(self):
+		clear_report_cache()
+		self.client_record = Client.objects.create(name="Counter Client", phone_number="254700000200")
+		self.today = timezone.localdate()
+
+	def create_payment(self, loan, amount, receipt):
+		payment = Payment.objects.create(
+			loan=loan,
+			amount=Decimal(amount),
+			mpesa_receipt=receipt,
+			phone=self.client_record.phone_number,
+		)
+		self.drain_outbox()
+		return payment
+
+	def test_counters_follow_payment_events_and_match_full_recompute(self):
+		on_time = Loan.objects.create(client=self.client_record, amount=Decimal("1000.00"), due_date=self.today + timedelta(days=3))
+		late = Loan.objects.create(client=self.client_record, amount=Decimal("600.00"), due_date=self.today - timedelta(days=3))
+		self.create_payment(on_time, "400.00", "CNT1")
+		self.create_payment(on_time, "600.00", "CNT2")
+		late_payment = self.create_payment(late, "600.00", "CNT3")
+
+		features = ClientCreditFeatures.objects.get(client=self.client_record)
+		# The two-payment loan counts twice towards total_due, as in the original scoring aggregate.
+		self.assertEqual(features.as_tuple(), (2, 2, 1, Decimal("2600.00"), Decimal("1600.00")))
+		self.assertEqual(list(verify_client_credit_features()), [])
+
+		late_payment.delete()
+		self.drain_outbox()
+		features = ClientCreditFeatures.objects.get(client=self.client_record)
+		self.assertEqual(features.as_tuple(), (2, 1, 1, Decimal("2600.00"), Decimal("1000.00")))
+		self.assertEqual(list(verify_client_credit_features()), [])
+
+		self.client_record.refresh_from_db()
+		incremental = (self.client_record.credit_score, self.client_record.max_loan_limit)
+		recompute_client_credit(self.client_record)
+		self.assertEqual(incremental, (self.client_record.credit_score, self.client_record.max_loan_limit))
+
+	def test_payment_event_does_not_scan_other_loans(self):
+		loan = Loan.objects.create(client=self.client_record, amount=Decimal("1000.00"), due_date=self.today + timedelta(days=3))
+		for _ in range(5):
+			Loan.objects.create(client=self.client_record, amount=Decimal("100.00"), due_date=self.today + timedelta(days=3))
+		with CaptureQueriesContext(connection) as captured:
+			Payment.objects.create(loan=loan, amount=Decimal("100.00"), mpesa_receipt="CNT10", phone="254700000200")
+		self.assertFalse(any('WHERE "loans_loan"."client_id"' in query["sql"] for query in captured))
+		# The payment's own deltas are one UPDATE; the rescore is deferred to the per-client job.
+		features_queries = [query["sql"] for query in captured if '"loans_clientcreditfeatures"' in query["sql"]]
+		self.assertEqual(len(features_queries), 1)
+		self.assertTrue(features_queries[0].startswith('UPDATE "loans_clientcreditfeatures"'))
+		self.assertFalse(any(query["sql"].startswith('UPDATE "loans_client"') for query in captured))
+		self.assertEqual(ClientCreditFeatures.objects.get(client=self.client_record).total_repaid, Decimal("100.00"))
+
+	def test_counters_follow_edits_moves_and_on_time_changes(self):
+		paid = Loan.objects.create(client=self.client_record, amount=Decimal("500.00"), due_date=self.today + timedelta(days=3))
+		other = Loan.objects.create(client=self.client_record, amount=Decimal("800.00"), due_date=self.today + timedelta(days=3))
+		payment = self.create_payment(paid, "500.00", "CNT40")
+		self.create_payment(paid, "50.00", "CNT41")
+		self.assertEqual(list(verify_client_credit_features()), [])
+
+		payment.paid_at = timezone.now() + timedelta(days=10)
+		payment.save()
+		self.drain_outbox()
+		self.assertEqual(ClientCreditFeatures.objects.get(client=self.client_record).paid_on_time, 0)
+		self.assertEqual(list(verify_client_credit_features()), [])
+
+		payment.loan = other
+		payment.amount = Decimal("300.00")
+		payment.save()
+		self.drain_outbox()
+		self.assertEqual(list(verify_client_credit_features()), [])
+
+	def test_status_saved_through_loan_save_moves_the_counters(self):
+		loan = Loan.objects.create(client=self.client_record, amount=Decimal("500.00"), due_date=self.today + timedelta(days=3))
+		Payment.objects.create(loan=loan, amount=Decimal("500.00"), mpesa_receipt="CNT60", phone=self.client_record.phone_number)
+		self.assertEqual(Loan.objects.get(pk=loan.pk).status, Loan.Status.ACTIVE)
+
+		# The loan is saved before the debounced payment-effects job gets to it.
+		loan = Loan.objects.get(pk=loan.pk)
+		loan.save(update_fields=["status"])
+		features = ClientCreditFeatures.objects.get(client=self.client_record)
+		self.assertEqual((loan.status, features.loans_paid, features.paid_on_time), (Loan.Status.PAID, 1, 1))
+
+		self.drain_outbox()
+		features.refresh_from_db()
+		self.assertEqual((features.loans_paid, features.paid_on_time), (1, 1))
+		self.assertEqual(list(verify_client_credit_features()), [])
+
+	@patch("loans.tasks.send_with_fallback", return_value=True)
+	def test_burst_of_payments_schedules_one_job_per_client(self, _mock_notify):
+		loan = Loan.objects.create(client=self.client_record, amount=Decimal("1000.00"), due_date=self.today + timedelta(days=3))
+		for index in range(4):
+			Payment.objects.create(loan=loan, amount=Decimal("100.00"), mpesa_receipt=f"CNT3{index}", phone="254700000200")
+		effects = OutboxMessage.objects.filter(task=apply_payment_effects_task.name)
+		self.assertEqual(list(effects.values_list("args", flat=True)), [[self.client_record.id]])
+		self.assertEqual(OutboxMessage.objects.filter(task=send_payment_confirmation_sms.name).count(), 4)
+
+		self.assertEqual(self.drain_outbox(), {OutboxMessage.Status.DISPATCHED: 5})
+		self.assertEqual(ClientCreditFeatures.objects.get(client=self.client_record).total_repaid, Decimal("400.00"))
+		self.create_payment(loan, "100.00", "CNT39")
+		self.assertEqual(effects.count(), 2)
+		self.assertEqual(ClientCreditFeatures.objects.get(client=self.client_record).total_repaid, Decimal("500.00"))
+
+	def test_debounced_job_rescores_from_counters_without_rescanning(self):
+		loan = Loan.objects.create(client=self.client_record, amount=Decimal("1000.00"), due_date=self.today + timedelta(days=3))
+		for index in range(3):
+			Loan.objects.create(client=self.client_record, amount=Decimal("100.00"), due_date=self.today + timedelta(days=3))
+		Payment.objects.create(loan=loan, amount=Decimal("400.00"), mpesa_receipt="CNT50", phone="254700000200")
+		Payment.objects.create(loan=loan, amount=Decimal("600.00"), mpesa_receipt="CNT51", phone="254700000200")
+
+		with CaptureQueriesContext(connection) as captured:
+			with self.assertNumQueries(10):
+				report = apply_payment_effects_task(self.client_record.id)
+		self.assertEqual(report["transitions"], 1)
+		# The counters are moved by the transition only; nothing is rebuilt from the loan and payment tables.
+		self.assertFalse(any(query["sql"].startswith(("INSERT", "DELETE")) for query in captured))
+		features = ClientCreditFeatures.objects.get(client=self.client_record)
+		self.assertEqual(features.as_tuple(), (4, 1, 1, Decimal("2300.00"), Decimal("1000.00")))
+		self.assertEqual(list(verify_client_credit_features()), [])
+
+	def test_rebuild_command_checks_and_repairs_drift(self):
+		loan = Loan.objects.create(client=self.client_record, amount=Decimal("1000.00"), due_date=self.today + timedelta(days=3))
+		self.create_payment(loan, "250.00", "CNT20")
+		ClientCreditFeatures.objects.filter(client=self.client_record).update(total_repaid=Decimal("1.00"))
+
+		with self.assertRaises(CommandError):
+			call_command("rebuild_credit_features", "--check", stdout=StringIO())
+		call_command("rebuild_credit_features", stdout=StringIO())
+		call_command("rebuild_credit_features", "--check", stdout=StringIO())
+		self.assertEqual(ClientCreditFeatures.objects.get(client=self.client_record).total_repaid, Decimal("250.00"))
+
+
+class AuditBufferTests(APITestCase):
+	def make_entry(self, index):
+		return AuditLog(actor="tester", action=f"GET /api/{index}/", endpoint=f"/api/{index}/", method="GET", status_code=200)
+
+	def test_buffer_flushes_in_bulk_and_counts_rows(self):
+		buffer = AuditBuffer(max_size=100, batch_size=1000, flush_interval=3600)
+		for index in range(5):
+			buffer.add(self.make_entry(index))
+
+		with self.assertNumQueries(1):
+			self.assertEqual(buffer.flush(), 5)
+		self.assertEqual(AuditLog.objects.filter(actor="tester").count(), 5)
+		self.assertEqual(buffer.stats(), {"pending": 0, "flushed": 5, "dropped": 0, "failed": 0})
+
+	def test_overflow_policies(self):
+		oldest = AuditBuffer(max_size=2, batch_size=1000, flush_interval=3600, overflow_policy="drop_oldest")
+		newest = AuditBuffer(max_size=2, batch_size=1000, flush_interval=3600, overflow_policy="drop_newest")
+		for index in range(3):
+			oldest.add(self.make_entry(index))
+			newest.add(self.make_entry(index))
+
+		self.assertEqual([entry.endpoint for entry in oldest._entries], ["/api/1/", "/api/2/"])
+		self.assertEqual([entry.endpoint for entry in newest._entries], ["/api/0/", "/api/1/"])
+		self.assertEqual(oldest.stats()["dropped"], 1)
+		self.assertEqual(newest.stats()["dropped"], 1)
+
+	@override_settings(AUDIT_LOG_MODE="sync")
+	def test_sync_mode_writes_audit_row_per_request(self):
+		self.client.get(reverse("system-health"))
+		self.assertTrue(AuditLog.objects.filter(endpoint=reverse("system-health")).exists())
+
+
+class LatencyHistogramTests(APITestCase):
+	def setUp(self):
+		self.tempdir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.tempdir.cleanup)
+		self.metrics_path = os.path.join(self.tempdir.name, "latency.bin")
+		override = override_settings(LATENCY_METRICS_PATH=self.metrics_path, SYSTEM_AUTOMATION_TOKEN="scrape-token")
+		override.enable()
+		self.addCleanup(override.disable)
+
+	def test_histogram_is_shared_through_the_mapped_file(self):
+		writer = LatencyHistogram(self.metrics_path, max_series=8, window_minutes=15)
+		reader = LatencyHistogram(self.metrics_path, max_series=8, window_minutes=15)
+		for duration in [3] * 90 + [120] * 8 + [4000] * 2:
+			writer.record("GET", "/api/reports/overdue-loans/", 200, duration)
+		writer.record("GET", "/api/reports/overdue-loans/", 500, 30)
+
+		report = latency_report(reader)
+		self.assertEqual(report["overall"]["count"], 101)
+		self.assertEqual(report["errors"], 1)
+		ok_series = [row for row in report["endpoints"] if row["status"] == 200][0]
+		self.assertLessEqual(ok_series["p50"], 5)
+		self.assertTrue(100 <= ok_series["p95"] <= 150)
+		self.assertTrue(2500 <= ok_series["p99"] <= 5000)
+
+	def test_prometheus_endpoint_needs_token_and_no_database(self):
+		get_latency_histogram().record("POST", "/api/mpesa/stk-push/", 200, 42)
+		url = reverse("system-metrics-prometheus")
+
+		self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+		with CaptureQueriesContext(connection) as captured:
+			response = self.client.get(url, HTTP_X_SYSTEM_TOKEN="scrape-token")
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertEqual([query for query in captured if "loans_auditlog" not in query["sql"]], [])
+		body = response.content.decode("utf-8")
+		self.assertIn('weito_http_request_duration_ms_count{method="POST",endpoint="/api/mpesa/stk-push/",status="200"} 1', body)
+		self.assertIn('quantile="0.99"', body)
+
+	def test_unrouted_paths_share_one_series_and_labels_are_escaped(self):
+		for index in range(20):
+			self.client.get(f"/api/scan-{index}/")
+		self.client.generic("PROPFIND", reverse("system-health"))
+		keys = set(get_latency_histogram().snapshot())
+		self.assertEqual(keys, {"GET 404 unmatched", "OTHER 405 /api/system/health/"})
+
+		get_latency_histogram().record("GET", 'x"} 1\nfake_metric{a="\\', 200, 5)
+		body = render_prometheus()
+		self.assertNotIn("\nfake_metric", body)
+		self.assertIn('endpoint="x\\"} 1\\nfake_metric{a=\\"\\\\"', body)
+
+	def test_metrics_view_reports_percentiles_from_histogram(self):
+		staff_user = get_user_model().objects.create_superuser(username="metrics", email="m@example.com", password="secure-pass-123")
+		self.client.force_authenticate(user=staff_user)
+		self.client.get(reverse("system-health"))
+		response = self.client.get(reverse("system-metrics"))
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertEqual(response.data["api_requests_last_15m"], 1)
+		self.assertEqual(set(response.data["api_latency_ms_last_15m"]), {"p50", "p95", "p99"})
+
+
+@override_settings(MPESA_CALLBACK_TOKEN="test-token", MPESA_WEBHOOK_SECRET="", SYSTEM_AUTOMATION_TOKEN="scrape-token")
+class EndpointQueryBudgetTests(QueryBudgetAssertionsMixin, APITestCase):
+	def setUp(self):
+		cache.clear()
+		clear_report_cache()
+		self.client_record = Client.objects.create(name="Budget Client", phone_number="254700000300")
+		self.staff_user = get_user_model().objects.create_superuser(
+			username="budget",
+			email="budget@example.com",
+			password="secure-pass-123",
+		)
+		today = timezone.localdate()
+		for index in range(15):
+			loan = Loan.objects.create(
+				client=self.client_record,
+				amount=Decimal("1000.00"),
+				due_date=today + timedelta(days=(index % 5) - 2),
+			)
+			Payment.objects.bulk_create(
+				[Payment(loan=loan, amount=Decimal("100.00"), mpesa_receipt=f"BUD{index}", phone="254700000300")]
+			)
+		self.loan = loan
+		_token, self.raw_token = ClientAccessToken.create_token(self.client_record)
+
+	def staff_get(self, url_name):
+		self.client.force_authenticate(user=self.staff_user)
+		with self.assertWithinQueryBudget(url_name):
+			response = self.client.get(reverse(url_name))
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+	def client_get(self, url_name):
+		self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.raw_token}")
+		with self.assertWithinQueryBudget(url_name):
+			response = self.client.get(reverse(url_name))
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+	def test_report_endpoints_stay_within_budget(self):
+		for url_name in [
+			"report-daily-collections",
+			"report-outstanding-loans",
+			"report-overdue-loans",
+			"report-monthly-performance",
+			"system-metrics",
+		]:
+			with self.subTest(url_name=url_name):
+				self.staff_get(url_name)
+
+	def test_client_endpoints_stay_within_budget(self):
+		for url_name in ["client-loan-summary", "client-payment-history"]:
+			with self.subTest(url_name=url_name):
+				self.client_get(url_name)
+
+	def test_public_endpoints_stay_within_budget(self):
+		with self.assertWithinQueryBudget("system-health"):
+			self.client.get(reverse("system-health"))
+		with self.assertWithinQueryBudget("system-metrics-prometheus"):
+			self.client.get(reverse("system-metrics-prometheus"), HTTP_X_SYSTEM_TOKEN="scrape-token")
+		url = reverse("mpesa-callback", kwargs={"token": "test-token", "loan_id": self.loan.id})
+		with self.assertWithinQueryBudget("mpesa-callback"):
+			self.client.post(url, {"Body": {"stkCallback": {"ResultCode": 1032}}}, format="json")
+
+	def test_write_endpoints_stay_within_budget(self):
+		self.client.force_authenticate(user=self.staff_user)
+		with self.assertWithinQueryBudget("mpesa-stk-push"):
+			response = self.client.post(
+				reverse("mpesa-stk-push"),
+				{"loan_id": self.loan.id, "phone": "254700000300", "amount": "100.00"},
+				format="json",
+			)
+		self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+		self.client.force_authenticate(user=None)
+
+		url = reverse("mpesa-callback", kwargs={"token": "test-token", "loan_id": self.loan.id})
+		body = {
+			"Body": {
+				"stkCallback": {
+					"CheckoutRequestID": "ws_CO_300",
+					"ResultCode": 0,
+					"CallbackMetadata": {
+						"Item": [
+							{"Name": "Amount", "Value": 100},
+							{"Name": "MpesaReceiptNumber", "Value": "BUDPOST"},
+							{"Name": "PhoneNumber", "Value": 254700000300},
+						]
+					},
+				}
+			}
+		}
+		with self.assertWithinQueryBudget("mpesa-callback"):
+			response = self.client.post(url, body, format="json")
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+		self.client_record.max_loan_limit = Decimal("5000.00")
+		self.client_record.save(update_fields=["max_loan_limit"])
+		self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.raw_token}")
+		with self.assertWithinQueryBudget("client-loan-apply"):
+			response = self.client.post(
+				reverse("client-loan-apply"),
+				{"amount": "500.00", "due_date": str(timezone.localdate() + timedelta(days=30))},
+				format="json",
+			)
+		self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+	@override_settings(QUERY_BUDGET_ENABLED=True)
+	def test_middleware_attaches_query_numbers_to_audit_metadata(self):
+		self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.raw_token}")
+		self.client.get(reverse("client-loan-summary"))
+		metadata = AuditLog.objects.filter(endpoint=reverse("client-loan-summary")).latest("id").metadata
+		self.assertEqual(metadata["db_query_budget"], 4)
+		self.assertGreater(metadata["db_queries"], 0)
+		self.assertIn("db_time_ms", metadata)
+
+	@override_settings(QUERY_BUDGET_ENABLED=True, QUERY_BUDGETS={"client-loan-summary": 0})
+	def test_middleware_logs_over_budget_requests(self):
+		self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.raw_token}")
+		with self.assertLogs("loans.query_budget", level="WARNING") as logs:
+			self.client.get(reverse("client-loan-summary"))
+		self.assertIn('"event": "query_budget_exceeded"', logs.output[0])
+
+
+class GeneratePortfolioCommandTests(APITestCase):
+	def generate(self, seed):
+		call_command("generate_portfolio", clients=6, audit_per_client=2, seed=seed, chunk_size=4, stdout=StringIO())
+
+	def test_generates_consistent_portfolio(self):
+		self.generate(seed=7)
+
+		self.assertEqual(Client.objects.count(), 6)
+		self.assertEqual(AuditLog.objects.count(), 12)
+		self.assertGreaterEqual(Loan.objects.count(), 6)
+		self.assertFalse(Loan.objects.with_financials().exclude(status=F("computed_status")).exists())
+		self.assertLess(Loan.objects.filter(created_at__date=timezone.localdate()).count(), Loan.objects.count())
+		self.assertFalse(Client.objects.filter(created_at__date=timezone.localdate()).exists())
+		self.assertLess(AuditLog.objects.filter(created_at__date=timezone.localdate()).count(), AuditLog.objects.count())
+		self.assertEqual(ClientCreditFeatures.objects.count(), 6)
+		self.assertEqual(list(verify_client_credit_features()), [])
+		self.assertEqual(Client.objects.first().id_number[:3], "007")
+
+	def test_history_is_written_at_insert_time_on_the_apps_reminder_offsets(self):
+		with CaptureQueriesContext(connection) as queries:
+			call_command("generate_portfolio", clients=20, audit_per_client=1, seed=9, history_days=90, stdout=StringIO())
+
+		backdated = ("loans_client", "loans_loan", "loans_loanreminderlog", "loans_auditlog")
+		self.assertFalse(
+			[q["sql"] for q in queries.captured_queries if q["sql"].startswith("UPDATE") and any(t in q["sql"] for t in backdated)]
+		)
+		due_soon = LoanReminderLog.objects.filter(reminder_type=LoanReminderLog.ReminderType.DUE_SOON).select_related("loan")
+		self.assertTrue(due_soon.exists())
+		for reminder in due_soon:
+			self.assertEqual(timezone.localdate(reminder.sent_at), reminder.loan.due_date - timedelta(days=1))
+		self.assertFalse(LoanReminderLog.objects.filter(sent_at__date=timezone.localdate(), loan__due_date__lt=timezone.localdate() - timedelta(days=2)).exists())
+
+	def test_same_seed_reproduces_amounts_and_refuses_to_run_twice(self):
+		self.generate(seed=8)
+		amounts = list(Loan.objects.order_by("id").values_list("amount", "due_date", "status"))
+		Client.objects.all().delete()
+		self.generate(seed=8)
+
+		self.assertEqual(list(Loan.objects.order_by("id").values_list("amount", "due_date", "status")), amounts)
+		with self.assertRaises(CommandError):
+			self.generate(seed=8)
+
+
+class RunBenchmarksCommandTests(APITestCase):
+	def run_benchmarks(self, output, **options):
+		call_command(
+			"run_benchmarks",
+			sizes="3",
+			repeat=1,
+			output=output,
+			stdout=StringIO(),
+			**{"only": "report_outstanding_loans,mpesa_callback,task_reconcile_transactions", **options},
+		)
+
+	def test_writes_results_and_rolls_back_seeded_portfolio(self):
+		with tempfile.TemporaryDirectory() as directory:
+			output = os.path.join(directory, "results.json")
+			self.run_benchmarks(output)
+			with open(output) as handle:
+				results = json.load(handle)["results"]["3"]
+
+		self.assertEqual(set(results), {"report_outstanding_loans", "mpesa_callback", "task_reconcile_transactions"})
+		self.assertEqual(results["mpesa_callback"]["queries"], 1)
+		self.assertGreater(results["report_outstanding_loans"]["wall_ms"], 0)
+		self.assertFalse(Client.objects.exists())
+		self.assertFalse(MpesaCallbackInbox.objects.exists())
+
+	def test_series_hot_paths_are_benchmarked(self):
+		names = [
+			"task_send_stk_push",
+			"task_fail_stale_stk_pushes",
+			"task_apply_payment_effects",
+			"task_dispatch_outbox_messages",
+			"task_purge_outbox_messages",
+			"task_purge_mpesa_callback_inbox",
+			"task_pace_loan_reminders",
+		]
+		with tempfile.TemporaryDirectory() as directory:
+			output = os.path.join(directory, "results.json")
+			self.run_benchmarks(output, only=",".join(names))
+			with open(output) as handle:
+				results = json.load(handle)["results"]["3"]
+
+		self.assertEqual(set(results), set(names))
+		self.assertTrue(all(result["queries"] > 0 for result in results.values()))
+		self.assertFalse(StkPushRequest.objects.exists())
+		self.assertFalse(OutboxMessage.objects.exists())
+
+	def test_beat_task_without_a_benchmark_fails(self):
+		schedule = {**settings.CELERY_BEAT_SCHEDULE, "new-job": {"task": "loans.tasks.new_job", "schedule": 60}}
+		with override_settings(CELERY_BEAT_SCHEDULE=schedule):
+			with self.assertRaisesMessage(CommandError, "Beat tasks without a benchmark: loans.tasks.new_job."):
+				self.run_benchmarks(os.devnull)
+
+	def test_fails_when_query_count_regresses_against_baseline(self):
+		with tempfile.TemporaryDirectory() as directory:
+			output = os.path.join(directory, "results.json")
+			baseline = os.path.join(directory, "baseline.json")
+			with open(baseline, "w") as handle:
+				json.dump({"results": {"3": {"mpesa_callback": {"wall_ms": 1000, "queries": 0, "peak_kb": 10000}}}}, handle)
+
+			with self.assertRaisesMessage(CommandError, "1 benchmark regressions"):
+				self.run_benchmarks(output, baseline=baseline)
+
+
+class CollectionRollupTests(APITestCase):
+	def setUp(self):
+		cache.clear()
+		clear_report_cache()
+		self.client_record = Client.objects.create(name="Rollup Client", phone_number="254700000400")
+		self.today = timezone.localdate()
+		self.loan = Loan.objects.create(client=self.client_record, amount=Decimal("5000.00"), due_date=self.today + timedelta(days=10))
+		self.other_loan = Loan.objects.create(client=self.client_record, amount=Decimal("5000.00"), due_date=self.today + timedelta(days=10))
+		self.staff_user = get_user_model().objects.create_superuser(
+			username="rollups",
+			email="rollups@example.com",
+			password="secure-pass-123",
+		)
+
+	def create_payment(self, loan, amount, receipt, paid_at=None):
+		return Payment.objects.create(
+			loan=loan,
+			amount=Decimal(amount),
+			mpesa_receipt=receipt,
+			phone=self.client_record.phone_number,
+			paid_at=paid_at or timezone.now(),
+		)
+
+	def test_rollups_follow_payment_inserts_edits_and_deletes(self):
+		self.create_payment(self.loan, "100.00", "ROL1")
+		self.create_payment(self.loan, "200.00", "ROL2")
+		moved = self.create_payment(self.other_loan, "300.00", "ROL3")
+		self.assertEqual(DailyCollectionRollup.objects.get(date=self.today).as_tuple(), (Decimal("600.00"), 3, 2))
+
+		moved.paid_at = timezone.now() - timedelta(days=2)
+		moved.save()
+		self.assertEqual(DailyCollectionRollup.objects.get(date=self.today).as_tuple(), (Decimal("300.00"), 2, 1))
+		self.assertEqual(
+			DailyCollectionRollup.objects.get(date=timezone.localdate(moved.paid_at)).as_tuple(),
+			(Decimal("300.00"), 1, 1),
+		)
+
+		self.loan.delete()
+		self.assertFalse(DailyCollectionRollup.objects.filter(date=self.today).exists())
+		self.assertEqual(list(verify_collection_rollups()), [])
+
+	def test_day_rows_are_upserted_not_deleted_and_recreated(self):
+		self.create_payment(self.loan, "100.00", "ROL30")
+		DailyCollectionRollup.objects.filter(date=self.today).update(loans_count=9)
+
+		with CaptureQueriesContext(connection) as captured:
+			self.create_payment(self.loan, "40.00", "ROL31", paid_at=timezone.now() - timedelta(seconds=1))
+			self.create_payment(self.other_loan, "60.00", "ROL32")
+		self.assertFalse(any(query["sql"].startswith('DELETE FROM "loans_dailycollectionrollup"') for query in captured))
+		self.assertEqual(DailyCollectionRollup.objects.get(date=self.today).as_tuple(), (Decimal("200.00"), 3, 10))
+
+		call_command("rebuild_collection_rollups", stdout=StringIO())
+		self.assertEqual(DailyCollectionRollup.objects.get(date=self.today).as_tuple(), (Decimal("200.00"), 3, 2))
+		self.assertEqual(list(verify_collection_rollups()), [])
+
+	def test_reports_read_rollups(self):
+		self.create_payment(self.loan, "150.00", "ROL10")
+		self.create_payment(self.other_loan, "350.00", "ROL11")
+		self.client.force_authenticate(user=self.staff_user)
+
+		with self.assertNumQueries(2):
+			daily = self.client.get(reverse("report-daily-collections"))
+		self.assertEqual(daily.data["total_collections"], Decimal("500.00"))
+		self.assertEqual(daily.data["payments_count"], 2)
+
+		with CaptureQueriesContext(connection) as captured:
+			monthly = self.client.get(reverse("report-monthly-performance"))
+		self.assertEqual(monthly.data["collections"], {"total": Decimal("500.00"), "payments_count": 2})
+		self.assertFalse(any('"loans_payment"' in query["sql"] for query in captured))
+
+	def test_backfill_command_checks_and_repairs_drift(self):
+		self.create_payment(self.loan, "150.00", "ROL20")
+		self.create_payment(self.loan, "50.00", "ROL21", paid_at=timezone.now() - timedelta(days=40))
+		DailyCollectionRollup.objects.all().delete()
+
+		with self.assertRaises(CommandError):
+			call_command("rebuild_collection_rollups", "--check", stdout=StringIO())
+		call_command("rebuild_collection_rollups", "--chunk-days", "7", stdout=StringIO())
+		call_command("rebuild_collection_rollups", "--check", stdout=StringIO())
+		self.assertEqual(DailyCollectionRollup.objects.count(), 2)
+
+
+class ReportCacheTests(APITestCase):
+	def setUp(self):
+		clear_report_cache()
+		self.client_record = Client.objects.create(name="Cache Client", phone_number="254700000500")
+		self.loan = Loan.objects.create(
+			client=self.client_record,
+			amount=Decimal("1000.00"),
+			due_date=timezone.localdate() + timedelta(days=5),
+		)
+		self.staff_user = get_user_model().objects.create_superuser(
+			username="cache",
+			email="cache@example.com",
+			password="secure-pass-123",
+		)
+		self.client.force_authenticate(user=self.staff_user)
+
+	def test_hits_skip_the_database_until_a_payment_commits(self):
+		first = self.client.get(reverse("report-outstanding-loans"))
+		self.assertEqual(first.data["outstanding_total"], Decimal("1000.00"))
+		with self.assertNumQueries(1):
+			self.client.get(reverse("report-outstanding-loans"))
+
+		version = current_report_version()
+		with self.captureOnCommitCallbacks(execute=True):
+			Payment.objects.create(loan=self.loan, amount=Decimal("400.00"), mpesa_receipt="RPC1", phone="254700000500")
+		self.assertNotEqual(current_report_version(), version)
+
+		second = self.client.get(reverse("report-outstanding-loans"))
+		self.assertEqual(second.data["outstanding_total"], Decimal("600.00"))
+
+	def test_cache_errors_after_commit_do_not_fail_the_payment(self):
+		with patch("loans.services.report_cache._report_cache", side_effect=OSError("disk full")):
+			with self.assertLogs("django.test", level="ERROR"):
+				with self.captureOnCommitCallbacks(execute=True):
+					Payment.objects.create(loan=self.loan, amount=Decimal("100.00"), mpesa_receipt="RPC9", phone="254700000500")
+		self.assertTrue(Payment.objects.filter(mpesa_receipt="RPC9").exists())
+		self.assertTrue(OutboxMessage.objects.filter(task=apply_payment_effects_task.name).exists())
+
+	def test_version_is_shared_between_cache_connections(self):
+		other_process = caches.create_connection(REPORT_CACHE_ALIAS)
+		self.client.get(reverse("report-daily-collections"))
+		self.assertEqual(other_process.get("reports:version"), current_report_version())
+
+		with self.captureOnCommitCallbacks(execute=True):
+			Loan.objects.create(client=self.client_record, amount=Decimal("10.00"), due_date=timezone.localdate())
+		self.assertEqual(other_process.get("reports:version"), current_report_version())
+
+
+	def test_runs_against_private_cache_directories(self):
+		for alias in (REPORT_CACHE_ALIAS, TOKEN_CACHE_ALIAS):
+			location = caches[alias]._dir
+			self.assertFalse(location.startswith(str(settings.APP_DATA_DIR)))
+			self.assertTrue(location.startswith(tempfile.gettempdir()))
+		# The latency histogram file is shared the same way, so a run must not map the host's live one.
+		self.assertEqual(os.path.dirname(settings.LATENCY_METRICS_PATH), os.path.dirname(caches[REPORT_CACHE_ALIAS]._dir))
+		self.assertFalse(settings.LATENCY_METRICS_PATH.startswith(str(settings.APP_DATA_DIR)))
+		for name in ("SMS_RATE_LIMIT_DIR", "MPESA_TOKEN_DIR"):
+			self.assertEqual(os.path.dirname(getattr(settings, name)), os.path.dirname(caches[REPORT_CACHE_ALIAS]._dir))
+
+
+class OverdueReportPaginationTests(APITestCase):
+	def setUp(self):
+		clear_report_cache()
+		self.client_record = Client.objects.create(name="Overdue Client", phone_number="254700000600")
+		self.staff_user = get_user_model().objects.create_superuser(
+			username="overdue",
+			email="overdue@example.com",
+			password="secure-pass-123",
+		)
+		self.client.force_authenticate(user=self.staff_user)
+		today = timezone.localdate()
+		self.loans = [
+			Loan.objects.create(client=self.client_record, amount=Decimal("100.00"), due_date=today - timedelta(days=days))
+			for days in (3, 5, 5, 5, 9)
+		]
+		Loan.objects.create(client=self.client_record, amount=Decimal("100.00"), due_date=today + timedelta(days=1))
+		self.expected_ids = [loan.id for loan in sorted(self.loans, key=lambda loan: (loan.due_date, loan.id))]
+
+	def test_cursor_walks_every_overdue_loan_once_in_key_order(self):
+		seen = []
+		params = {"page_size": 2}
+		while True:
+			response = self.client.get(reverse("report-overdue-loans"), params)
+			self.assertEqual(response.status_code, status.HTTP_200_OK)
+			self.assertEqual(response.data["overdue_count"], 5)
+			self.assertLessEqual(len(response.data["results"]), 2)
+			seen.extend(row["id"] for row in response.data["results"])
+			if not response.data["next_cursor"]:
+				break
+			params["cursor"] = response.data["next_cursor"]
+		self.assertEqual(seen, self.expected_ids)
+
+	def test_page_query_count_does_not_depend_on_position(self):
+		first = self.client.get(reverse("report-overdue-loans"), {"page_size": 1})
+		clear_report_cache()
+		with CaptureQueriesContext(connection) as first_page:
+			self.client.get(reverse("report-overdue-loans"), {"page_size": 1})
+		clear_report_cache()
+		with CaptureQueriesContext(connection) as later_page:
+			self.client.get(reverse("report-overdue-loans"), {"page_size": 1, "cursor": first.data["next_cursor"]})
+		self.assertEqual(len(later_page), len(first_page))
+
+	def test_overdue_count_is_computed_once_per_report_version(self):
+		with CaptureQueriesContext(connection) as first_page:
+			first = self.client.get(reverse("report-overdue-loans"), {"page_size": 2})
+		with CaptureQueriesContext(connection) as next_page:
+			second = self.client.get(reverse("report-overdue-loans"), {"page_size": 2, "cursor": first.data["next_cursor"]})
+
+		self.assertEqual(first.data["overdue_count"], 5)
+		self.assertEqual(second.data["overdue_count"], 5)
+		self.assertEqual(sum("COUNT(" in query["sql"] for query in first_page), 1)
+		self.assertFalse(any("COUNT(" in query["sql"] for query in next_page))
+
+	def test_invalid_cursor_is_rejected(self):
+		for cursor in ["not-a-cursor", encode_cursor("2026-01-01"), encode_cursor("yesterday", "1")]:
+			with self.subTest(cursor=cursor):
+				response = self.client.get(reverse("report-overdue-loans"), {"cursor": cursor})
+				self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+	def test_stream_mode_returns_every_row(self):
+		response = self.client.get(reverse("report-overdue-loans"), {"stream": "true"})
+		self.assertTrue(response.streaming)
+		body = json.loads(b"".join(response.streaming_content))
+		self.assertEqual(body["overdue_count"], 5)
+		self.assertEqual([row["id"] for row in body["results"]], self.expected_ids)
+		self.assertEqual(body["results"][0]["balance"], "100.00")
+
+
+class PaymentHistoryPaginationTests(APITestCase):
+	def setUp(self):
+		self.client_record = Client.objects.create(name="History Client", phone_number="254700000700")
+		self.loan = Loan.objects.create(
+			client=self.client_record,
+			amount=Decimal("100000.00"),
+			due_date=timezone.localdate() + timedelta(days=30),
+		)
+		_token, raw_token = ClientAccessToken.create_token(self.client_record)
+		self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {raw_token}")
+		self.now = timezone.now()
+		self.receipts = 0
+		self.add_payments([self.now - timedelta(hours=hours) for hours in (5, 4, 4, 3, 1)])
+
+	def add_payments(self, moments):
+		payments = []
+		for paid_at in moments:
+			self.receipts += 1
+			payments.append(
+				Payment(loan=self.loan, amount=Decimal("10.00"), mpesa_receipt=f"HIS{self.receipts}", phone="254700000700", paid_at=paid_at)
+			)
+		return Payment.objects.bulk_create(payments)
+
+	def get_history(self, **params):
+		response = self.client.get(reverse("client-payment-history"), params)
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		return response.data
+
+	def test_cursor_pages_newest_first_without_gaps(self):
+		expected = list(Payment.objects.order_by("-paid_at", "-id").values_list("id", flat=True))
+		seen = []
+		page = self.get_history(page_size=2)
+		sync_token = page["sync_token"]
+		while True:
+			seen.extend(row["id"] for row in page["results"])
+			if not page["next_cursor"]:
+				break
+			page = self.get_history(page_size=2, cursor=page["next_cursor"])
+		self.assertEqual(seen, expected)
+		self.assertIsNotNone(sync_token)
+
+	def test_since_returns_only_newer_payments(self):
+		sync_token = self.get_history()["sync_token"]
+		new_payments = self.add_payments([self.now + timedelta(minutes=minutes) for minutes in (1, 2, 2)])
+
+		first = self.get_history(since=sync_token, page_size=2)
+		self.assertTrue(first["has_more"])
+		second = self.get_history(since=first["sync_token"], page_size=2)
+		self.assertFalse(second["has_more"])
+		self.assertEqual(
+			[row["id"] for row in first["results"] + second["results"]],
+			[payment.id for payment in new_payments],
+		)
+
+		idle = self.get_history(since=second["sync_token"])
+		self.assertEqual(idle["results"], [])
+		self.assertEqual(idle["sync_token"], second["sync_token"])
+
+	def test_since_returns_payments_recorded_with_an_earlier_paid_at(self):
+		sync_token = self.get_history()["sync_token"]
+		[backdated] = self.add_payments([self.now - timedelta(hours=2)])
+
+		synced = self.get_history(since=sync_token)
+		self.assertEqual([row["id"] for row in synced["results"]], [backdated.id])
+		self.assertEqual(self.get_history(since=synced["sync_token"])["results"], [])
+
+	def test_empty_history_sync_token_catches_first_payment(self):
+		Payment.objects.all().delete()
+		sync_token = self.get_history()["sync_token"]
+		self.add_payments([self.now])
+		self.assertEqual(len(self.get_history(since=sync_token)["results"]), 1)
+
+	def test_invalid_since_is_rejected(self):
+		response = self.client.get(reverse("client-payment-history"), {"since": encode_cursor("never", "x")})
+		self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+		self.assertIn("since", response.data)
+
+
+class ClientTokenCacheTests(APITestCase):
+	def setUp(self):
+		self.client_record = Client.objects.create(name="Token Client", phone_number="254700000850")
+		self.token, raw_token = ClientAccessToken.create_token(self.client_record)
+		self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {raw_token}")
+
+	def get_summary(self):
+		return self.client.get(reverse("client-loan-summary"))
+
+	def token_queries(self, captured):
+		return [
+			query["sql"]
+			for query in captured
+			if query["sql"].startswith("SELECT") and '"loans_clientaccesstoken"' in query["sql"]
+		]
+
+	@override_settings(CLIENT_TOKEN_TOUCH_SECONDS=60)
+	def test_repeat_requests_skip_token_lookup_and_writes(self):
+		self.addCleanup(get_last_used_tracker().flush)
+		self.assertEqual(self.get_summary().status_code, status.HTTP_200_OK)
+
+		with CaptureQueriesContext(connection) as captured:
+			for _ in range(3):
+				self.assertEqual(self.get_summary().status_code, status.HTTP_200_OK)
+		self.assertEqual(self.token_queries(captured), [])
+		self.assertFalse(any('UPDATE "loans_clientaccesstoken"' in query["sql"] for query in captured))
+
+	def test_revoked_token_is_rejected_immediately(self):
+		self.assertEqual(self.get_summary().status_code, status.HTTP_200_OK)
+
+		with self.captureOnCommitCallbacks(execute=True):
+			self.token.revoked_at = timezone.now()
+			self.token.save(update_fields=["revoked_at"])
+
+		self.assertIn(self.get_summary().status_code, [status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN])
+
+	def test_client_change_is_read_without_reloading_the_token(self):
+		self.assertEqual(self.get_summary().status_code, status.HTTP_200_OK)
+
+		with self.captureOnCommitCallbacks(execute=True):
+			self.client_record.name = "Renamed Client"
+			self.client_record.save(update_fields=["name"])
+
+		with CaptureQueriesContext(connection) as captured:
+			response = self.get_summary()
+		self.assertEqual(response.data["client"]["name"], "Renamed Client")
+		self.assertEqual(self.token_queries(captured), [])
+
+	def test_cached_token_holds_no_client_details(self):
+		self.assertEqual(self.get_summary().status_code, status.HTTP_200_OK)
+
+		entry = caches[TOKEN_CACHE_ALIAS].get(f"client-token:{self.token.token_hash}")
+		self.assertEqual(entry, (self.token.id, self.client_record.id, self.token.expires_at, False))
+
+	def test_last_used_writes_are_coalesced_per_interval(self):
+		other, _raw = ClientAccessToken.create_token(self.client_record)
+		tracker = LastUsedTracker(interval=60)
+		first_seen = timezone.now()
+		with CaptureQueriesContext(connection) as captured:
+			tracker.touch(self.token.id, first_seen)
+		self.assertEqual(len(captured), 1)
+
+		last_seen = first_seen + timedelta(seconds=5)
+		with CaptureQueriesContext(connection) as captured:
+			tracker.touch(self.token.id, first_seen + timedelta(seconds=1))
+			tracker.touch(self.token.id, last_seen)
+			tracker.touch(other.id, last_seen)
+		self.assertEqual(len(captured), 0)
+
+		with CaptureQueriesContext(connection) as captured:
+			self.assertEqual(tracker.flush(), 2)
+		self.assertEqual(len(captured), 1)
+		self.token.refresh_from_db()
+		other.refresh_from_db()
+		self.assertEqual(self.token.last_used_at, last_seen)
+		self.assertEqual(other.last_used_at, last_seen)
+
+	def test_idle_worker_flushes_deferred_touches_on_a_timer(self):
+		tracker = LastUsedTracker(interval=0.2)
+		written = []
+		flushed = threading.Event()
+
+		def record(batch):
+			if batch:
+				written.append(batch)
+				flushed.set()
+			return len(batch)
+
+		moment = timezone.now()
+		with patch.object(tracker, "_write", side_effect=record):
+			tracker.touch(self.token.id, moment)
+			flushed.clear()
+			tracker.touch(self.token.id, moment + timedelta(seconds=1))
+			self.assertEqual(len(written), 1)
+			# No further touch arrives; the flusher thread writes the pending one on its own.
+			self.assertTrue(flushed.wait(2))
+		self.assertEqual(written[-1], {self.token.id: moment + timedelta(seconds=1)})
+
+
+class ClientSummaryCacheTests(APITestCase):
+	def setUp(self):
+		clear_report_cache()
+		self.client_record = Client.objects.create(name="Summary Client", phone_number="254700000800")
+		self.other_client = Client.objects.create(name="Other Client", phone_number="254700000801")
+		self.loan = Loan.objects.create(
+			client=self.client_record,
+			amount=Decimal("1000.00"),
+			due_date=timezone.localdate() + timedelta(days=5),
+		)
+		self.other_loan = Loan.objects.create(
+			client=self.other_client,
+			amount=Decimal("1000.00"),
+			due_date=timezone.localdate() + timedelta(days=5),
+		)
+		_token, raw_token = ClientAccessToken.create_token(self.client_record)
+		self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {raw_token}")
+
+	def get_summary(self, **headers):
+		return self.client.get(reverse("client-loan-summary"), **headers)
+
+	@override_settings(CLIENT_TOKEN_TOUCH_SECONDS=60)
+	def test_matching_etag_returns_304_without_reading_tables(self):
+		self.addCleanup(get_last_used_tracker().flush)
+		first = self.get_summary()
+		self.assertEqual(first.status_code, status.HTTP_200_OK)
+
+		with CaptureQueriesContext(connection) as captured:
+			cached = self.get_summary()
+		self.assertEqual(cached.data, first.data)
+		self.assertFalse(any('"loans_loan"' in query["sql"] for query in captured))
+
+		with CaptureQueriesContext(connection) as captured:
+			not_modified = self.get_summary(HTTP_IF_NONE_MATCH=first["ETag"])
+		self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+		self.assertEqual(not_modified["ETag"], first["ETag"])
+		tables = {query["sql"].split('"')[1] for query in captured}
+		self.assertEqual(tables - {"loans_auditlog"}, set())
+
+	def test_version_moves_only_for_the_client_that_changed(self):
+		etag = self.get_summary()["ETag"]
+
+		with self.captureOnCommitCallbacks(execute=True):
+			Payment.objects.create(loan=self.other_loan, amount=Decimal("100.00"), mpesa_receipt="SUM1", phone="254700000801")
+		self.assertEqual(self.get_summary(HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+
+		with self.captureOnCommitCallbacks(execute=True):
+			Payment.objects.create(loan=self.loan, amount=Decimal("400.00"), mpesa_receipt="SUM2", phone="254700000800")
+		response = self.get_summary(HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertNotEqual(response["ETag"], etag)
+		self.assertEqual(response.data["loans"][0]["balance"], "600.00")
+
+	def test_batch_rescoring_invalidates_changed_clients(self):
+		etag = self.get_summary()["ETag"]
+		Client.objects.filter(id=self.client_record.id).update(credit_score=99)
+		with self.captureOnCommitCallbacks(execute=True):
+			recompute_all_client_credit()
+		self.assertEqual(self.get_summary(HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+	def test_deleting_a_client_invalidates_its_summary(self):
+		client_id = Client.objects.create(name="Deleted Client", phone_number="254700000802").id
+		version = client_summary_version(client_id)
+		with self.captureOnCommitCallbacks(execute=True):
+			Client.objects.filter(id=client_id).delete()
+		self.assertNotEqual(client_summary_version(client_id), version)
+
+
+OLD_FIELD_KEY = Fernet.generate_key().decode()
+NEW_FIELD_KEY = Fernet.generate_key().decode()
+
+
+class RotateEncryptionKeysCommandTests(APITestCase):
+	def setUp(self):
+		self.tempdir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.tempdir.cleanup)
+		self.progress_file = os.path.join(self.tempdir.name, "progress.json")
+		with override_settings(FIELD_ENCRYPTION_KEY=OLD_FIELD_KEY):
+			self.clients = []
+			for index in range(3):
+				client = Client(name=f"Rotate {index}", phone_number=f"25470000090{index}")
+				client.set_id_number(f"3000000{index}")
+				client.save()
+				self.clients.append(client)
+			loan = Loan.objects.create(
+				client=self.clients[0],
+				amount=Decimal("500.00"),
+				due_date=timezone.localdate() + timedelta(days=5),
+			)
+			self.payment = Payment.objects.create(
+				loan=loan,
+				amount=Decimal("100.00"),
+				mpesa_receipt="ROTATE1",
+				phone="254700000900",
+				raw_payload={"receipt": "ROTATE1"},
+			)
+
+	def rotate(self, **options):
+		with override_settings(FIELD_ENCRYPTION_KEY=NEW_FIELD_KEY, FIELD_ENCRYPTION_PREVIOUS_KEYS=[OLD_FIELD_KEY]):
+			call_command(
+				"rotate_encryption_keys",
+				workers=1,
+				chunk_size=2,
+				progress_file=self.progress_file,
+				stdout=StringIO(),
+				**options,
+			)
+
+	def test_previous_keys_still_decrypt_and_cipher_is_reused(self):
+		with override_settings(FIELD_ENCRYPTION_KEY=NEW_FIELD_KEY, FIELD_ENCRYPTION_PREVIOUS_KEYS=[OLD_FIELD_KEY]):
+			self.assertIs(_fernet_instance(), _fernet_instance())
+			self.assertEqual(Client.objects.get(pk=self.clients[1].pk).id_number, "30000001")
+		with override_settings(FIELD_ENCRYPTION_KEY=NEW_FIELD_KEY):
+			self.assertEqual(Client.objects.get(pk=self.clients[1].pk).id_number, "")
+
+	def test_secret_key_derived_key_is_dropped_when_legacy_key_is_disabled(self):
+		with override_settings(FIELD_ENCRYPTION_KEY=""):
+			legacy = Client(name="Legacy", phone_number="254700000999")
+			legacy.set_id_number("39999999")
+			legacy.save()
+		with override_settings(FIELD_ENCRYPTION_KEY=NEW_FIELD_KEY):
+			self.assertEqual(Client.objects.get(pk=legacy.pk).id_number, "39999999")
+		with override_settings(FIELD_ENCRYPTION_KEY=NEW_FIELD_KEY, FIELD_ENCRYPTION_LEGACY_KEY=False):
+			self.assertEqual(field_encryption_keys(), (NEW_FIELD_KEY,))
+			self.assertEqual(Client.objects.get(pk=legacy.pk).id_number, "")
+
+	def test_rotation_moves_every_value_to_the_primary_key(self):
+		self.rotate()
+
+		new_key = Fernet(NEW_FIELD_KEY.encode())
+		for client in Client.objects.filter(pk__in=[client.pk for client in self.clients]):
+			self.assertTrue(new_key.decrypt(client.id_number_encrypted.encode()).decode().startswith("3000000"))
+		payload = new_key.decrypt(PaymentPayload.objects.get(payment_id=self.payment.pk).payload_encrypted.encode())
+		self.assertEqual(json.loads(zlib.decompress(payload)), {"receipt": "ROTATE1"})
+
+		with open(self.progress_file) as handle:
+			progress = json.load(handle)
+		self.assertEqual(progress["fields"]["loans.Client.id_number_encrypted"], self.clients[-1].pk)
+
+	def test_rerun_resumes_from_saved_progress(self):
+		self.rotate()
+		Client.objects.filter(pk=self.clients[0].pk).update(
+			id_number_encrypted=Fernet(OLD_FIELD_KEY.encode()).encrypt(b"30000000").decode()
+		)
+
+		with CaptureQueriesContext(connection) as captured:
+			self.rotate()
+		self.assertFalse(any(query["sql"].startswith("UPDATE") for query in captured))
+
+		self.rotate(restart=True)
+		rotated = Client.objects.get(pk=self.clients[0].pk).id_number_encrypted.encode()
+		self.assertEqual(Fernet(NEW_FIELD_KEY.encode()).decrypt(rotated), b"30000000")
+
+	def test_rows_edited_during_the_run_keep_the_new_value(self):
+		def edit_while_rotating(rows):
+			result = rotate_tokens(rows)
+			if self.clients[1].pk in [pk for pk, _token in rows]:
+				client = Client.objects.get(pk=self.clients[1].pk)
+				client.set_id_number("39999999")
+				client.save()
+			return result
+
+		with patch("loans.management.commands.rotate_encryption_keys.rotate_tokens", edit_while_rotating):
+			self.rotate()
+
+		with override_settings(FIELD_ENCRYPTION_KEY=NEW_FIELD_KEY):
+			self.assertEqual(Client.objects.get(pk=self.clients[1].pk).id_number, "39999999")
+			self.assertEqual(Client.objects.get(pk=self.clients[0].pk).id_number, "30000000")
+			self.assertEqual(Client.objects.get(pk=self.clients[2].pk).id_number, "30000002")
+
+
+class PaymentPayloadStorageTests(APITestCase):
+	def setUp(self):
+		client = Client.objects.create(name="Payload Client", phone_number="254700000950")
+		self.loan = Loan.objects.create(
+			client=client,
+			amount=Decimal("500.00"),
+			due_date=timezone.localdate() + timedelta(days=5),
+		)
+
+	def create_payment(self, receipt, payload):
+		return Payment.objects.create(
+			loan=self.loan,
+			amount=Decimal("100.00"),
+			mpesa_receipt=receipt,
+			phone="254700000950",
+			raw_payload=payload,
+		)
+
+	def test_payload_is_compressed_encrypted_and_loaded_lazily(self):
+		payload = {"Body": {"stkCallback": {"ResultCode": 0, "MpesaReceiptNumber": "PAYLOAD1"}}}
+		payment = self.create_payment("PAYLOAD1", payload)
+
+		stored = PaymentPayload.objects.get(payment=payment).payload_encrypted
+		self.assertNotIn("PAYLOAD1", stored)
+
+		with CaptureQueriesContext(connection) as captured:
+			fetched = Payment.objects.get(pk=payment.pk)
+		self.assertNotIn("payload", captured[0]["sql"])
+		with CaptureQueriesContext(connection) as captured:
+			self.assertEqual(fetched.raw_payload, payload)
+			self.assertEqual(fetched.raw_payload, payload)
+		self.assertEqual(len(captured), 1)
+
+	def test_empty_payload_stores_nothing_and_clearing_removes_the_row(self):
+		empty = self.create_payment("PAYLOAD2", {})
+		self.assertFalse(PaymentPayload.objects.filter(payment=empty).exists())
+		self.assertEqual(Payment.objects.get(pk=empty.pk).raw_payload, {})
+
+		payment = self.create_payment("PAYLOAD3", {"receipt": "PAYLOAD3"})
+		payment.raw_payload = {}
+		payment.save()
+		self.assertFalse(PaymentPayload.objects.filter(payment=payment).exists())
+
+	def test_inbox_callbacks_are_stored_encrypted(self):
+		payload = {"Body": {"stkCallback": {"CheckoutRequestID": "ws_CO_951", "MpesaReceiptNumber": "PAYLOAD4"}}}
+		entry = record_callback(self.loan.id, payload)
+
+		stored = MpesaCallbackInbox.objects.filter(pk=entry.pk).values_list("payload_encrypted", flat=True).get()
+		self.assertNotIn("PAYLOAD4", stored)
+		self.assertEqual(MpesaCallbackInbox.objects.get(pk=entry.pk).payload, payload)
+
+
+class StubDarajaHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, format, *args):
+		pass
+
+	def reply(self, status_code, body):
+		data = json.dumps(body).encode("utf-8")
+		self.send_response(status_code)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def do_GET(self):
+		stub = self.server.stub
+		stub["ports"].append(self.client_address[1])
+		stub["oauth"].append(self.path)
+		time.sleep(0.05)
+		self.reply(200, {"access_token": f"token-{len(stub['oauth'])}", "expires_in": "3599"})
+
+	def do_POST(self):
+		stub = self.server.stub
+		self.rfile.read(int(self.headers["Content-Length"]))
+		stub["ports"].append(self.client_address[1])
+		stub["pushes"].append(self.headers["Authorization"])
+		if stub["reject_next"]:
+			stub["reject_next"] = False
+			self.reply(401, {"errorMessage": "Invalid Access Token"})
+			return
+		self.reply(200, {"ResponseCode": "0", "CheckoutRequestID": f"ws_CO_{len(stub['pushes'])}"})
+
+
+class MpesaServiceTests(APITestCase):
+	def setUp(self):
+		server = ThreadingHTTPServer(("127.0.0.1", 0), StubDarajaHandler)
+		server.stub = self.stub = {"oauth": [], "pushes": [], "ports": [], "reject_next": False}
+		thread = threading.Thread(target=server.serve_forever, daemon=True)
+		thread.start()
+		self.addCleanup(server.server_close)
+		self.addCleanup(server.shutdown)
+		tempdir = tempfile.TemporaryDirectory()
+		self.addCleanup(tempdir.cleanup)
+		override = override_settings(
+			MPESA_BASE_URL=f"http://127.0.0.1:{server.server_address[1]}",
+			MPESA_CONSUMER_KEY=f"stub-{server.server_address[1]}",
+			MPESA_SHORTCODE="174379",
+			MPESA_TOKEN_DIR=os.path.join(tempdir.name, "mpesa"),
+		)
+		override.enable()
+		self.addCleanup(override.disable)
+
+	def push(self, service):
+		return service.stk_push(
+			phone="254700000990",
+			amount="100",
+			account_reference="LOAN-1",
+			transaction_desc="Loan repayment 1",
+			callback_url="http://127.0.0.1:8000/api/mpesa/callback/token/1/",
+		)
+
+	def test_one_oauth_call_per_token_lifetime(self):
+		service = get_mpesa_service()
+		self.assertIs(get_mpesa_service(), service)
+		for _ in range(3):
+			self.assertEqual(self.push(service)["ResponseCode"], "0")
+		self.assertEqual(len(self.stub["oauth"]), 1)
+		self.assertEqual(self.stub["pushes"], ["Bearer token-1"] * 3)
+		self.assertEqual(len(set(self.stub["ports"])), 1)
+		# The requests went through the pooled adapter, which opened a single connection for all four.
+		adapter = service.session.get_adapter(settings.MPESA_BASE_URL)
+		self.assertEqual(adapter.max_retries.total, 3)
+		pools = [adapter.poolmanager.pools[key] for key in adapter.poolmanager.pools.keys()]
+		self.assertEqual([pool.num_connections for pool in pools], [1])
+
+		self.push(MpesaService())
+		self.assertEqual(len(self.stub["oauth"]), 1)
+
+		with patch("loans.services.mpesa.time.time", return_value=time.time() + 3600):
+			self.push(service)
+		self.assertEqual(len(self.stub["oauth"]), 2)
+		self.assertEqual(self.stub["pushes"][-1], "Bearer token-2")
+
+	def test_concurrent_requests_share_one_refresh(self):
+		service = MpesaService()
+		tokens = []
+		threads = [threading.Thread(target=lambda: tokens.append(service._get_access_token())) for _ in range(5)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(tokens, ["token-1"] * 5)
+		self.assertEqual(len(self.stub["oauth"]), 1)
+
+	def test_waits_for_the_worker_that_is_refreshing(self):
+		service = MpesaService()
+		token_file = service._token_file
+		tokens = []
+		waiter = threading.Thread(target=lambda: tokens.append(service._get_access_token()))
+		with token_file.refresh_lock(0):
+			waiter.start()
+			time.sleep(0.2)
+			self.assertEqual(tokens, [])
+			token_file.write("worker-token", time.time() + 600)
+		waiter.join()
+		self.assertEqual(tokens, ["worker-token"])
+		self.assertEqual(self.stub["oauth"], [])
+
+	def test_token_is_shared_as_a_private_json_file(self):
+		service = MpesaService()
+		self.push(service)
+		path = service._token_file.path
+		self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+		self.assertEqual(os.stat(os.path.dirname(path)).st_mode & 0o777, 0o700)
+		with open(path, encoding="utf-8") as handle:
+			self.assertEqual(json.load(handle)["token"], "token-1")
+
+		with open(path, "wb") as handle:
+			handle.write(b"\x80\x04garbage")
+		self.push(MpesaService())
+		self.assertEqual(len(self.stub["oauth"]), 2)
+
+	def test_rejected_token_is_refreshed_once(self):
+		service = MpesaService()
+		self.push(service)
+		self.stub["reject_next"] = True
+		self.assertEqual(self.push(service)["ResponseCode"], "0")
+		self.assertEqual(len(self.stub["oauth"]), 2)
+		self.assertEqual(self.stub["pushes"][-2:], ["Bearer token-1", "Bearer token-2"])
+
+
+@override_settings(MPESA_CALLBACK_TOKEN="test-token", MPESA_WEBHOOK_SECRET="", MPESA_CALLBACK_ALLOWED_IPS=[])
+class StkPushRequestTests(QueryBudgetAssertionsMixin, APITestCase):
+	def setUp(self):
+		client = Client.objects.create(name="Push Client", phone_number="254700000970")
+		self.loan = Loan.objects.create(
+			client=client,
+			amount=Decimal("1000.00"),
+			due_date=timezone.localdate() + timedelta(days=5),
+		)
+		service = patch("loans.tasks.get_mpesa_service")
+		self.service = service.start().return_value
+		self.addCleanup(service.stop)
+		self.service.stk_push.return_value = {
+			"ResponseCode": "0",
+			"ResponseDescription": "Success. Request accepted for processing",
+			"CheckoutRequestID": "ws_CO_970",
+			"MerchantRequestID": "970-1",
+		}
+
+	def queue_push(self):
+		response = self.client.post(
+			reverse("mpesa-stk-push"),
+			{"loan_id": self.loan.id, "phone": "254700000970", "amount": "400.00"},
+			format="json",
+		)
+		self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+		push = StkPushRequest.objects.get(public_id=response.data["request_id"])
+		self.assertTrue(OutboxMessage.objects.filter(task=send_stk_push.name, args=[push.id]).exists())
+		return push
+
+	def status_of(self, push):
+		return self.client.get(reverse("mpesa-stk-push-status", kwargs={"request_id": push.public_id})).data
+
+	def callback(self, result_code, result_desc):
+		url = reverse("mpesa-callback", kwargs={"token": "test-token", "loan_id": self.loan.id})
+		body = {"Body": {"stkCallback": {"CheckoutRequestID": "ws_CO_970", "ResultCode": result_code, "ResultDesc": result_desc}}}
+		self.client.post(url, body, format="json")
+		process_mpesa_callback_inbox()
+
+	def test_web_request_only_records_the_push(self):
+		with CaptureQueriesContext(connection) as captured:
+			push = self.queue_push()
+		writes = [query["sql"] for query in captured if not query["sql"].startswith("SELECT")]
+		self.assertEqual(len([sql for sql in writes if '"loans_stkpushrequest"' in sql]), 1)
+		self.assertEqual(len([sql for sql in writes if '"loans_outboxmessage"' in sql]), 1)
+		self.service.stk_push.assert_not_called()
+		self.assertEqual(self.status_of(push)["state"], StkPushRequest.State.QUEUED)
+
+	def test_worker_sends_and_callback_completes_the_request(self):
+		push = self.queue_push()
+		send_stk_push(push.id)
+		self.assertEqual(self.service.stk_push.call_args.kwargs["account_reference"], f"LOAN-{self.loan.id}")
+		self.assertEqual(self.status_of(push)["state"], StkPushRequest.State.SENT)
+
+		send_stk_push(push.id)
+		self.assertEqual(self.service.stk_push.call_count, 1)
+
+		self.callback(0, "The service request is processed successfully.")
+		with self.assertWithinQueryBudget("mpesa-stk-push-status"):
+			result = self.status_of(push)
+		self.assertEqual(result["state"], StkPushRequest.State.COMPLETED)
+		self.assertEqual(result["result_code"], 0)
+
+	def test_cancelled_and_rejected_pushes_are_failed(self):
+		push = self.queue_push()
+		send_stk_push(push.id)
+		self.callback(1032, "Request cancelled by user")
+		result = self.status_of(push)
+		self.assertEqual((result["state"], result["result_code"]), (StkPushRequest.State.FAILED, 1032))
+
+		self.service.stk_push.return_value = {"ResponseCode": "1", "ResponseDescription": "Invalid PhoneNumber"}
+		rejected = self.queue_push()
+		send_stk_push(rejected.id)
+		result = self.status_of(rejected)
+		self.assertEqual((result["state"], result["result_desc"]), (StkPushRequest.State.FAILED, "Invalid PhoneNumber"))
+
+
+	def test_redelivered_push_prompts_the_customer_once(self):
+		push = self.queue_push()
+
+		def redeliver(**_kwargs):
+			send_stk_push(push.id)
+			return self.service.stk_push.return_value
+
+		self.service.stk_push.side_effect = redeliver
+		send_stk_push(push.id)
+		self.assertEqual(self.service.stk_push.call_count, 1)
+		self.assertEqual(self.status_of(push)["state"], StkPushRequest.State.SENT)
+
+	def test_only_unopened_connections_are_retried(self):
+		refused = requests.ConnectionError(MaxRetryError(None, "/stk", reason=NewConnectionError(None, "refused")))
+		self.service.stk_push.side_effect = refused
+		push = self.queue_push()
+		with self.assertRaises(requests.ConnectionError):
+			send_stk_push(push.id)
+		self.assertEqual(self.status_of(push)["state"], StkPushRequest.State.QUEUED)
+
+		self.service.stk_push.side_effect = requests.ConnectionError(ProtocolError("Connection aborted."))
+		send_stk_push(push.id)
+		self.assertEqual(self.status_of(push)["state"], StkPushRequest.State.FAILED)
+		self.assertEqual(self.service.stk_push.call_count, 2)
+
+	def test_callback_arriving_before_the_push_is_marked_sent(self):
+		push = self.queue_push()
+
+		def answer_early(**_kwargs):
+			self.callback(0, "The service request is processed successfully.")
+			return self.service.stk_push.return_value
+
+		self.service.stk_push.side_effect = answer_early
+		send_stk_push(push.id)
+		result = self.status_of(push)
+		self.assertEqual((result["state"], result["result_code"]), (StkPushRequest.State.COMPLETED, 0))
+
+		self.callback(1032, "Request cancelled by user")
+		self.assertEqual(self.status_of(push)["state"], StkPushRequest.State.COMPLETED)
+
+	def test_early_result_is_found_by_the_indexed_checkout_id(self):
+		self.callback(0, "The service request is processed successfully.")
+		self.assertEqual(MpesaCallbackInbox.objects.get().checkout_request_id, "ws_CO_970")
+		with CaptureQueriesContext(connection) as captured:
+			apply_early_stk_result(self.loan.id, "ws_CO_970")
+		self.assertIn('"loans_mpesacallbackinbox"."checkout_request_id" = ', captured[0]["sql"])
+
+	@override_settings(STK_PUSH_SENDING_TIMEOUT_SECONDS=300)
+	def test_pushes_stuck_in_sending_are_failed_after_the_timeout(self):
+		stuck = self.queue_push()
+		recent = self.queue_push()
+		StkPushRequest.objects.filter(id__in=[stuck.id, recent.id]).update(state=StkPushRequest.State.SENDING)
+		StkPushRequest.objects.filter(id=stuck.id).update(updated_at=timezone.now() - timedelta(minutes=10))
+
+		self.assertEqual(fail_stale_stk_pushes_task(), 1)
+		self.assertEqual(self.status_of(stuck)["state"], StkPushRequest.State.FAILED)
+		self.assertEqual(self.status_of(recent)["state"], StkPushRequest.State.SENDING)
+
+
+class OutboxTests(APITestCase):
+	def setUp(self):
+		client = Client.objects.create(name="Outbox Client", phone_number="254700000990")
+		self.loan = Loan.objects.create(client=client, amount=Decimal("1000.00"), due_date=timezone.localdate() + timedelta(days=5))
+		self.later = timezone.now() + timedelta(minutes=5)
+
+	def create_payment(self, receipt):
+		return Payment.objects.create(loan=self.loan, amount=Decimal("100.00"), mpesa_receipt=receipt, phone="254700000990")
+
+	def test_rolled_back_payment_leaves_no_message(self):
+		with self.assertRaises(RuntimeError):
+			with transaction.atomic():
+				self.create_payment("OBX1")
+				self.assertEqual(OutboxMessage.objects.count(), 2)
+				raise RuntimeError("rollback")
+		self.assertFalse(OutboxMessage.objects.exists())
+
+	@patch("loans.services.outbox.current_app")
+	def test_dispatcher_publishes_due_messages_over_one_producer(self, app):
+		self.create_payment("OBX2")
+		self.create_payment("OBX3")
+
+		self.assertEqual(dispatch_outbox(), {OutboxMessage.Status.DISPATCHED: 2})
+		app.producer_or_acquire.assert_called_once_with()
+		self.assertEqual(
+			[call.args[0] for call in app.send_task.call_args_list],
+			[send_payment_confirmation_sms.name] * 2,
+		)
+		# The debounced payment job waits out its delay in the table.
+		pending = OutboxMessage.objects.get(status=OutboxMessage.Status.PENDING)
+		self.assertEqual(pending.task, apply_payment_effects_task.name)
+
+		self.assertEqual(dispatch_outbox(now=self.later), {OutboxMessage.Status.DISPATCHED: 1})
+		self.assertEqual(app.send_task.call_args.kwargs["args"], [self.loan.client_id])
+		self.assertEqual(dispatch_outbox(now=self.later), {})
+
+	@override_settings(OUTBOX_MAX_ATTEMPTS=2)
+	@patch("loans.services.outbox.current_app")
+	def test_unreachable_broker_backs_off_then_fails(self, app):
+		app.producer_or_acquire.side_effect = ConnectionError("broker down")
+		self.create_payment("OBX4")
+
+		self.assertEqual(dispatch_outbox(now=self.later), {OutboxMessage.Status.PENDING: 2})
+		message = OutboxMessage.objects.get(task=send_payment_confirmation_sms.name)
+		self.assertEqual((message.attempts, message.last_error), (1, "broker down"))
+		self.assertGreater(message.available_at, self.later)
+
+		self.assertEqual(dispatch_outbox(now=self.later), {})
+		self.assertEqual(dispatch_outbox(now=self.later + timedelta(minutes=1)), {OutboxMessage.Status.FAILED: 2})
+
+
+	def test_purge_drops_old_dispatched_messages_only(self):
+		now = timezone.now()
+		old = OutboxMessage.objects.bulk_create(
+			OutboxMessage(task="loans.tasks.x", status=OutboxMessage.Status.DISPATCHED, dispatched_at=now - timedelta(days=8))
+			for _ in range(5)
+		)
+		recent = OutboxMessage.objects.create(task="loans.tasks.x", status=OutboxMessage.Status.DISPATCHED, dispatched_at=now)
+		failed = OutboxMessage.objects.create(task="loans.tasks.x", status=OutboxMessage.Status.FAILED)
+
+		self.assertEqual(purge_outbox(retention_days=7, batch_size=2, now=now), len(old))
+		self.assertEqual(set(OutboxMessage.objects.values_list("id", flat=True)), {recent.id, failed.id})
+
+class FakeTwilio:
+	"""Stands in for the Twilio REST client: each create() waits `latency` seconds and records concurrency."""
+
+	def __init__(self, latency=0.0, failing=()):
+		self.latency = latency
+		self.failing = set(failing)
+		self.sent = []
+		self.active = 0
+		self.peak = 0
+		self.lock = threading.Lock()
+		self.messages = self
+
+	def create(self, body, from_, to):
+		with self.lock:
+			self.active += 1
+			self.peak = max(self.peak, self.active)
+		try:
+			time.sleep(self.latency)
+			if to in self.failing:
+				raise RuntimeError("HTTP 429 Too Many Requests")
+			with self.lock:
+				self.sent.append((to, time.monotonic()))
+		finally:
+			with self.lock:
+				self.active -= 1
+
+
+@override_settings(
+	SMS_PROVIDER="twilio",
+	TWILIO_FROM_NUMBER="+15550000000",
+	TWILIO_WHATSAPP_FROM_NUMBER="whatsapp:+15550000001",
+	ENABLE_WHATSAPP_REMINDERS=False,
+	SMS_DISPATCH_WORKERS=8,
+	SMS_RATE_LIMITS={"twilio": 0},
+)
+class NotificationDispatchTests(APITestCase):
+	def use_provider(self, provider):
+		patcher = patch("loans.services.sms._twilio_client", return_value=provider)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		return provider
+
+	def batch(self, count):
+		return [(f"2547000{index:05d}", f"Reminder {index}") for index in range(count)]
+
+	def test_batch_sends_concurrently_and_logs_in_one_insert(self):
+		provider = self.use_provider(FakeTwilio(latency=0.05))
+
+		started = time.monotonic()
+		with self.assertNumQueries(1):
+			results = send_batch(self.batch(24))
+		elapsed = time.monotonic() - started
+
+		self.assertEqual(results, [True] * 24)
+		self.assertEqual(len(provider.sent), 24)
+		self.assertTrue(2 <= provider.peak <= 8)
+		self.assertLess(elapsed, 24 * 0.05 / 2)
+		self.assertEqual(NotificationLog.objects.filter(success=True, channel=NotificationLog.Channel.SMS).count(), 24)
+
+	@override_settings(SMS_RATE_LIMITS={"twilio": 50})
+	def test_provider_rate_limit_spaces_sends(self):
+		provider = self.use_provider(FakeTwilio())
+		send_batch(self.batch(11))
+		times = sorted(sent_at for _to, sent_at in provider.sent)
+		self.assertGreaterEqual(times[-1] - times[0], 10 * 0.02 * 0.9)
+
+	def test_rate_limiter_hands_out_evenly_spaced_slots(self):
+		now = [100.0]
+		waits = []
+		limiter = RateLimiter(4, clock=lambda: now[0], sleep=waits.append)
+		for _ in range(3):
+			limiter.acquire()
+		now[0] += 1.0
+		limiter.acquire()
+		self.assertEqual(waits, [0.25, 0.5])
+
+	def test_rate_limit_is_shared_by_processes_on_the_host(self):
+		path = os.path.join(settings.SMS_RATE_LIMIT_DIR, "shared-test.slot")
+		now = [100.0]
+		waits = []
+		workers = [RateLimiter(4, clock=lambda: now[0], sleep=waits.append, path=path) for _ in range(2)]
+		for limiter in workers + workers:
+			limiter.acquire()
+		self.assertEqual(waits, [0.25, 0.5, 0.75])
+
+		# A wall clock stepped back by hours must not leave senders waiting for the old schedule.
+		now[0] -= 7200
+		waits.clear()
+		workers[0].acquire()
+		self.assertEqual(waits, [])
+
+	@override_settings(ENABLE_WHATSAPP_REMINDERS=True)
+	def test_failed_whatsapp_falls_back_to_sms_and_results_keep_order(self):
+		self.use_provider(FakeTwilio(failing={"whatsapp:254700000001", "whatsapp:254700000002", "254700000002"}))
+		messages = [("254700000000", "a"), ("254700000001", "b"), ("254700000002", "c")]
+
+		self.assertEqual(send_batch(messages), [True, True, False])
+		logs = NotificationLog.objects.order_by("phone_number", "channel").values_list("phone_number", "channel", "success")
+		self.assertEqual(
+			list(logs),
+			[
+				("254700000000", NotificationLog.Channel.WHATSAPP, True),
+				("254700000001", NotificationLog.Channel.SMS, True),
+				("254700000001", NotificationLog.Channel.WHATSAPP, False),
+				("254700000002", NotificationLog.Channel.SMS, False),
+				("254700000002", NotificationLog.Channel.WHATSAPP, False),
+			],
+		)
+		self.assertEqual(NotificationLog.objects.get(phone_number="254700000002", channel="SMS").error_message, "HTTP 429 Too Many Requests")
+
+	def test_twilio_client_is_shared_until_credentials_change(self):
+		with override_settings(TWILIO_ACCOUNT_SID="AC" + "0" * 32, TWILIO_AUTH_TOKEN="first"):
+			client = _twilio_client()
+			self.assertIs(_twilio_client(), client)
+		with override_settings(TWILIO_ACCOUNT_SID="AC" + "0" * 32, TWILIO_AUTH_TOKEN="second"):
+			self.assertIsNot(_twilio_client(), client)
+
+
+@override_settings(
+	SMS_PROVIDER="twilio",
+	TWILIO_FROM_NUMBER="+15550000000",
+	ENABLE_WHATSAPP_REMINDERS=False,
+	SMS_RATE_LIMITS={"twilio": 0},
+)
+class ReminderPipelineTests(APITestCase):
+	def setUp(self):
+		self.provider = FakeTwilio(latency=0.01)
+		patcher = patch("loans.services.sms._twilio_client", return_value=self.provider)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.today = timezone.localdate()
+
+	def create_loan(self, phone, due_in_days, status=Loan.Status.ACTIVE):
+		client = Client.objects.create(name=f"Reminder {phone}", phone_number=phone)
+		loan = Loan.objects.create(client=client, amount=Decimal("500.00"), due_date=self.today + timedelta(days=due_in_days))
+		Loan.objects.filter(id=loan.id).update(status=status)
+		return loan
+
+	def reminded(self, reminder_type):
+		return set(LoanReminderLog.objects.filter(reminder_type=reminder_type).values_list("loan_id", flat=True))
+
+	def test_overdue_run_claims_sends_and_releases_failures(self):
+		stale = self.create_loan("254700001001", -3)
+		flagged = self.create_loan("254700001002", -3, Loan.Status.OVERDUE)
+		failing = self.create_loan("254700001003", -1, Loan.Status.OVERDUE)
+		reminded = self.create_loan("254700001004", -5, Loan.Status.OVERDUE)
+		LoanReminderLog.objects.create(loan=reminded, reminder_type=LoanReminderLog.ReminderType.OVERDUE)
+		settled = self.create_loan("254700001005", -2, Loan.Status.OVERDUE)
+		Payment.objects.create(loan=settled, amount=Decimal("500.00"), mpesa_receipt="REM1", phone="254700001005")
+		Loan.objects.filter(id=settled.id).update(status=Loan.Status.OVERDUE)
+		self.provider.failing = {"254700001003"}
+
+		report = send_overdue_reminders()
+
+		self.assertEqual(
+			report,
+			{"scanned": 4, "claimed": 3, "sent": 2, "failed": 1, "transitions": 2, "last_id": settled.id, "done": True},
+		)
+		self.assertEqual(self.reminded(LoanReminderLog.ReminderType.OVERDUE), {stale.id, flagged.id, reminded.id})
+		self.assertEqual(Loan.objects.get(id=stale.id).status, Loan.Status.OVERDUE)
+		self.assertEqual(Loan.objects.get(id=settled.id).status, Loan.Status.PAID)
+		self.assertIn("was due on", NotificationLog.objects.get(phone_number="254700001001").message)
+
+		self.provider.failing = set()
+		self.assertEqual(send_overdue_reminders()["sent"], 1)
+		self.assertEqual(self.reminded(LoanReminderLog.ReminderType.OVERDUE), {stale.id, flagged.id, failing.id, reminded.id})
+		self.assertEqual(send_overdue_reminders()["claimed"], 0)
+		self.assertEqual(sorted(to for to, _sent_at in self.provider.sent).count("254700001001"), 1)
+
+	def test_query_count_does_not_grow_with_the_book(self):
+		def run_queries(count, offset):
+			for index in range(count):
+				self.create_loan(f"2547000{offset + index:05d}", 1)
+			with CaptureQueriesContext(connection) as captured:
+				self.assertEqual(send_due_soon_reminders()["sent"], count)
+			return len(captured)
+
+		small = run_queries(3, 2000)
+		self.assertEqual(run_queries(30, 3000), small)
+
+
+@override_settings(
+	SMS_PROVIDER="twilio",
+	TWILIO_FROM_NUMBER="+15550000000",
+	ENABLE_WHATSAPP_REMINDERS=False,
+	SMS_RATE_LIMITS={"twilio": 0},
+	REMINDER_WINDOW_START="08:00",
+	REMINDER_WINDOW_END="08:00:10",
+	REMINDER_RATE_PER_SECOND=2,
+	REMINDER_TICK_SECONDS=30,
+)
+class ReminderScheduleTests(APITestCase):
+	def setUp(self):
+		self.provider = FakeTwilio()
+		patcher = patch("loans.services.sms._twilio_client", return_value=self.provider)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.today = timezone.localdate()
+		self.due_soon = [self.create_loan(f"25470000{index:04d}", 1) for index in range(12)]
+		self.overdue = [self.create_loan(f"25470001{index:04d}", -2) for index in range(3)]
+
+	def create_loan(self, phone, due_in_days):
+		client = Client.objects.create(name=f"Scheduled {phone}", phone_number=phone)
+		return Loan.objects.create(client=client, amount=Decimal("500.00"), due_date=self.today + timedelta(days=due_in_days))
+
+	def at(self, hour, minute, second=0):
+		return timezone.make_aware(datetime.combine(self.today, dt_time(hour, minute, second)))
+
+	def reminder_run(self, reminder_type):
+		return ReminderRun.objects.get(run_date=self.today, reminder_type=reminder_type)
+
+	def test_nothing_is_planned_before_the_window(self):
+		self.assertEqual(run_reminder_schedule(now=self.at(7, 59)), {})
+		self.assertFalse(ReminderRun.objects.exists())
+		self.assertEqual(self.provider.sent, [])
+
+	def test_sends_follow_the_pace_and_progress_is_persisted(self):
+		due_soon, overdue = LoanReminderLog.ReminderType.DUE_SOON, LoanReminderLog.ReminderType.OVERDUE
+		run_reminder_schedule(now=self.at(8, 0, 4))
+
+		# 2/s shared by two types; the three overdue loans are stretched over the 10s window.
+		self.assertEqual((self.reminder_run(due_soon).total, self.reminder_run(due_soon).pace), (12, 1.0))
+		self.assertAlmostEqual(self.reminder_run(overdue).pace, 0.3)
+		self.assertEqual((self.reminder_run(due_soon).sent, self.reminder_run(due_soon).last_loan_id), (4, self.due_soon[3].id))
+		self.assertEqual(self.reminder_run(overdue).sent, 1)
+
+		run_reminder_schedule(now=self.at(8, 0, 4))
+		self.assertEqual(len(self.provider.sent), 5)
+
+		run_reminder_schedule(now=self.at(8, 0, 9))
+		self.assertEqual((self.reminder_run(due_soon).sent, self.reminder_run(overdue).sent), (9, 2))
+		self.assertEqual(len({to for to, _sent_at in self.provider.sent}), 11)
+
+		# The window closed at 08:00:10: the runs are closed unfinished and nothing more is sent.
+		report = run_reminder_schedule(now=self.at(8, 0, 10))
+		self.assertEqual(report, {f"{self.today}:{due_soon}": {"closed": True}, f"{self.today}:{overdue}": {"closed": True}})
+		self.assertEqual(run_reminder_schedule(now=self.at(8, 1)), {})
+		self.assertEqual(len(self.provider.sent), 11)
+		self.assertEqual(ReminderRun.objects.filter(finished_at__isnull=True).count(), 0)
+
+		# The unreminded overdue loan is planned into the next day's window.
+		run_reminder_schedule(now=self.at(8, 0, 4) + timedelta(days=1))
+		self.assertEqual(ReminderRun.objects.get(run_date=self.today + timedelta(days=1), reminder_type=overdue).total, 1)
+
+	@override_settings(REMINDER_WINDOW_END="11:00")
+	def test_small_sets_are_spread_over_a_realistic_window(self):
+		# 12 and 3 loans over three hours earn far less than one send per 30s tick.
+		sends = []
+		tick = self.at(8, 0)
+		while tick <= self.at(11, 1):
+			before = len(self.provider.sent)
+			run_reminder_schedule(now=tick)
+			sends.extend([tick] * (len(self.provider.sent) - before))
+			tick += timedelta(seconds=30)
+
+		self.assertEqual(len(sends), 15)
+		self.assertEqual(self.reminder_run(LoanReminderLog.ReminderType.DUE_SOON).sent, 12)
+		self.assertEqual(self.reminder_run(LoanReminderLog.ReminderType.OVERDUE).sent, 3)
+		self.assertLessEqual(max(sends.count(when) for when in sends), 2)
+		self.assertGreater(sends[0], self.at(8, 10))
+		self.assertGreater(sends[-1], self.at(10, 50))
+
+	def test_unfinished_run_from_a_previous_day_is_closed(self):
+		stale = ReminderRun.objects.create(
+			reminder_type=LoanReminderLog.ReminderType.DUE_SOON,
+			run_date=self.today - timedelta(days=1),
+			total=5,
+			pace=1.0,
+			paced_at=self.at(8, 0) - timedelta(days=1),
+		)
+		report = run_reminder_schedule(now=self.at(7, 0))
+		self.assertEqual(report, {f"{stale.run_date}:{stale.reminder_type}": {"closed": True}})
+		stale.refresh_from_db()
+		self.assertIsNotNone(stale.finished_at)
+		self.assertEqual(self.provider.sent, [])
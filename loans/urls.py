@@ -7,9 +7,11 @@ from .views import (
     DailyCollectionsReportView,
     LoanApprovalView,
     MonthlyPerformanceReportView,
+    MpesaSTKPushStatusView,
     MpesaSTKPushView,
     OutstandingLoansReportView,
     OverdueLoansReportView,
+    PrometheusMetricsView,
     SystemHealthView,
     SystemMetricsView,
     health_check,
@@ -26,6 +28,7 @@ urlpatterns = [
     path("client/loans/apply/", ClientLoanApplicationView.as_view(), name="client-loan-apply"),
     path("client/payments/history/", ClientPaymentHistoryView.as_view(), name="client-payment-history"),
     path("mpesa/stk-push/", MpesaSTKPushView.as_view(), name="mpesa-stk-push"),
+    path("mpesa/stk-push/<uuid:request_id>/", MpesaSTKPushStatusView.as_view(), name="mpesa-stk-push-status"),
     path("mpesa/callback/<str:token>/<int:loan_id>/", mpesa_callback, name="mpesa-callback"),
     path("loans/<int:loan_id>/approve/", LoanApprovalView.as_view(), name="loan-approve"),
     path("reports/daily-collections/", DailyCollectionsReportView.as_view(), name="report-daily-collections"),
@@ -34,4 +37,5 @@ urlpatterns = [
     path("reports/monthly-performance/", MonthlyPerformanceReportView.as_view(), name="report-monthly-performance"),
     path("system/health/", SystemHealthView.as_view(), name="system-health"),
     path("system/metrics/", SystemMetricsView.as_view(), name="system-metrics"),
+    path("system/metrics/prometheus/", PrometheusMetricsView.as_view(), name="system-metrics-prometheus"),
 ]
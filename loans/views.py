@@ -1,28 +1,32 @@
 import hashlib
 import hmac
+import json
 import secrets
-from datetime import timedelta
+from datetime import date, datetime
 from decimal import Decimal
 
 from django.conf import settings
-from django.db import connection
-from django.db import IntegrityError
-from django.db.models import Count, Q, Sum
+from django.db import connection, transaction
+from django.db.models import Count, Max, Q, Sum
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils import timezone
-from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
-from drf_spectacular.utils import extend_schema
+from django.utils.http import parse_etags
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import OpenApiParameter, extend_schema
 from rest_framework import status
 from rest_framework.authentication import BasicAuthentication, SessionAuthentication
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import ValidationError
 from rest_framework.parsers import JSONParser
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 from rest_framework.views import APIView
 
 from .auth import ClientTokenAuthentication
-from .models import AuditLog, Client, ClientAccessToken, ClientOTP, Loan, Payment, SuspiciousActivityLog
-from .permissions import IsClientAuthenticated, IsLoanOfficer
+from .models import Client, ClientAccessToken, ClientOTP, Loan, Payment, StkPushRequest, SuspiciousActivityLog
+from .pagination import MAX_PAGE_SIZE, decode_cursor, encode_cursor, page_size_from
+from .permissions import IsClientAuthenticated, IsLoanOfficer, IsSystemAutomation
 from .serializers import (
     ClientLoanSummarySerializer,
     ClientLoanApplicationSerializer,
@@ -37,11 +41,22 @@ from .serializers import (
     OTPVerifySerializer,
     OutstandingLoansSerializer,
     OverdueLoansSerializer,
+    PaymentHistoryPageSerializer,
     PaymentHistorySerializer,
     STKPushSerializer,
+    StkPushRequestSerializer,
 )
-from .services.mpesa import MpesaService
+from .services import outbox
+from .services.audit import get_audit_buffer
+from .services.callbacks import record_callback
+from .services.collections import collections_between
+from .services.latency import latency_report, render_prometheus
+from .services.report_cache import cached_client_summary, cached_report, client_summary_version
 from .services.sms import send_with_fallback
+from .tasks import send_stk_push
+
+OVERDUE_STREAM_CHUNK_SIZE = 500
+PAYMENT_HISTORY_PAGE_SIZE = 50
 
 
 @extend_schema(responses=HealthCheckResponseSerializer)
@@ -55,30 +70,35 @@ class MpesaSTKPushView(APIView):
     parser_classes = [JSONParser]
     permission_classes = [AllowAny]
 
-    @extend_schema(request=STKPushSerializer, responses=dict)
+    @extend_schema(request=STKPushSerializer, responses={202: StkPushRequestSerializer})
     def post(self, request):
         serializer = STKPushSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         loan = serializer.validated_data["loan"]
-        phone = serializer.validated_data["phone"]
-        amount = serializer.validated_data["amount"]
 
         if loan.status == Loan.Status.PAID:
             return Response({"detail": "Loan already paid."}, status=status.HTTP_400_BAD_REQUEST)
 
-        callback_url = (
-            f"{settings.MPESA_CALLBACK_BASE_URL.rstrip('/')}"
-            f"/api/mpesa/callback/{settings.MPESA_CALLBACK_TOKEN}/{loan.id}/"
-        )
+        # The Daraja round-trip happens in a Celery worker; callers poll the status endpoint.
+        with transaction.atomic():
+            push = StkPushRequest.objects.create(
+                loan=loan,
+                phone=serializer.validated_data["phone"],
+                amount=serializer.validated_data["amount"],
+            )
+            outbox.enqueue(send_stk_push, push.id)
+        return Response(StkPushRequestSerializer(push).data, status=status.HTTP_202_ACCEPTED)
 
-        result = MpesaService().stk_push(
-            phone=phone,
-            amount=amount,
-            account_reference=f"LOAN-{loan.id}",
-            transaction_desc=f"Loan repayment {loan.id}",
-            callback_url=callback_url,
-        )
-        return Response(result)
+
+class MpesaSTKPushStatusView(APIView):
+    permission_classes = [AllowAny]
+
+    @extend_schema(responses=StkPushRequestSerializer)
+    def get(self, request, request_id):
+        push = StkPushRequest.objects.filter(public_id=request_id).first()
+        if push is None:
+            return Response({"detail": "STK push request not found."}, status=status.HTTP_404_NOT_FOUND)
+        return Response(StkPushRequestSerializer(push).data)
 
 
 @extend_schema(request=dict, responses=MpesaCallbackAckSerializer)
@@ -104,72 +124,7 @@ def mpesa_callback(request, token: str, loan_id: int):
         if remote_ip not in allowed_ips:
             return Response({"detail": "Forbidden source."}, status=status.HTTP_403_FORBIDDEN)
 
-    payload = request.data or {}
-    stk_callback = payload.get("Body", {}).get("stkCallback", {})
-    if stk_callback.get("ResultCode") != 0:
-        return Response({"ResultCode": 0, "ResultDesc": "Accepted"})
-
-    loan = Loan.objects.filter(id=loan_id).first()
-    if not loan:
-        return Response({"ResultCode": 0, "ResultDesc": "Accepted"})
-
-    metadata_items = stk_callback.get("CallbackMetadata", {}).get("Item", [])
-    metadata = {item.get("Name"): item.get("Value") for item in metadata_items if item.get("Name")}
-    amount = metadata.get("Amount")
-    mpesa_receipt = metadata.get("MpesaReceiptNumber")
-    phone = str(metadata.get("PhoneNumber") or loan.client.phone_number)
-
-    if not mpesa_receipt or amount is None:
-        return Response({"ResultCode": 0, "ResultDesc": "Accepted"})
-
-    try:
-        amount_decimal = Decimal(str(amount))
-    except Exception:
-        SuspiciousActivityLog.objects.create(
-            category="INVALID_AMOUNT",
-            reference=f"loan:{loan.id}",
-            severity="HIGH",
-            details={"amount": amount, "receipt": mpesa_receipt},
-        )
-        return Response({"ResultCode": 0, "ResultDesc": "Accepted"})
-
-    if amount_decimal <= 0:
-        SuspiciousActivityLog.objects.create(
-            category="NON_POSITIVE_AMOUNT",
-            reference=f"loan:{loan.id}",
-            severity="HIGH",
-            details={"amount": str(amount_decimal), "receipt": mpesa_receipt},
-        )
-        return Response({"ResultCode": 0, "ResultDesc": "Accepted"})
-
-    if amount_decimal > loan.balance:
-        SuspiciousActivityLog.objects.create(
-            category="OVERPAYMENT_ATTEMPT",
-            reference=f"loan:{loan.id}",
-            severity="HIGH",
-            details={"amount": str(amount_decimal), "balance": str(loan.balance), "receipt": mpesa_receipt},
-        )
-        return Response({"ResultCode": 0, "ResultDesc": "Accepted"})
-
-    if Payment.objects.filter(mpesa_receipt=mpesa_receipt).exists():
-        SuspiciousActivityLog.objects.get_or_create(
-            category="DUPLICATE_RECEIPT",
-            reference=mpesa_receipt,
-            defaults={"severity": "MEDIUM", "details": {"loan_id": loan.id}},
-        )
-        return Response({"ResultCode": 0, "ResultDesc": "Accepted"})
-
-    try:
-        Payment.objects.create(
-            loan=loan,
-            amount=amount_decimal,
-            mpesa_receipt=mpesa_receipt,
-            phone=phone,
-            raw_payload=payload,
-        )
-    except IntegrityError:
-        pass
-
+    record_callback(loan_id, request.data or {})
     return Response({"ResultCode": 0, "ResultDesc": "Accepted"})
 
 
@@ -217,30 +172,101 @@ class ClientLoanSummaryView(APIView):
 
     @extend_schema(responses=dict)
     def get(self, request):
-        loans = Loan.objects.filter(client=request.user).order_by("-created_at")
-        serialized = ClientLoanSummarySerializer(loans, many=True)
-        return Response(
-            {
-                "client": {
-                    "name": request.user.name,
-                    "phone_number": request.user.phone_number,
-                    "credit_score": request.user.credit_score,
-                    "max_loan_limit": request.user.max_loan_limit,
-                },
-                "loans": serialized.data,
-            }
-        )
+        client = request.user
+        version = client_summary_version(client.id)
+        etag = f'"{client.id}-{version}"'
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+
+            def build():
+                if client.get_deferred_fields():
+                    client.refresh_from_db(fields=["name", "phone_number", "credit_score", "max_loan_limit"])
+                loans = Loan.objects.filter(client=client).with_financials().order_by("-created_at")
+                return {
+                    "client": {
+                        "name": client.name,
+                        "phone_number": client.phone_number,
+                        "credit_score": client.credit_score,
+                        "max_loan_limit": client.max_loan_limit,
+                    },
+                    "loans": ClientLoanSummarySerializer(loans, many=True).data,
+                }
+
+            response = Response(cached_client_summary(client.id, version, build))
+        response["ETag"] = etag
+        response["Cache-Control"] = "private, no-cache"
+        return response
 
 
 class ClientPaymentHistoryView(APIView):
     authentication_classes = [ClientTokenAuthentication]
     permission_classes = [IsClientAuthenticated]
 
-    @extend_schema(responses=PaymentHistorySerializer(many=True))
+    @extend_schema(
+        parameters=[
+            OpenApiParameter("cursor", str, description="next_cursor from the previous page (older payments)"),
+            OpenApiParameter("since", str, description="sync_token from an earlier response; returns only payments recorded since"),
+            OpenApiParameter("page_size", int, description=f"Rows per page (max {MAX_PAGE_SIZE})"),
+        ],
+        responses=PaymentHistoryPageSerializer,
+    )
     def get(self, request):
-        payments = Payment.objects.filter(loan__client=request.user).select_related("loan").order_by("-paid_at")
-        serialized = PaymentHistorySerializer(payments, many=True)
-        return Response({"results": serialized.data})
+        payments = Payment.objects.filter(loan__client=request.user)
+        page_size = page_size_from(request, default=PAYMENT_HISTORY_PAGE_SIZE)
+        since = request.query_params.get("since")
+        cursor = request.query_params.get("cursor")
+
+        if since:
+            # Incremental sync walks forward by id, not paid_at: M-Pesa can report a payment with a transaction
+            # time older than rows the app already holds, and it must still come through.
+            payment_id = _sync_key(since)
+            rows = list(payments.filter(id__gt=payment_id).order_by("id")[: page_size + 1])
+            page = rows[:page_size]
+            sync_token = encode_cursor(page[-1].id) if page else since
+            return Response(
+                {
+                    "results": PaymentHistorySerializer(page, many=True).data,
+                    "next_cursor": None,
+                    "sync_token": sync_token,
+                    "has_more": len(rows) > page_size,
+                }
+            )
+
+        if cursor:
+            paid_at, payment_id = _payment_key(cursor, "cursor")
+            payments = payments.filter(Q(paid_at__lt=paid_at) | Q(paid_at=paid_at, id__lt=payment_id))
+        rows = list(payments.order_by("-paid_at", "-id")[: page_size + 1])
+        page = rows[:page_size]
+        next_cursor = encode_cursor(page[-1].paid_at.isoformat(), page[-1].id) if len(rows) > page_size else None
+        sync_token = None
+        if not cursor:
+            # The newest payment by paid_at need not be the last one recorded, so the token is the highest id.
+            sync_token = encode_cursor(payments.aggregate(last_id=Max("id"))["last_id"] or 0)
+        return Response(
+            {
+                "results": PaymentHistorySerializer(page, many=True).data,
+                "next_cursor": next_cursor,
+                "sync_token": sync_token,
+                "has_more": next_cursor is not None,
+            }
+        )
+
+
+def _sync_key(token: str) -> int:
+    (payment_id,) = decode_cursor(token, 1, param="since")
+    try:
+        return int(payment_id)
+    except ValueError:
+        raise ValidationError({"since": "Invalid cursor."})
+
+
+def _payment_key(token: str, param: str):
+    paid_at, payment_id = decode_cursor(token, 2, param=param)
+    try:
+        return datetime.fromisoformat(paid_at), int(payment_id)
+    except ValueError:
+        raise ValidationError({param: "Invalid cursor."})
 
 
 class ClientLoanApplicationView(APIView):
@@ -307,70 +333,132 @@ class LoanApprovalView(APIView):
         )
 
 
-@method_decorator(cache_page(60 * 5), name="dispatch")
 class DailyCollectionsReportView(APIView):
     authentication_classes = [SessionAuthentication, BasicAuthentication]
     permission_classes = [IsAuthenticated]
 
     @extend_schema(responses=DailyCollectionsSerializer)
     def get(self, request):
-        today = timezone.localdate()
-        payments = Payment.objects.filter(paid_at__date=today)
-        total = payments.aggregate(total=Sum("amount"))["total"] or Decimal("0.00")
-        return Response({"date": today, "total_collections": total, "payments_count": payments.count()})
+        def build():
+            today = timezone.localdate()
+            collections = collections_between(today, today)
+            return {"date": today, "total_collections": collections["total"], "payments_count": collections["payments_count"]}
+
+        return Response(cached_report("daily-collections", build))
 
 
-@method_decorator(cache_page(60 * 5), name="dispatch")
 class OutstandingLoansReportView(APIView):
     authentication_classes = [SessionAuthentication, BasicAuthentication]
     permission_classes = [IsAuthenticated]
 
     @extend_schema(responses=OutstandingLoansSerializer)
     def get(self, request):
-        loans = Loan.objects.exclude(status=Loan.Status.PAID)
-        outstanding_total = Decimal("0.00")
-        for loan in loans:
-            outstanding_total += loan.balance
-        return Response({"outstanding_loans_count": loans.count(), "outstanding_total": outstanding_total})
+        def build():
+            summary = Loan.objects.exclude(status=Loan.Status.PAID).with_financials().aggregate(
+                outstanding_loans_count=Count("id"),
+                outstanding_total=Sum("balance_due"),
+            )
+            return {
+                "outstanding_loans_count": summary["outstanding_loans_count"],
+                "outstanding_total": summary["outstanding_total"] or Decimal("0.00"),
+            }
+
+        return Response(cached_report("outstanding-loans", build))
 
 
-@method_decorator(cache_page(60 * 5), name="dispatch")
 class OverdueLoansReportView(APIView):
     authentication_classes = [SessionAuthentication, BasicAuthentication]
     permission_classes = [IsAuthenticated]
 
-    @extend_schema(responses=OverdueLoansSerializer)
+    @extend_schema(
+        parameters=[
+            OpenApiParameter("cursor", str, description="next_cursor from the previous page"),
+            OpenApiParameter("page_size", int, description=f"Rows per page (max {MAX_PAGE_SIZE})"),
+            OpenApiParameter("stream", bool, description="Stream every overdue loan as one JSON document"),
+        ],
+        responses=OverdueLoansSerializer,
+    )
     def get(self, request):
         today = timezone.localdate()
-        overdue_loans = Loan.objects.filter(due_date__lt=today).exclude(status=Loan.Status.PAID)
-        return Response({"overdue_count": overdue_loans.count(), "results": ClientLoanSummarySerializer(overdue_loans, many=True).data})
+        overdue = Loan.objects.filter(
+            status__in=[Loan.Status.ACTIVE, Loan.Status.OVERDUE],
+            due_date__lt=today,
+        )
+        if request.query_params.get("stream", "").lower() in ("1", "true"):
+            return self._stream(overdue, today)
+
+        # The COUNT over every overdue loan runs once per report version and is shared by all pages, so walking
+        # the pages after a payment costs one count rather than one per page.
+        overdue_count = cached_report("overdue-loans-count", overdue.count)
+        page_size = page_size_from(request)
+        cursor = request.query_params.get("cursor")
+        if cursor:
+            due_date, loan_id = decode_cursor(cursor, 2)
+            try:
+                overdue = overdue.filter(
+                    Q(due_date__gt=date.fromisoformat(due_date)) | Q(due_date=date.fromisoformat(due_date), id__gt=int(loan_id))
+                )
+            except ValueError:
+                raise ValidationError({"cursor": "Invalid cursor."})
+
+        def build():
+            # Page the bare (due_date, id) keys first so the payment aggregation only runs for one page.
+            loan_ids = list(overdue.order_by("due_date", "id").values_list("id", flat=True)[: page_size + 1])
+            page = list(
+                Loan.objects.filter(id__in=loan_ids[:page_size]).with_financials(today=today).order_by("due_date", "id")
+            )
+            next_cursor = None
+            if len(loan_ids) > page_size:
+                next_cursor = encode_cursor(page[-1].due_date.isoformat(), page[-1].id)
+            return {
+                "overdue_count": overdue_count,
+                "results": ClientLoanSummarySerializer(page, many=True).data,
+                "next_cursor": next_cursor,
+            }
+
+        return Response(cached_report(f"overdue-loans:{page_size}:{cursor or ''}", build))
+
+    def _stream(self, overdue, today):
+        rows = overdue.with_financials(today=today).order_by("due_date", "id").iterator(chunk_size=OVERDUE_STREAM_CHUNK_SIZE)
+        serializer = ClientLoanSummarySerializer()
+
+        def generate():
+            count = 0
+            buffer = ['{"results":[']
+            for loan in rows:
+                buffer.append(("," if count else "") + json.dumps(serializer.to_representation(loan), cls=JSONEncoder))
+                count += 1
+                if len(buffer) >= OVERDUE_STREAM_CHUNK_SIZE:
+                    yield "".join(buffer)
+                    buffer = []
+            buffer.append(f'],"overdue_count":{count},"next_cursor":null}}')
+            yield "".join(buffer)
+
+        return StreamingHttpResponse(generate(), content_type="application/json")
 
 
-@method_decorator(cache_page(60 * 5), name="dispatch")
 class MonthlyPerformanceReportView(APIView):
     authentication_classes = [SessionAuthentication, BasicAuthentication]
     permission_classes = [IsAuthenticated]
 
     @extend_schema(responses=MonthlyPerformanceSerializer)
     def get(self, request):
-        today = timezone.localdate()
-        month_start = today.replace(day=1)
-        monthly_payments = Payment.objects.filter(paid_at__date__gte=month_start, paid_at__date__lte=today)
-        monthly_total = monthly_payments.aggregate(total=Sum("amount"))["total"] or Decimal("0.00")
-        loan_summary = Loan.objects.aggregate(
-            total_loans=Count("id"),
-            paid_loans=Count("id", filter=Q(status=Loan.Status.PAID)),
-            overdue_loans=Count("id", filter=Q(status=Loan.Status.OVERDUE)),
-        )
-
-        return Response(
-            {
+        def build():
+            today = timezone.localdate()
+            month_start = today.replace(day=1)
+            loan_summary = Loan.objects.aggregate(
+                total_loans=Count("id"),
+                paid_loans=Count("id", filter=Q(status=Loan.Status.PAID)),
+                overdue_loans=Count("id", filter=Q(status=Loan.Status.OVERDUE)),
+            )
+            return {
                 "month_start": month_start,
                 "as_of": today,
-                "collections": {"total": monthly_total, "payments_count": monthly_payments.count()},
+                "collections": collections_between(month_start, today),
                 "loans": loan_summary,
             }
-        )
+
+        return Response(cached_report("monthly-performance", build))
 
 
 class SystemHealthView(APIView):
@@ -402,15 +490,7 @@ class SystemMetricsView(APIView):
     @extend_schema(responses=dict)
     def get(self, request):
         now = timezone.now()
-        since = now - timedelta(minutes=15)
-        recent_audits = AuditLog.objects.filter(created_at__gte=since)
-
-        durations = [
-            row.metadata.get("duration_ms")
-            for row in recent_audits
-            if isinstance(row.metadata, dict) and row.metadata.get("duration_ms") is not None
-        ]
-        avg_duration = round(sum(durations) / len(durations), 2) if durations else 0
+        latency = latency_report()
 
         return Response(
             {
@@ -420,8 +500,24 @@ class SystemMetricsView(APIView):
                 "overdue_loans": Loan.objects.filter(status=Loan.Status.OVERDUE).count(),
                 "payment_count": Payment.objects.count(),
                 "unresolved_suspicious_events": SuspiciousActivityLog.objects.filter(resolved=False).count(),
-                "api_requests_last_15m": recent_audits.count(),
-                "avg_api_duration_ms_last_15m": avg_duration,
-                "error_requests_last_15m": recent_audits.filter(status_code__gte=500).count(),
+                "api_requests_last_15m": latency["overall"]["count"],
+                "avg_api_duration_ms_last_15m": latency["overall"]["avg_ms"],
+                "api_latency_ms_last_15m": {
+                    "p50": latency["overall"]["p50"],
+                    "p95": latency["overall"]["p95"],
+                    "p99": latency["overall"]["p99"],
+                },
+                "error_requests_last_15m": latency["errors"],
+                "endpoints_last_15m": latency["endpoints"],
+                "audit_buffer": get_audit_buffer().stats() if settings.AUDIT_LOG_MODE != "sync" else None,
             }
         )
+
+
+class PrometheusMetricsView(APIView):
+    authentication_classes = []
+    permission_classes = [IsSystemAutomation]
+
+    @extend_schema(responses={(200, "text/plain"): OpenApiTypes.STR})
+    def get(self, request):
+        return HttpResponse(render_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")
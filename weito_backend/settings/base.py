@@ -12,6 +12,9 @@ SECRET_KEY = os.getenv("DJANGO_SECRET_KEY")
 if not SECRET_KEY:
     raise RuntimeError("DJANGO_SECRET_KEY is required")
 
+# Runtime state the workers on one host share (caches, the Daraja token); owned by the app, not world-writable /tmp.
+APP_DATA_DIR = Path(os.getenv("APP_DATA_DIR", str(BASE_DIR / "var")))
+
 DEBUG = os.getenv("DJANGO_DEBUG", "False").lower() == "true"
 ALLOWED_HOSTS = [host.strip() for host in os.getenv("DJANGO_ALLOWED_HOSTS", "localhost,127.0.0.1").split(",") if host.strip()]
 
@@ -37,6 +40,7 @@ MIDDLEWARE = [
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "loans.middleware.AuditLogMiddleware",
+    "loans.middleware.QueryBudgetMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -122,6 +126,25 @@ MPESA_WEBHOOK_SECRET = os.getenv("MPESA_WEBHOOK_SECRET", "")
 MPESA_CALLBACK_ALLOWED_IPS = [
     ip.strip() for ip in os.getenv("MPESA_CALLBACK_ALLOWED_IPS", "").split(",") if ip.strip()
 ]
+MPESA_TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv("MPESA_TOKEN_REFRESH_MARGIN_SECONDS", "60"))
+MPESA_TOKEN_DIR = os.getenv("MPESA_TOKEN_DIR", str(APP_DATA_DIR / "mpesa"))
+MPESA_HTTP_POOL_SIZE = int(os.getenv("MPESA_HTTP_POOL_SIZE", "10"))
+# A push still SENDING after this long belongs to a worker that died mid-call (Daraja calls time out at 30s).
+STK_PUSH_SENDING_TIMEOUT_SECONDS = int(os.getenv("STK_PUSH_SENDING_TIMEOUT_SECONDS", "300"))
+PAYMENT_EFFECTS_DELAY_SECONDS = int(os.getenv("PAYMENT_EFFECTS_DELAY_SECONDS", "5"))
+MPESA_INBOX_DRAIN_SECONDS = float(os.getenv("MPESA_INBOX_DRAIN_SECONDS", "5"))
+MPESA_INBOX_MAX_ATTEMPTS = int(os.getenv("MPESA_INBOX_MAX_ATTEMPTS", "5"))
+MPESA_INBOX_RETENTION_DAYS = int(os.getenv("MPESA_INBOX_RETENTION_DAYS", "30"))
+# broker: the dispatcher publishes due outbox messages to Celery; inline: it runs them in its own process.
+OUTBOX_DISPATCH_MODE = os.getenv("OUTBOX_DISPATCH_MODE", "broker").lower()
+OUTBOX_DISPATCH_SECONDS = float(os.getenv("OUTBOX_DISPATCH_SECONDS", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+# Due-soon and overdue reminders are spread over this local-time window, sharing REMINDER_RATE_PER_SECOND.
+REMINDER_WINDOW_START = os.getenv("REMINDER_WINDOW_START", "08:00")
+REMINDER_WINDOW_END = os.getenv("REMINDER_WINDOW_END", "11:00")
+REMINDER_RATE_PER_SECOND = float(os.getenv("REMINDER_RATE_PER_SECOND", "2"))
+REMINDER_TICK_SECONDS = float(os.getenv("REMINDER_TICK_SECONDS", "30"))
 
 SMS_PROVIDER = os.getenv("SMS_PROVIDER", "twilio")
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID", "")
@@ -129,21 +152,88 @@ TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN", "")
 TWILIO_FROM_NUMBER = os.getenv("TWILIO_FROM_NUMBER", "")
 TWILIO_WHATSAPP_FROM_NUMBER = os.getenv("TWILIO_WHATSAPP_FROM_NUMBER", "")
 ENABLE_WHATSAPP_REMINDERS = os.getenv("ENABLE_WHATSAPP_REMINDERS", "False").lower() == "true"
+SMS_DISPATCH_WORKERS = int(os.getenv("SMS_DISPATCH_WORKERS", "8"))
+# Messages per second per provider, shared by every worker process on the host through a slot file in
+# SMS_RATE_LIMIT_DIR; 0 disables the limit.
+SMS_RATE_LIMITS = {"twilio": float(os.getenv("TWILIO_RATE_LIMIT_PER_SECOND", "10"))}
+SMS_RATE_LIMIT_DIR = os.getenv("SMS_RATE_LIMIT_DIR", str(APP_DATA_DIR / "sms"))
 
 FIELD_ENCRYPTION_KEY = os.getenv("FIELD_ENCRYPTION_KEY", "")
+# Decrypt-only keys kept while `rotate_encryption_keys` moves data onto FIELD_ENCRYPTION_KEY.
+FIELD_ENCRYPTION_PREVIOUS_KEYS = [
+    key.strip() for key in os.getenv("FIELD_ENCRYPTION_PREVIOUS_KEYS", "").split(",") if key.strip()
+]
+# Keep the SECRET_KEY-derived key (used before FIELD_ENCRYPTION_KEY was set) readable; turn off once rotated.
+FIELD_ENCRYPTION_LEGACY_KEY = os.getenv("FIELD_ENCRYPTION_LEGACY_KEY", "True").lower() == "true"
 DATA_HASH_SALT = os.getenv("DATA_HASH_SALT", SECRET_KEY)
 SYSTEM_AUTOMATION_TOKEN = os.getenv("SYSTEM_AUTOMATION_TOKEN", "")
 DB_BACKUP_DIR = os.getenv("DB_BACKUP_DIR", str(BASE_DIR / "backups"))
 ADMIN_ALERT_PHONE = os.getenv("ADMIN_ALERT_PHONE", "")
 
+AUDIT_LOG_MODE = os.getenv("AUDIT_LOG_MODE", "buffered").lower()
+AUDIT_LOG_BUFFER_SIZE = int(os.getenv("AUDIT_LOG_BUFFER_SIZE", "10000"))
+AUDIT_LOG_BATCH_SIZE = int(os.getenv("AUDIT_LOG_BATCH_SIZE", "500"))
+AUDIT_LOG_FLUSH_SECONDS = float(os.getenv("AUDIT_LOG_FLUSH_SECONDS", "2"))
+AUDIT_LOG_OVERFLOW_POLICY = os.getenv("AUDIT_LOG_OVERFLOW_POLICY", "drop_oldest").lower()
+
+LATENCY_METRICS_PATH = os.getenv("LATENCY_METRICS_PATH", str(APP_DATA_DIR / "weito-latency.bin"))
+LATENCY_METRICS_MAX_SERIES = int(os.getenv("LATENCY_METRICS_MAX_SERIES", "256"))
+LATENCY_WINDOW_MINUTES = int(os.getenv("LATENCY_WINDOW_MINUTES", "15"))
+
+QUERY_BUDGET_ENABLED = os.getenv("QUERY_BUDGET_ENABLED", "False").lower() == "true"
+QUERY_BUDGET_DEFAULT = int(os.getenv("QUERY_BUDGET_DEFAULT", "10"))
+QUERY_BUDGET_SLOW_MS = float(os.getenv("QUERY_BUDGET_SLOW_MS", "500"))
+# Per url_name query ceilings for the view and the middleware below QueryBudgetMiddleware. The audit log INSERT
+# is written afterwards by AuditLogMiddleware and is not counted.
+QUERY_BUDGETS = {
+    "health-check": 1,
+    "client-request-otp": 3,
+    "client-verify-otp": 5,
+    "client-loan-summary": 4,
+    "client-loan-apply": 5,
+    "client-payment-history": 4,
+    "mpesa-stk-push": 4,
+    "mpesa-stk-push-status": 2,
+    "mpesa-callback": 3,
+    "loan-approve": 5,
+    "report-daily-collections": 2,
+    "report-outstanding-loans": 3,
+    "report-overdue-loans": 4,
+    "report-monthly-performance": 3,
+    "system-health": 2,
+    "system-metrics": 7,
+    "system-metrics-prometheus": 1,
+}
+
+REPORT_CACHE_LOCATION = os.getenv("REPORT_CACHE_LOCATION", str(APP_DATA_DIR / "report-cache"))
+REPORT_CACHE_TIMEOUT = int(os.getenv("REPORT_CACHE_TIMEOUT", "86400"))
+CLIENT_TOKEN_CACHE_LOCATION = os.getenv("CLIENT_TOKEN_CACHE_LOCATION", str(APP_DATA_DIR / "token-cache"))
+CLIENT_TOKEN_CACHE_SECONDS = int(os.getenv("CLIENT_TOKEN_CACHE_SECONDS", "60"))
+CLIENT_TOKEN_TOUCH_SECONDS = int(os.getenv("CLIENT_TOKEN_TOUCH_SECONDS", "60"))
+
 CACHES = {
     "default": {
         "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
         "LOCATION": "weito-backend-cache",
         "TIMEOUT": 300,
-    }
+    },
+    # Shared by every worker on the host so all officers see the same report; entries are invalidated by
+    # version bumps on payment/loan changes, the timeout only bounds how long superseded versions linger.
+    "reports": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": REPORT_CACHE_LOCATION,
+        "TIMEOUT": REPORT_CACHE_TIMEOUT,
+    },
+    # Validated client tokens, shared across workers; revocation deletes the entry on commit.
+    "tokens": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": CLIENT_TOKEN_CACHE_LOCATION,
+        "TIMEOUT": CLIENT_TOKEN_CACHE_SECONDS,
+    },
 }
 
+TEST_RUNNER = "loans.testing.TestRunner"
+
 CORS_ALLOWED_ORIGINS = [
     origin.strip()
     for origin in os.getenv("CORS_ALLOWED_ORIGINS", "http://localhost:3000,http://127.0.0.1:3000,http://localhost:5173,http://127.0.0.1:5173").split(",")
@@ -158,13 +248,29 @@ CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = TIME_ZONE
 
 CELERY_BEAT_SCHEDULE = {
-    "send-due-soon-reminders-daily": {
-        "task": "loans.tasks.send_due_soon_reminders",
-        "schedule": crontab(hour=8, minute=0),
+    "drain-mpesa-callback-inbox": {
+        "task": "loans.tasks.process_mpesa_callback_inbox",
+        "schedule": MPESA_INBOX_DRAIN_SECONDS,
+    },
+    "purge-mpesa-callback-inbox": {
+        "task": "loans.tasks.purge_mpesa_callback_inbox",
+        "schedule": crontab(hour=3, minute=45),
+    },
+    "dispatch-outbox": {
+        "task": "loans.tasks.dispatch_outbox_messages",
+        "schedule": OUTBOX_DISPATCH_SECONDS,
+    },
+    "fail-stale-stk-pushes": {
+        "task": "loans.tasks.fail_stale_stk_pushes_task",
+        "schedule": crontab(minute="*"),
+    },
+    "purge-outbox": {
+        "task": "loans.tasks.purge_outbox_messages",
+        "schedule": crontab(hour=3, minute=30),
     },
-    "send-overdue-reminders-daily": {
-        "task": "loans.tasks.send_overdue_reminders",
-        "schedule": crontab(hour=9, minute=0),
+    "pace-loan-reminders": {
+        "task": "loans.tasks.pace_loan_reminders",
+        "schedule": REMINDER_TICK_SECONDS,
     },
     "recompute-credit-scores-nightly": {
         "task": "loans.tasks.recompute_credit_scores_task",
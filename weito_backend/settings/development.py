@@ -1,3 +1,8 @@
+import os
+
 from .base import *
 
 DEBUG = True
+
+AUDIT_LOG_MODE = os.getenv("AUDIT_LOG_MODE", "sync").lower()
+CLIENT_TOKEN_TOUCH_SECONDS = int(os.getenv("CLIENT_TOKEN_TOUCH_SECONDS", "0"))